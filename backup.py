@@ -0,0 +1,162 @@
+"""Backups and point-in-time restore.
+
+Backups go to BACKUP_DIR or, with BACKUP_S3_BUCKET (and optionally BACKUP_S3_PREFIX,
+BACKUP_S3_ENDPOINT for S3-compatible stores), to a bucket. The web server (or
+db_service.py) takes them every BACKUP_INTERVAL_HOURS and journals writes in between;
+this script takes one on demand, lists them, and restores, verifies or benchmarks
+them offline:
+
+    python backup.py backup                                # through the running service, if any
+    python backup.py list
+    python backup.py restore /tmp/students.db --until 2026-10-19T08:30:00
+    python backup.py verify                                # latest backup and its journal, row counts and checksums
+    python backup.py bench --runs 3
+
+Restore writes a new file (refusing to overwrite one unless --force) and the
+archived time tracking files next to it; start the app on it afterwards. Times are UTC.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import main_full
+
+def _store(args):
+    if args.dir:
+        return main_full.LocalBackupStore(args.dir)
+    store = main_full.backup_store()
+    if store is None:
+        sys.exit("No backup target configured (set BACKUP_DIR or BACKUP_S3_BUCKET, or pass --dir)")
+    return store
+
+def _print_tables(report):
+    for table, result in report["tables"].items():
+        status = "ok" if result["ok"] else "MISMATCH"
+        print(f"  {table:32} {result['rows']:>10} rows  {status}")
+
+def _print_checks(report):
+    # The journal's check frames, compared after replaying up to each
+    for check in report.get("replay_checks", ()):
+        status = "MISMATCH " + ", ".join(check["mismatched"]) if check["mismatched"] else "ok"
+        print(f"  journal check at {check['checked_at']}: {check['tables']} tables  {status}")
+
+def cmd_backup(args):
+    main_full.init_db()
+    report = main_full.take_backup()
+    if report is None:
+        sys.exit("No backup target configured (set BACKUP_DIR or BACKUP_S3_BUCKET)")
+    print(json.dumps(report, indent=2))
+
+def cmd_list(args):
+    store = _store(args)
+    print(store.location)
+    for backup_id in main_full.list_backup_manifests(store):
+        stats = main_full.load_backup_manifest(store, backup_id)["stats"]
+        print(f"  {backup_id}  {stats['rows']:>10} rows  {stats['total_bytes'] / 1048576:8.1f} MB  "
+              f"{stats['uploaded_partitions']}/{stats['partitions']} partitions shipped "
+              f"({stats['uploaded_bytes'] / 1048576:.1f} MB)")
+
+def cmd_restore(args):
+    until = datetime.fromisoformat(args.until) if args.until else None
+    report = main_full.restore_backup(
+        args.target, until=until, backup_id=args.backup, store=_store(args),
+        archive_dir=args.archive_dir, replay=not args.no_journal, force=args.force
+    )
+    print(f"Restored backup {report['backup_id']} (taken {report['taken_at']}) to {args.target}")
+    _print_tables(report)
+    print(f"Replayed {report['replayed_transactions']} journaled transactions"
+          + (f" up to {report['replayed_to']}" if report.get("replayed_to") else ""))
+    _print_checks(report)
+    if report.get("replay_error"):
+        print(f"Journal replay {report['replay_error']}")
+    print(f"load {report['load_ms']:.0f} ms, verify {report['verify_ms']:.0f} ms, "
+          f"indexes and archive {report['index_ms']:.0f} ms, replay {report['replay_ms']:.0f} ms, "
+          f"total {report['total_ms']:.0f} ms")
+
+def cmd_verify(args):
+    # Restores into a scratch file and compares every table with the manifest, then
+    # replays the journal and compares with its check frames
+    scratch = tempfile.mkdtemp(prefix="sloka-verify-")
+    try:
+        report = main_full.restore_backup(
+            os.path.join(scratch, "verify.db"), backup_id=args.backup, store=_store(args),
+            archive_dir=os.path.join(scratch, "archive"), verify=False
+        )
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+    print(f"Backup {report['backup_id']} (taken {report['taken_at']})")
+    _print_tables(report)
+    print(f"Replayed {report['replayed_transactions']} journaled transactions")
+    _print_checks(report)
+    if report.get("replay_error"):
+        print(f"Journal replay {report['replay_error']}")
+    if not report["verified"] or not report["replay_verified"] or report.get("replay_error"):
+        sys.exit("Verification failed")
+    print("All row counts and checksums match")
+
+def cmd_bench(args):
+    store = _store(args)
+    runs = []
+    for _ in range(args.runs):
+        scratch = tempfile.mkdtemp(prefix="sloka-bench-")
+        try:
+            runs.append(main_full.restore_backup(
+                os.path.join(scratch, "bench.db"), store=store, archive_dir=os.path.join(scratch, "archive")
+            ))
+            restored_bytes = os.path.getsize(os.path.join(scratch, "bench.db"))
+        finally:
+            shutil.rmtree(scratch, ignore_errors=True)
+    best = min(runs, key=lambda report: report["total_ms"])
+    rows = sum(result["rows"] for result in best["tables"].values())
+    print(f"Backup {best['backup_id']}: {rows} rows, {best['loaded_bytes'] / 1048576:.1f} MB of Parquet, "
+          f"{best['replayed_transactions']} journaled transactions")
+    for report in runs:
+        print(f"  total {report['total_ms']:8.0f} ms  (load {report['load_ms']:.0f}, verify {report['verify_ms']:.0f}, "
+              f"indexes and archive {report['index_ms']:.0f}, replay {report['replay_ms']:.0f})")
+    print(f"best {best['total_ms']:.0f} ms, {restored_bytes / 1048576 / (best['total_ms'] / 1000):.1f} MB/s of database file")
+
+    database = os.getenv("DATABASE_PATH") or "/tmp/students.db"
+    if os.path.exists(database):
+        # For comparison: a plain copy of the live file, which needs writes stopped
+        scratch = tempfile.mkdtemp(prefix="sloka-bench-")
+        try:
+            start = time.perf_counter()
+            shutil.copyfile(database, os.path.join(scratch, "copy.db"))
+            print(f"full file copy of {database} ({os.path.getsize(database) / 1048576:.1f} MB): "
+                  f"{(time.perf_counter() - start) * 1000:.0f} ms")
+        finally:
+            shutil.rmtree(scratch, ignore_errors=True)
+
+def main():
+    parser = argparse.ArgumentParser(description="Backups and point-in-time restore")
+    parser.add_argument("--dir", help="local backup directory (overrides BACKUP_DIR / BACKUP_S3_BUCKET)")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    commands.add_parser("backup", help="take a backup now")
+    commands.add_parser("list", help="list the kept backups")
+
+    restore = commands.add_parser("restore", help="rebuild a database file from a backup and the journal")
+    restore.add_argument("target", help="database file to create")
+    restore.add_argument("--until", help="UTC point in time (ISO 8601); default: everything shipped")
+    restore.add_argument("--backup", help="start from this backup id instead of the latest before --until")
+    restore.add_argument("--archive-dir", help="where to put archived time tracking (default: next to target)")
+    restore.add_argument("--no-journal", action="store_true", help="restore the backup only, without replaying writes")
+    restore.add_argument("--force", action="store_true", help="replace an existing target file")
+
+    verify = commands.add_parser("verify", help="restore to a scratch file, replay the journal and check row counts and checksums")
+    verify.add_argument("--backup", help="backup id (default: latest)")
+
+    bench = commands.add_parser("bench", help="time full restores of the latest backup")
+    bench.add_argument("--runs", type=int, default=3)
+
+    args = parser.parse_args()
+    {"backup": cmd_backup, "list": cmd_list, "restore": cmd_restore, "verify": cmd_verify, "bench": cmd_bench}[args.command](args)
+
+if __name__ == "__main__":
+    main()
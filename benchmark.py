@@ -0,0 +1,411 @@
+"""
+Load-testing and benchmark suite for the Sai Kalpataru Vidyalaya API.
+
+Seeds a reproducible synthetic dataset into a scratch DuckDB file, then drives the
+real FastAPI app (main_full.py) with concurrent clients, either in-process through
+httpx's ASGI transport or over a uvicorn server, and reports p50/p95/p99 latency and
+throughput per scenario.
+
+Usage:
+    pip install -r requirements-bench.txt
+    python benchmark.py                                   # default dataset, both modes
+    python benchmark.py --students 500 --time-entries 200000 --mode uvicorn
+    python benchmark.py --save-baseline                   # record benchmark_baseline.json
+    python benchmark.py --compare                         # exit 1 on regressions
+    python benchmark.py --check-plans --mode none         # query-plan regression check only
+    python benchmark.py --mode none --workers 1,2,4       # db_service.py scaling, 1..N workers
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+ADMIN_EMAIL = "jayab2021@gmail.com"
+ADMIN_PASSWORD = "Admin@123"
+STUDENT_PASSWORD = "bench-password"
+FIRST_STUDENT_ID = 100
+
+# Material sizes per course: (material_type, filename, size in bytes)
+MATERIAL_SIZES = [
+    ("lyrics", "sloka.txt", 4 * 1024),
+    ("lyrics", "sloka.pdf", 256 * 1024),
+    ("recordings", "practice.mp3", 2 * 1024 * 1024),
+    ("recordings", "class.wav", 8 * 1024 * 1024),
+]
+
+SCENARIOS = ["login_storm", "dashboard", "admin_roster", "material_download", "time_entry_burst"]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the Sai Kalpataru Vidyalaya API")
+    parser.add_argument("--students", type=int, default=200)
+    parser.add_argument("--courses", type=int, default=6)
+    parser.add_argument("--time-entries", type=int, default=50000)
+    parser.add_argument("--requests", type=int, default=200, help="requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--mode", choices=["inprocess", "uvicorn", "both", "none"], default="both")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--db", help="scratch database path (default: a temporary file)")
+    parser.add_argument("--output", help="write the JSON results to this file")
+    parser.add_argument("--baseline", default="benchmark_baseline.json")
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--compare", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="allowed relative regression of p95 latency and throughput")
+    parser.add_argument("--check-plans", action="store_true",
+                        help="fail if a hot query falls back to a full table scan on the seeded data")
+    parser.add_argument("--workers", default="",
+                        help="comma-separated uvicorn worker counts to run behind db_service.py, e.g. 1,2,4")
+    return parser.parse_args()
+
+
+def seed_database(app_module, args):
+    """Create the schema through the app, then bulk-load the synthetic dataset."""
+    app_module.init_db()
+    conn = app_module.get_db()
+    rng = random.Random(args.seed)
+    start = time.perf_counter()
+
+    # Every student shares one password hash so seeding doesn't pay N PBKDF2 rounds
+    password_hash = app_module.get_password_hash(STUDENT_PASSWORD)
+
+    for course_id in range(7, args.courses + 1):
+        conn.execute("INSERT OR IGNORE INTO courses (id, name, description) VALUES (?, ?, ?)",
+                     (course_id, f"Bench Course {course_id}", f"Synthetic course {course_id}"))
+
+    conn.execute("""
+        INSERT INTO users (id, first_name, last_name, email, password_hash, is_admin)
+        SELECT ? + i, 'Student', 'No' || i, 'student' || i || '@bench.example.com', ?, FALSE
+        FROM range(?) t(i)
+    """, (FIRST_STUDENT_ID, password_hash, args.students))
+
+    # Each student takes roughly a third of the courses, always at least one
+    conn.execute("""
+        INSERT INTO student_courses (id, student_id, course_id)
+        SELECT row_number() OVER (), s.i + ?, c.i + 1
+        FROM range(?) s(i), range(?) c(i)
+        WHERE (s.i + c.i) % 3 = 0
+    """, (FIRST_STUDENT_ID, args.students, args.courses))
+
+    # Deterministic pseudo-random spread of sessions over students, courses and a year
+    conn.execute("""
+        INSERT INTO time_tracking (id, student_id, course_id, start_time, end_time, duration)
+        SELECT i + 1,
+               ? + (i * 7919) % ?,
+               1 + (i * 31) % ?,
+               TIMESTAMP '2024-01-01' + to_seconds((i * 617) % 31536000),
+               TIMESTAMP '2024-01-01' + to_seconds((i * 617) % 31536000 + 60 + (i * 97) % 3600),
+               60 + (i * 97) % 3600
+        FROM range(?) t(i)
+    """, (FIRST_STUDENT_ID, args.students, args.courses, args.time_entries))
+
+    material_id = 0
+    for course_id in range(1, args.courses + 1):
+        for material_type, filename, size in MATERIAL_SIZES:
+            material_id += 1
+            conn.execute("""
+                INSERT INTO course_materials (id, course_id, material_type, filename, content)
+                VALUES (?, ?, ?, ?, ?)
+            """, (material_id, course_id, material_type, filename, rng.randbytes(size)))
+
+    conn.execute("CHECKPOINT")
+    # Hand the file back; the app (or the uvicorn server) reopens it on startup.
+    # DuckDB allows a single read-write process per database file.
+    app_module.db_conn.close()
+    app_module.db_conn = None
+    print(f"Seeded {args.students} students, {args.courses} courses, {args.time_entries} time entries "
+          f"and {material_id} materials in {time.perf_counter() - start:.1f}s")
+    return material_id
+
+
+def check_plans(app_module):
+    app_module.init_db()
+    try:
+        failures = app_module.check_query_plans(app_module.get_db())
+    finally:
+        app_module.db_conn.close()
+        app_module.db_conn = None
+    if failures:
+        print("Query-plan regressions:")
+        for failure in failures:
+            print(f"  {failure}")
+    else:
+        print(f"Query plans OK: all {len(app_module.HOT_QUERIES)} hot queries are index-backed")
+    return failures
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, round(pct / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+async def login(client, email, password):
+    response = await client.post("/api/login", json={"email": email, "password": password})
+    response.raise_for_status()
+    return {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+
+async def student_headers(client, args, count):
+    rng = random.Random(args.seed)
+    ids = rng.sample(range(args.students), min(count, args.students))
+    headers = []
+    for i in ids:
+        headers.append((FIRST_STUDENT_ID + i, await login(client, f"student{i}@bench.example.com", STUDENT_PASSWORD)))
+    return headers
+
+
+def build_scenarios(args, admin, students, material_count):
+    """Each scenario is a function (request_number) -> (method, url, kwargs)."""
+    rng = random.Random(args.seed)
+
+    def login_storm(n):
+        i = rng.randrange(args.students)
+        return "POST", "/api/login", {"json": {"email": f"student{i}@bench.example.com", "password": STUDENT_PASSWORD}}
+
+    def dashboard(n):
+        student_id, headers = students[n % len(students)]
+        if n % 2 == 0:
+            return "GET", "/api/courses", {"headers": headers}
+        return "GET", f"/api/time-stats/{student_id}", {"headers": headers}
+
+    def admin_roster(n):
+        return "GET", "/api/students", {"headers": admin}
+
+    def material_download(n):
+        student_id, headers = students[n % len(students)]
+        return "GET", f"/api/download-material/{1 + n % material_count}", {"headers": headers}
+
+    def time_entry_burst(n):
+        _, headers = students[n % len(students)]
+        return "POST", "/api/time-tracking", {"headers": headers, "json": {
+            "course_id": 1 + n % args.courses,
+            "start_time": "2025-01-01T10:00:00",
+            "end_time": "2025-01-01T10:30:00",
+            "duration": 1800
+        }}
+
+    return {
+        "login_storm": login_storm,
+        "dashboard": dashboard,
+        "admin_roster": admin_roster,
+        "material_download": material_download,
+        "time_entry_burst": time_entry_burst,
+    }
+
+
+async def run_scenario(client, make_request, total, concurrency):
+    latencies = []
+    errors = 0
+    counter = iter(range(total))
+
+    async def worker():
+        nonlocal errors
+        for n in counter:
+            method, url, kwargs = make_request(n)
+            start = time.perf_counter()
+            try:
+                response = await client.request(method, url, **kwargs)
+                if response.status_code >= 400:
+                    errors += 1
+            except httpx.HTTPError:
+                errors += 1
+            latencies.append((time.perf_counter() - start) * 1000)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "requests": total,
+        "errors": errors,
+        "p50_ms": round(percentile(latencies, 50), 2),
+        "p95_ms": round(percentile(latencies, 95), 2),
+        "p99_ms": round(percentile(latencies, 99), 2),
+        "mean_ms": round(statistics.fmean(latencies), 2) if latencies else 0.0,
+        "throughput_rps": round(total / elapsed, 1) if elapsed else 0.0,
+    }
+
+
+async def drive(client, args, material_count):
+    admin = await login(client, ADMIN_EMAIL, ADMIN_PASSWORD)
+    students = await student_headers(client, args, args.concurrency)
+    scenarios = build_scenarios(args, admin, students, material_count)
+    results = {}
+    for name in args.scenarios.split(","):
+        name = name.strip()
+        if name not in scenarios:
+            raise SystemExit(f"Unknown scenario: {name}")
+        # login_storm is CPU-bound on PBKDF2, so keep it proportionate
+        total = max(args.concurrency, args.requests // 4) if name == "login_storm" else args.requests
+        results[name] = await run_scenario(client, scenarios[name], total, args.concurrency)
+        print_result(name, results[name])
+    return results
+
+
+async def run_inprocess(app_module, args, material_count):
+    transport = httpx.ASGITransport(app=app_module.app)
+    async with app_module.app.router.lifespan_context(app_module.app):
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=120) as client:
+            return await drive(client, args, material_count)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def run_uvicorn(args, material_count, workers=None):
+    port = free_port()
+    env = dict(os.environ, DATABASE_PATH=args.db)
+    if workers:
+        # Single-writer mode: the service owns the file, uvicorn workers talk to it
+        env["DB_SERVICE_SOCKET"] = os.path.join(os.path.dirname(args.db), "db.sock")
+        command = [sys.executable, "db_service.py", "--port", str(port), "--workers", str(workers),
+                   "--socket", env["DB_SERVICE_SOCKET"], "--log-level", "warning"]
+    else:
+        command = [sys.executable, "-m", "uvicorn", "main_full:app", "--port", str(port), "--log-level", "warning"]
+    server = subprocess.Popen(command, env=env, cwd=os.path.dirname(os.path.abspath(__file__)))
+    base_url = f"http://127.0.0.1:{port}"
+    try:
+        limits = httpx.Limits(max_connections=args.concurrency)
+        async with httpx.AsyncClient(base_url=base_url, timeout=120, limits=limits) as client:
+            for _ in range(200):
+                try:
+                    if (await client.get("/login")).status_code == 200:
+                        break
+                except httpx.TransportError:
+                    pass
+                await asyncio.sleep(0.1)
+            else:
+                raise SystemExit("uvicorn did not start")
+            return await drive(client, args, material_count)
+    finally:
+        server.terminate()
+        server.wait(timeout=10)
+
+
+def print_result(name, result):
+    print(f"  {name:<18} p50 {result['p50_ms']:>8.1f} ms  p95 {result['p95_ms']:>8.1f} ms  "
+          f"p99 {result['p99_ms']:>8.1f} ms  {result['throughput_rps']:>8.1f} req/s  "
+          f"errors {result['errors']}")
+
+
+def print_scaling(results, worker_counts):
+    print("Throughput by worker count (req/s):")
+    print("  " + f"{'scenario':<18}" + "".join(f"{n:>10}" for n in worker_counts))
+    first = results["modes"][f"workers-{worker_counts[0]}"]
+    for name in first:
+        row = [results["modes"][f"workers-{n}"][name]["throughput_rps"] for n in worker_counts]
+        print("  " + f"{name:<18}" + "".join(f"{value:>10.1f}" for value in row))
+
+
+def compare_with_baseline(results, baseline, tolerance):
+    regressions = []
+    for mode, scenarios in results["modes"].items():
+        for name, result in scenarios.items():
+            base = baseline.get("modes", {}).get(mode, {}).get(name)
+            if not base:
+                continue
+            if result["p95_ms"] > base["p95_ms"] * (1 + tolerance):
+                regressions.append(f"{mode}/{name}: p95 {result['p95_ms']} ms vs baseline {base['p95_ms']} ms")
+            if result["throughput_rps"] < base["throughput_rps"] * (1 - tolerance):
+                regressions.append(f"{mode}/{name}: {result['throughput_rps']} req/s "
+                                   f"vs baseline {base['throughput_rps']} req/s")
+    return regressions
+
+
+def main():
+    args = parse_args()
+    scratch_dir = None
+    if not args.db:
+        scratch_dir = tempfile.mkdtemp(prefix="sloka-bench-")
+        args.db = os.path.join(scratch_dir, "bench.db")
+    elif os.path.exists(args.db):
+        os.remove(args.db)
+
+    os.environ["DATABASE_PATH"] = args.db
+    # Keep the slow-query log from skewing the numbers it is meant to explain
+    os.environ.setdefault("SLOW_QUERY_EXPLAIN", "false")
+    # Every client shares 127.0.0.1, so the login storm would measure the rate limiter
+    os.environ.setdefault("RATE_LIMIT_ENABLED", "false")
+    import main_full
+
+    material_count = seed_database(main_full, args)
+    results = {
+        "dataset": {"students": args.students, "courses": args.courses, "time_entries": args.time_entries,
+                    "requests": args.requests, "concurrency": args.concurrency, "seed": args.seed},
+        "modes": {}
+    }
+
+    exit_code = 0
+    if args.check_plans and check_plans(main_full):
+        exit_code = 1
+
+    if args.mode in ("inprocess", "both"):
+        print("In-process (ASGI transport):")
+        results["modes"]["inprocess"] = asyncio.run(run_inprocess(main_full, args, material_count))
+
+    if args.mode in ("uvicorn", "both"):
+        if main_full.db_conn is not None:
+            main_full.db_conn.close()
+            main_full.db_conn = None
+        print("uvicorn (HTTP):")
+        results["modes"]["uvicorn"] = asyncio.run(run_uvicorn(args, material_count))
+
+    worker_counts = [int(n) for n in args.workers.split(",") if n.strip()]
+    if worker_counts:
+        if main_full.db_conn is not None:
+            main_full.db_conn.close()
+            main_full.db_conn = None
+        for workers in worker_counts:
+            print(f"db_service.py + {workers} uvicorn worker(s):")
+            results["modes"][f"workers-{workers}"] = asyncio.run(run_uvicorn(args, material_count, workers))
+        print_scaling(results, worker_counts)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Baseline saved to {args.baseline}")
+    elif args.compare:
+        if not os.path.exists(args.baseline):
+            raise SystemExit(f"No baseline at {args.baseline}; run with --save-baseline first")
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get("dataset") != results["dataset"]:
+            print("Warning: baseline was recorded with a different dataset/config")
+        regressions = compare_with_baseline(results, baseline, args.tolerance)
+        if regressions:
+            print("Regressions against baseline:")
+            for line in regressions:
+                print(f"  {line}")
+            exit_code = 1
+        else:
+            print(f"No regressions against baseline (tolerance {args.tolerance:.0%})")
+
+    if scratch_dir:
+        for name in os.listdir(scratch_dir):
+            os.remove(os.path.join(scratch_dir, name))
+        os.rmdir(scratch_dir)
+    sys.exit(exit_code)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+"""Pick the password-hash cost for this host.
+
+Benchmarks PBKDF2-SHA256 on one core and prints the iteration count that makes a
+password check take about the target latency, ready to set as
+PASSWORD_HASH_ITERATIONS. Run it on the deployment's hardware:
+
+    python calibrate_hash.py                     # 50 ms per login
+    python calibrate_hash.py --target-ms 100
+
+Existing hashes keep working at their recorded cost and are upgraded on each user's
+next successful login. Setting PASSWORD_HASH_TARGET_MS instead makes every web
+process run this calibration when it starts.
+"""
+
+import argparse
+import secrets
+
+import main_full
+
+def main():
+    parser = argparse.ArgumentParser(description="Calibrate the PBKDF2 iteration count for a target verify latency")
+    parser.add_argument("--target-ms", type=float, default=50.0,
+                        help="desired time for one password check, in milliseconds")
+    parser.add_argument("--samples", type=int, default=5)
+    args = parser.parse_args()
+
+    iterations, per_thousand_ms = main_full.calibrate_password_hash(args.target_ms, samples=args.samples)
+    estimate_ms = iterations * per_thousand_ms / 1000
+    floored = iterations == main_full.PASSWORD_HASH_MIN_ITERATIONS and estimate_ms > args.target_ms * 1.1
+
+    # Check the pick end to end, the way a login would run it
+    salt = secrets.token_bytes(16)
+    measured_ms = min(
+        main_full._timed_pbkdf2(b"calibration-password", salt, iterations)
+        for _ in range(3)
+    )
+
+    print(f"{main_full.PASSWORD_HASH_ALGORITHM}: {per_thousand_ms:.3f} ms per 1,000 iterations on one core")
+    print(f"{iterations} iterations: {measured_ms:.1f} ms measured, target {args.target_ms:g} ms")
+    if floored:
+        print(f"Raised to PASSWORD_HASH_MIN_ITERATIONS ({main_full.PASSWORD_HASH_MIN_ITERATIONS}); "
+              "this host is slower than the target allows")
+    print()
+    print(f"PASSWORD_HASH_ITERATIONS={iterations}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,260 @@
+"""Single-writer DuckDB service for multi-worker deployments.
+
+DuckDB allows one read-write process per database file, so `uvicorn --workers N`
+cannot open /tmp/students.db from every worker. This process owns the only
+connection, creates the schema, runs the background jobs (derivatives,
+re-clustering, archival) and serves every worker's statements over a Unix socket:
+
+    python db_service.py --workers 4              # service + 4 uvicorn workers
+    python db_service.py                          # service only
+    DB_SERVICE_SOCKET=/tmp/sloka-db.sock uvicorn main_full:app --workers 4
+
+Each client socket gets its own cursor here, so a worker thread's transaction
+stays on one cursor. The service also counts committed writes per table, which
+workers use to invalidate their in-process caches after another worker writes,
+holds the rate-limit token buckets so limits apply across all workers, holds the
+open practice sessions so any worker can serve a session's heartbeat and the
+admin event bus so dashboards see every worker's events, holds the idempotency
+keys so a retried write is caught on any worker, runs
+compaction, pausing worker statements while the database file is swapped, and
+takes backups, journaling every worker's committed writes in between.
+"""
+
+import argparse
+import asyncio
+import os
+import signal
+import socketserver
+import subprocess
+import sys
+import threading
+
+import main_full
+
+DEFAULT_SOCKET = "/tmp/sloka-db.sock"
+
+class TableVersions:
+    def __init__(self):
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def bump(self, tables):
+        with self._lock:
+            for table in tables:
+                self._versions[table] = self._versions.get(table, 0) + 1
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._versions)
+
+class StatementHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        db = main_full.get_db()
+        cursor = db.cursor()
+        generation = db.generation
+        in_transaction = False
+        touched = set()
+        pending = None  # this client's journaled statements awaiting COMMIT
+        try:
+            while True:
+                request = main_full.recv_frame(self.request)
+                if request is None:
+                    return
+                if request[0] == "versions":
+                    versions = self.server.versions.snapshot()
+                    # plus writes by the background jobs running in this process
+                    for table, version in main_full.get_db().table_versions().items():
+                        versions[table] = versions.get(table, 0) + version
+                    main_full.send_frame(self.request, ("ok", versions))
+                    continue
+                if request[0] == "take_tokens":
+                    # Rate-limit buckets shared by every web worker
+                    main_full.send_frame(self.request, ("ok", main_full.local_rate_limits.take(*request[1:])))
+                    continue
+                if request[0] == "practice":
+                    # Practice sessions, so heartbeat and stop work on any web worker
+                    if request[1] not in main_full.PRACTICE_SERVICE_METHODS:
+                        main_full.send_frame(self.request, ("error", "Error", f"Unknown practice call {request[1]}"))
+                        continue
+                    result = getattr(main_full.practice_sessions, request[1])(*request[2:])
+                    main_full.send_frame(self.request, ("ok", result))
+                    continue
+                if request[0] == "idempotency":
+                    # Idempotency keys, so a retry is caught on whichever worker it lands
+                    if request[1] not in main_full.IDEMPOTENCY_SERVICE_METHODS:
+                        main_full.send_frame(self.request, ("error", "Error", f"Unknown idempotency call {request[1]}"))
+                        continue
+                    result = getattr(main_full.idempotency_store, request[1])(*request[2:])
+                    main_full.send_frame(self.request, ("ok", result))
+                    continue
+                if request[0] == "publish":
+                    # A worker's admin event, numbered and fanned out by the bus here
+                    main_full.event_bus.publish(*request[1:])
+                    main_full.send_frame(self.request, ("ok",))
+                    continue
+                if request[0] == "subscribe":
+                    self.stream_events(request[1])
+                    return
+                if request[0] in ("compact", "backup"):
+                    job = main_full.compact_database if request[0] == "compact" else main_full.take_backup
+                    try:
+                        main_full.send_frame(self.request, ("ok", job(*request[1:])))
+                    except Exception as e:
+                        main_full.send_frame(self.request, ("error", type(e).__name__, str(e)))
+                    continue
+
+                _, sql, params = request
+                keyword = sql.lstrip()[:8].upper()
+                match = main_full.WRITE_TARGET.match(sql)
+                # Autocommit writes are applied one at a time, so an INSERT that allocates
+                # its own id can't conflict with the same INSERT from another worker
+                serialize = match is not None and not in_transaction
+                # Waits while compaction pauses writes or swaps the file
+                write = db.gate.enter(sql, in_transaction)
+                journal = main_full.backup_journal
+                # Held from the commit to its journal entry, so entries are in commit order
+                ordered = journal is not None and journal.commits(sql, in_transaction)
+                if ordered:
+                    journal.lock.acquire()
+                was_in_transaction = in_transaction
+                stamp = None
+                succeeded = False
+                try:
+                    if generation != db.generation:
+                        # The file was swapped; the old cursor is closed
+                        cursor = db.cursor()
+                        generation = db.generation
+                    if serialize:
+                        self.server.write_lock.acquire()
+                    try:
+                        if journal is not None:
+                            result, stamp = journal.execute(cursor, sql, params, was_in_transaction, pending)
+                        else:
+                            result = cursor.execute(sql, params) if params is not None else cursor.execute(sql)
+                        # Column types are DuckDBPyType objects, which don't pickle
+                        description = [(column[0], str(column[1]), *column[2:])
+                                       for column in result.description] if result.description else None
+                        rows = result.fetchall() if description else []
+                        succeeded = True
+                    finally:
+                        if serialize:
+                            self.server.write_lock.release()
+                except Exception as e:
+                    main_full.send_frame(self.request, ("error", type(e).__name__, str(e)))
+                    continue
+                finally:
+                    if journal is not None:
+                        pending = journal.record(pending, sql, params, was_in_transaction, succeeded, stamp)
+                    if ordered:
+                        journal.lock.release()
+                    in_transaction = db.gate.leave(sql, was_in_transaction, write, succeeded)
+
+                if keyword.startswith(("COMMIT", "END")):
+                    self.server.versions.bump(touched)
+                    touched.clear()
+                elif keyword.startswith(("ROLLBACK", "ABORT")):
+                    touched.clear()
+                elif match and not (keyword.startswith("COPY") and " TO " in sql.upper()):
+                    if in_transaction:
+                        touched.add(match.group(1).lower())
+                    else:
+                        self.server.versions.bump([match.group(1).lower()])
+
+                main_full.send_frame(self.request, ("ok", rows, description))
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            if in_transaction:
+                write = db.gate.enter("ROLLBACK", True)
+                try:
+                    cursor.execute("ROLLBACK")
+                except Exception:
+                    pass
+                finally:
+                    db.gate.leave("ROLLBACK", True, write)
+            db.close_cursor(cursor)
+
+    def stream_events(self, last_event_id):
+        # Relays the bus to a worker's dashboard until the worker hangs up; the
+        # keepalives are how a dead connection is noticed
+        bus = main_full.event_bus
+        queue = bus.subscribe_threadsafe(last_event_id)
+        try:
+            while True:
+                event = bus.next_event_threadsafe(queue, main_full.EVENT_KEEPALIVE_SECONDS)
+                main_full.send_frame(self.request, ("keepalive",) if event is None else ("event", *event))
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            bus.unsubscribe_threadsafe(queue)
+
+class DatabaseService(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path):
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        self.versions = TableVersions()
+        self.write_lock = threading.Lock()
+        # Frames are pickles, so only this user may connect. The socket is created
+        # 0600 by bind, with no window for another user to connect before a chmod
+        umask = os.umask(0o177)
+        try:
+            super().__init__(socket_path, StatementHandler)
+        finally:
+            os.umask(umask)
+
+async def run_background(web_process):
+    main_full.event_bus.attach(asyncio.get_running_loop())
+    tasks = main_full.start_background_tasks()
+    try:
+        while web_process is None or web_process.poll() is None:
+            await asyncio.sleep(1)
+    finally:
+        main_full.stop_background_tasks(tasks)
+
+def _terminate(signum, frame):
+    raise KeyboardInterrupt
+
+def main():
+    parser = argparse.ArgumentParser(description="Single-writer DuckDB service for multi-worker deployments")
+    parser.add_argument("--socket", default=os.getenv("DB_SERVICE_SOCKET") or DEFAULT_SOCKET)
+    parser.add_argument("--workers", type=int, default=0,
+                        help="also start uvicorn with this many web workers (0 = service only)")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=int(os.getenv("PORT", "8000")))
+    parser.add_argument("--log-level", default="info")
+    args = parser.parse_args()
+
+    # This process is the writer: open the file directly even if the env points workers at us
+    main_full.DB_SERVICE_SOCKET = None
+    main_full.init_db()
+    server = DatabaseService(args.socket)
+    threading.Thread(target=server.serve_forever, name="db-service", daemon=True).start()
+    print(f"Database service listening on {args.socket} ({main_full.database_path})")
+
+    web_process = None
+    if args.workers > 0:
+        env = dict(os.environ, DB_SERVICE_SOCKET=args.socket)
+        web_process = subprocess.Popen([
+            sys.executable, "-m", "uvicorn", "main_full:app",
+            "--host", args.host, "--port", str(args.port), "--workers", str(args.workers),
+            "--log-level", args.log_level
+        ], env=env)
+    signal.signal(signal.SIGTERM, _terminate)
+
+    try:
+        asyncio.run(run_background(web_process))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if web_process is not None and web_process.poll() is None:
+            web_process.terminate()
+            web_process.wait(timeout=30)
+        server.shutdown()
+        server.server_close()
+        os.unlink(args.socket)
+        main_full.get_db().close()
+
+if __name__ == "__main__":
+    main()
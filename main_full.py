@@ -1,19 +1,64 @@
-from fastapi import FastAPI, HTTPException, Depends, Request, File, UploadFile, Form
-from fastapi.responses import HTMLResponse, JSONResponse, RedirectResponse
+from fastapi import FastAPI, HTTPException, Depends, Request, File, UploadFile, Form, Header, BackgroundTasks
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import HTMLResponse, JSONResponse, RedirectResponse, Response, StreamingResponse, FileResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from pydantic import BaseModel, EmailStr
 from jose import JWTError, jwt
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
+from decimal import Decimal
 from contextlib import asynccontextmanager
 import duckdb
 import os
 from typing import Optional, List
 import json
+import math
 import base64
 import hashlib
 import secrets
+import time
+import threading
+import cProfile
+import marshal
+import contextvars
+import pickle
+import socket
+import struct
+import asyncio
+import functools
+import inspect
+import io
+import re
+import shutil
+import subprocess
+import tempfile
+import unicodedata
+import wave
+import weakref
+import zipfile
+import zlib
+from array import array
+from urllib.parse import quote, urlencode
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from fastapi.concurrency import run_in_threadpool
+
+try:
+    import pyinstrument
+except ImportError:  # optional - falls back to cProfile
+    pyinstrument = None
+
+try:
+    from pypdf import PdfReader
+except ImportError:  # optional - falls back to the pdftotext binary
+    PdfReader = None
+
+try:
+    import boto3
+except ImportError:  # optional - only needed for S3 backup targets
+    boto3 = None
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
@@ -24,9 +69,47 @@ async def lifespan(app: FastAPI):
     except Exception as e:
         print(f"Database initialization error: {e}")
         # Continue anyway - database will be initialized on first request
+    # In single-writer mode the database service runs the background jobs once,
+    # instead of every web worker racing on them
+    tasks = [] if DB_SERVICE_SOCKET else start_background_tasks()
     yield
     # Shutdown
-    pass
+    stop_background_tasks(tasks)
+
+def start_background_tasks():
+    return [
+        asyncio.create_task(run_derivative_worker()),
+        asyncio.create_task(run_purge_worker()),
+        asyncio.create_task(run_periodic("Time tracking re-clustering", RECLUSTER_INTERVAL_HOURS * 3600,
+                                         recluster_time_tracking)),
+        asyncio.create_task(run_periodic("Time tracking archival", ARCHIVE_INTERVAL_HOURS * 3600,
+                                         archive_time_tracking)),
+        asyncio.create_task(run_periodic("Analytics snapshot", ANALYTICS_SNAPSHOT_MINUTES * 60,
+                                         take_analytics_snapshot)),
+        asyncio.create_task(run_periodic("Changelog pruning", 24 * 3600, prune_changelog)),
+        asyncio.create_task(run_periodic("Time entry receipt pruning", 24 * 3600, prune_time_entry_receipts)),
+        asyncio.create_task(run_periodic("Refresh session pruning", 24 * 3600, prune_refresh_sessions)),
+        asyncio.create_task(run_periodic("Database compaction", COMPACTION_INTERVAL_HOURS * 3600,
+                                         scheduled_compaction)),
+        asyncio.create_task(run_backup_scheduler()),
+        # Practice sessions are held where the background jobs run (see practice_backend)
+        asyncio.create_task(run_practice_session_sweeper()),
+    ]
+
+def stop_background_tasks(tasks):
+    for task in tasks:
+        task.cancel()
+    if derivative_pool is not None:
+        derivative_pool.shutdown(wait=False, cancel_futures=True)
+    practice_sessions.close_all()
+    try:
+        flush_practice_sessions()
+    except Exception as e:
+        print(f"Practice session flush on shutdown failed: {e}")
+    try:
+        ship_backup_journal()
+    except Exception as e:
+        print(f"Backup journal shipping on shutdown failed: {e}")
 
 app = FastAPI(lifespan=lifespan)
 
@@ -41,8 +124,557 @@ ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", "30")
 
 security = HTTPBearer()
 
+# Diagnostics
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "100"))
+# Capturing a plan re-runs the slow statement on the request path, so it is opt-in
+SLOW_QUERY_EXPLAIN = os.getenv("SLOW_QUERY_EXPLAIN", "false").lower() == "true"
+SLOW_QUERY_LOG_SIZE = int(os.getenv("SLOW_QUERY_LOG_SIZE", "200"))
+PROFILE_HISTORY_SIZE = int(os.getenv("PROFILE_HISTORY_SIZE", "20"))
+
+slow_query_log = deque(maxlen=SLOW_QUERY_LOG_SIZE)
+
+# Per-request counters (queries, db time, hashing time), set by the diagnostics middleware
+_request_stats = contextvars.ContextVar("request_stats", default=None)
+
+def _add_request_timing(key, elapsed_ms):
+    stats = _request_stats.get()
+    if stats is not None:
+        stats[key + "_ms"] = stats.get(key + "_ms", 0.0) + elapsed_ms
+        stats[key + "_count"] = stats.get(key + "_count", 0) + 1
+
+def _params_shape(params):
+    # Record parameter types (and BLOB sizes) only - never the values themselves
+    if params is None:
+        return None
+    shape = []
+    for param in params:
+        if isinstance(param, (bytes, bytearray, memoryview)):
+            shape.append(f"bytes[{len(param)}]")
+        else:
+            shape.append(type(param).__name__)
+    return f"({', '.join(shape)})"
+
+# Statements that write a table; db_service.py uses the same pattern
+WRITE_TARGET = re.compile(
+    r"^\s*(?:INSERT\s+(?:OR\s+\w+\s+)?INTO|UPDATE|DELETE\s+FROM|COPY)\s+(\w+)",
+    re.IGNORECASE
+)
+
+class StatementGate:
+    """Lets compaction hold back statements. pause("writes") blocks new writes and new
+    transactions and waits for running ones to finish, so the file can be copied while
+    reads go on; pause("all") also drains reads, for the moment the file is swapped.
+    Statements inside an open transaction always pass, so it can reach its COMMIT.
+    Waiting blocks the calling thread, which is why routes that write are plain def
+    (run in the threadpool); async routes only read, and reads only wait out the swap.
+
+    Long reads on their own cursor (bundle downloads, backup exports) register as
+    streams. They are not waited for: pause("all") fails at once while one is open,
+    since the swap would close its cursor mid-response.
+
+    It also orders changelog versions: a transaction that takes changelog versions or
+    writes the changelog holds the changelog lock from that statement until it commits
+    or rolls back, so versions become visible in the order they were allocated (see
+    changes_since)."""
+
+    READ_KEYWORDS = ("SELECT", "WITH", "PRAGMA", "EXPLAIN", "SHOW", "DESCRIBE", "SUMMARIZE", "FROM")
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._paused = None  # None, "writes" or "all"
+        self._active = 0
+        self._active_writes = 0
+        self._transactions = 0
+        self._streams = 0
+        self._changelog_lock = threading.Lock()
+        # Each thread runs one transaction at a time (per-thread cursors, one service
+        # handler thread per worker socket), so the holder is tracked per thread
+        self._local = threading.local()
+
+    def enter(self, sql, in_transaction):
+        write = not sql.lstrip()[:9].upper().startswith(self.READ_KEYWORDS)
+        with self._cond:
+            if not in_transaction:
+                while self._paused == "all" or (self._paused == "writes" and write):
+                    self._cond.wait()
+                if _starts_transaction(sql):
+                    self._transactions += 1
+            self._active += 1
+            if write:
+                self._active_writes += 1
+        if not getattr(self._local, "changelog", False):
+            match = WRITE_TARGET.match(sql) if write else None
+            if (match and match.group(1).lower() == "changelog") or "'changelog_version'" in sql:
+                self._changelog_lock.acquire()
+                self._local.changelog = True
+        return write
+
+    def leave(self, sql, in_transaction, write, succeeded=True):
+        """Returns whether the caller is in a transaction afterwards."""
+        with self._cond:
+            self._active -= 1
+            if write:
+                self._active_writes -= 1
+            # A failed COMMIT rolls back too
+            if in_transaction and _ends_transaction(sql):
+                self._transactions -= 1
+                in_transaction = False
+            elif not in_transaction and _starts_transaction(sql):
+                if succeeded:
+                    in_transaction = True
+                else:
+                    self._transactions -= 1
+            self._cond.notify_all()
+        if not in_transaction and getattr(self._local, "changelog", False):
+            self._local.changelog = False
+            self._changelog_lock.release()
+        return in_transaction
+
+    def pause(self, scope, timeout):
+        """Blocks until nothing in scope is running; False (and not paused) on timeout,
+        or straight away for "all" while a stream is open."""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            # No stream can open once "all" is set, so checking here is enough
+            self._paused = None if scope == "all" and self._streams else scope
+            while self._paused is not None and (
+                    self._transactions or (self._active if scope == "all" else self._active_writes)):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._paused = None
+                    break
+                self._cond.wait(remaining)
+            self._cond.notify_all()
+            return self._paused is not None
+
+    def open_stream(self):
+        with self._cond:
+            while self._paused == "all":
+                self._cond.wait()
+            self._streams += 1
+
+    def close_stream(self):
+        with self._cond:
+            self._streams -= 1
+            self._cond.notify_all()
+
+    def resume(self):
+        with self._cond:
+            self._paused = None
+            self._cond.notify_all()
+
+def _starts_transaction(sql):
+    return sql.lstrip()[:5].upper() in ("BEGIN", "START")
+
+def _ends_transaction(sql):
+    return sql.lstrip()[:8].upper().startswith(("COMMIT", "END", "ROLLBACK", "ABORT"))
+
+class InstrumentedConnection:
+    """Wraps a DuckDB connection, timing every statement and logging slow ones.
+
+    Sync dependencies run in the threadpool while async routes run on the event loop,
+    and a single DuckDB connection must not be used from two threads at once, so each
+    thread executes on its own cursor of the shared database.
+
+    It also counts committed writes per table (table_versions), so caches can tell
+    whether the tables behind a stored result have changed, gates statements so
+    compaction can pause writes and swap the database file underneath (see gate),
+    and appends committed writes to the backup journal when backups are on.
+    """
+
+    def __init__(self, conn):
+        self._conn = conn
+        self._local = threading.local()
+        self._cursors = []
+        self._cursors_lock = threading.Lock()
+        self._versions = {}
+        self._versions_lock = threading.Lock()
+        self.gate = StatementGate()
+        # Bumped when the database file is swapped; cursors from before are closed
+        self.generation = 0
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def cursor(self):
+        # Tracked, so a swap can close it; callers compare generation to notice
+        cursor = self._conn.cursor()
+        with self._cursors_lock:
+            self._cursors.append(cursor)
+        return cursor
+
+    def stream_cursor(self):
+        """A cursor for a long read transaction (see StatementGate streams); close it
+        with close_cursor(cursor, stream=True)."""
+        self.gate.open_stream()
+        try:
+            return self.cursor()
+        except Exception:
+            self.gate.close_stream()
+            raise
+
+    def close_cursor(self, cursor, stream=False):
+        with self._cursors_lock:
+            if cursor in self._cursors:
+                self._cursors.remove(cursor)
+        try:
+            cursor.close()
+        finally:
+            if stream:
+                self.gate.close_stream()
+
+    def _thread_cursor(self):
+        cursor = getattr(self._local, "cursor", None)
+        if cursor is None or self._local.generation != self.generation:
+            cursor = self.cursor()
+            self._local.cursor = cursor
+            self._local.generation = self.generation
+        return cursor
+
+    def close(self):
+        with self._cursors_lock:
+            for cursor in self._cursors:
+                cursor.close()
+            self._cursors.clear()
+        self._conn.close()
+
+    def execute(self, sql, params=None):
+        if isinstance(self._conn, RemoteDatabase):  # the service gates those
+            return self._execute(sql, params)[0]
+        in_transaction = getattr(self._local, "in_transaction", False)
+        write = self.gate.enter(sql, in_transaction)
+        journal = backup_journal
+        # Held from the commit to its journal entry, so entries are in commit order
+        ordered = journal is not None and journal.commits(sql, in_transaction)
+        if ordered:
+            journal.lock.acquire()
+        pending = getattr(self._local, "journal", None)
+        stamp = None
+        succeeded = False
+        try:
+            result, stamp = self._execute(sql, params, journal, in_transaction, pending)
+            succeeded = True
+            return result
+        finally:
+            if journal is not None:
+                self._local.journal = journal.record(pending, sql, params, in_transaction, succeeded, stamp)
+            if ordered:
+                journal.lock.release()
+            self._local.in_transaction = self.gate.leave(sql, in_transaction, write, succeeded)
+
+    def _execute(self, sql, params, journal=None, in_transaction=False, pending=None):
+        # Returns (result, journal stamp)
+        conn = self._thread_cursor()
+        start = time.perf_counter()
+        if journal is not None:
+            result, stamp = journal.execute(conn, sql, params, in_transaction, pending)
+        else:
+            result = conn.execute(sql, params) if params is not None else conn.execute(sql)
+            stamp = None
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        _add_request_timing("db", elapsed_ms)
+        if elapsed_ms >= SLOW_QUERY_MS:
+            self._log_slow_query(sql, params, elapsed_ms)
+        if not isinstance(self._conn, RemoteDatabase):  # the service counts those
+            self._track_writes(sql)
+        return result, stamp
+
+    def _track_writes(self, sql):
+        # Writes inside a transaction count at COMMIT, so a reader can't cache
+        # uncommitted state under the new version
+        keyword = sql.lstrip()[:8].upper()
+        touched = getattr(self._local, "touched", None)
+        if keyword.startswith(("BEGIN", "START")):
+            self._local.touched = set()
+        elif keyword.startswith(("COMMIT", "END")):
+            self._bump(touched or ())
+            self._local.touched = None
+        elif keyword.startswith(("ROLLBACK", "ABORT")):
+            self._local.touched = None
+        else:
+            match = WRITE_TARGET.match(sql)
+            if match and not (keyword.startswith("COPY") and " TO " in sql.upper()):
+                if touched is not None:
+                    touched.add(match.group(1).lower())
+                else:
+                    self._bump([match.group(1).lower()])
+
+    def _bump(self, tables):
+        with self._versions_lock:
+            for table in tables:
+                self._versions[table] = self._versions.get(table, 0) + 1
+
+    def table_versions(self):
+        if isinstance(self._conn, RemoteDatabase):
+            return self._conn.table_versions()
+        with self._versions_lock:
+            return dict(self._versions)
+
+    def swap_database(self, path, replacement):
+        """Move replacement over path and reopen. Call with the gate paused for all
+        statements; every cursor on the old file is closed first, since DuckDB keeps
+        a database open (and reuses it for the same path) while any cursor lives."""
+        with self._cursors_lock:
+            for cursor in self._cursors:
+                cursor.close()
+            self._cursors.clear()
+        self._conn.close()
+        try:
+            # The old file was checkpointed; a leftover log must not replay onto the new one
+            if os.path.exists(path + ".wal"):
+                os.remove(path + ".wal")
+            os.replace(replacement, path)
+        finally:
+            self._conn = duckdb.connect(path)
+            self.generation += 1
+
+    def _log_slow_query(self, sql, params, elapsed_ms):
+        statement = " ".join(sql.split())
+        stats = _request_stats.get()
+        entry = {
+            "sql": statement,
+            "params": _params_shape(params),
+            "duration_ms": round(elapsed_ms, 2),
+            "path": stats.get("path") if stats else None,
+            "logged_at": datetime.utcnow().isoformat(),
+            "plan": None
+        }
+        # EXPLAIN ANALYZE re-runs the statement, so only do it for reads. A separate
+        # cursor keeps the caller's pending result set intact.
+        if SLOW_QUERY_EXPLAIN and statement.upper().startswith(("SELECT", "WITH")):
+            try:
+                cursor = self._conn.cursor()
+                rows = cursor.execute("EXPLAIN ANALYZE " + sql, params).fetchall()
+                entry["plan"] = "\n".join(row[1] for row in rows)
+                cursor.close()
+            except Exception as e:
+                entry["plan"] = f"EXPLAIN ANALYZE failed: {e}"
+        slow_query_log.append(entry)
+        print(f"Slow query ({entry['duration_ms']} ms, {entry['path']}): {statement[:200]} params={entry['params']}")
+
+# Single-writer mode. DuckDB allows one read-write process per database file, so
+# to run several web workers a dedicated db_service.py process owns the connection
+# and every worker sends its statements over a Unix socket. Each client socket maps
+# to its own server-side cursor, so BEGIN/COMMIT sequences from one thread stay on
+# one cursor exactly like the per-thread cursors above.
+DB_SERVICE_SOCKET = os.getenv("DB_SERVICE_SOCKET")
+_FRAME_HEADER = struct.Struct("!I")
+
+def encode_frame(payload):
+    data = pickle.dumps(payload, protocol=pickle.HIGHEST_PROTOCOL)
+    return _FRAME_HEADER.pack(len(data)) + data
+
+def send_frame(sock, payload):
+    sock.sendall(encode_frame(payload))
+
+def recv_frame(sock):
+    header = _recv_exact(sock, _FRAME_HEADER.size)
+    if header is None:
+        return None
+    (length,) = _FRAME_HEADER.unpack(header)
+    data = _recv_exact(sock, length)
+    if data is None:
+        raise ConnectionError("Database service closed the connection mid-frame")
+    return pickle.loads(data)
+
+def _recv_exact(sock, size):
+    buf = bytearray()
+    while len(buf) < size:
+        chunk = sock.recv(min(size - len(buf), 1 << 20))
+        if not chunk:
+            if buf:
+                raise ConnectionError("Database service closed the connection mid-frame")
+            return None
+        buf.extend(chunk)
+    return bytes(buf)
+
+class RemoteCursor:
+    """A cursor on the database service. Results are materialised server side and
+    shipped in one frame, so fetchone/fetchall only walk the local rows."""
+
+    def __init__(self, socket_path):
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.connect(socket_path)
+        self._rows = []
+        self._pos = 0
+        self.description = None
+
+    def _call(self, *request):
+        send_frame(self._sock, request)
+        response = recv_frame(self._sock)
+        if response is None:
+            raise ConnectionError("Database service closed the connection")
+        if response[0] == "error":
+            # Re-raise as the same duckdb exception class so callers' except clauses still match
+            exc_type = getattr(duckdb, response[1], None)
+            if not (isinstance(exc_type, type) and issubclass(exc_type, Exception)):
+                exc_type = duckdb.Error
+            raise exc_type(response[2])
+        return response[1:]
+
+    def execute(self, sql, params=None):
+        self._rows, self.description = self._call("execute", sql, params)
+        self._pos = 0
+        return self
+
+    def fetchone(self):
+        if self._pos >= len(self._rows):
+            return None
+        row = self._rows[self._pos]
+        self._pos += 1
+        return row
+
+    def fetchall(self):
+        rows = self._rows[self._pos:]
+        self._pos = len(self._rows)
+        return rows
+
+    def table_versions(self):
+        return self._call("versions")[0]
+
+    def take_tokens(self, key, capacity, window_seconds, cost=1):
+        return self._call("take_tokens", key, capacity, window_seconds, cost)[0]
+
+    def practice(self, method, *args):
+        return self._call("practice", method, *args)[0]
+
+    def close(self):
+        try:
+            self._sock.close()
+        except OSError:
+            pass
+
+class RemoteDatabase:
+    """Stands in for a duckdb connection inside InstrumentedConnection."""
+
+    def __init__(self, socket_path):
+        self.socket_path = socket_path
+        self._default = None
+        self._versions_cursor = None
+        self._lock = threading.Lock()
+
+    def cursor(self):
+        return RemoteCursor(self.socket_path)
+
+    def execute(self, sql, params=None):
+        if self._default is None:
+            self._default = self.cursor()
+        return self._default.execute(sql, params)
+
+    def table_versions(self):
+        with self._lock:
+            if self._versions_cursor is None:
+                self._versions_cursor = self.cursor()
+            return self._versions_cursor.table_versions()
+
+    def take_tokens(self, key, capacity, window_seconds, cost=1):
+        # Rate-limit buckets held by the service; shares the versions socket
+        with self._lock:
+            if self._versions_cursor is None:
+                self._versions_cursor = self.cursor()
+            return self._versions_cursor.take_tokens(key, capacity, window_seconds, cost)
+
+    def practice(self, method, *args):
+        # Practice sessions held by the service, so any worker can serve a session
+        with self._lock:
+            if self._versions_cursor is None:
+                self._versions_cursor = self.cursor()
+            return self._versions_cursor.practice(method, *args)
+
+    def idempotency(self, method, *args):
+        # Its own socket: a claim may wait on a duplicate running elsewhere
+        cursor = self.cursor()
+        try:
+            return cursor._call("idempotency", method, *args)[0]
+        finally:
+            cursor.close()
+
+    def compact(self, force=False):
+        # Runs in the service, which owns the file; its own socket, since it takes a while
+        cursor = self.cursor()
+        try:
+            return cursor._call("compact", force)[0]
+        finally:
+            cursor.close()
+
+    def backup(self):
+        cursor = self.cursor()
+        try:
+            return cursor._call("backup")[0]
+        finally:
+            cursor.close()
+
+    def close(self):
+        for cursor in (self._default, self._versions_cursor):
+            if cursor is not None:
+                cursor.close()
+        self._default = self._versions_cursor = None
+
+# Request profiler: armed per request by an admin "X-Profile" header, or for the next N
+# matching requests through /api/admin/profiling. Only one profile runs at a time.
+profiling_state = {"remaining": 0, "path_prefix": "/api/"}
+profile_history = deque(maxlen=PROFILE_HISTORY_SIZE)
+_profiler_lock = threading.Lock()
+_profile_counter = 0
+
+class RequestProfiler:
+    """pyinstrument when installed (speedscope JSON), otherwise cProfile (pstats dump)."""
+
+    def __init__(self):
+        if pyinstrument is not None:
+            self.format = "speedscope"
+            self._profiler = pyinstrument.Profiler(async_mode="enabled")
+        else:
+            self.format = "pstats"
+            self._profiler = cProfile.Profile()
+
+    def start(self):
+        if self.format == "speedscope":
+            self._profiler.start()
+        else:
+            self._profiler.enable()
+
+    def stop(self):
+        if self.format == "speedscope":
+            from pyinstrument.renderers import SpeedscopeRenderer
+            self._profiler.stop()
+            return self._profiler.output(renderer=SpeedscopeRenderer()).encode("utf-8")
+        self._profiler.disable()
+        self._profiler.create_stats()
+        # Same bytes as pstats.Stats.dump_stats - loadable by snakeviz/flameprof
+        return marshal.dumps(self._profiler.stats)
+
+def _is_admin_request(request: Request):
+    auth_header = request.headers.get("authorization", "")
+    if not auth_header.lower().startswith("bearer "):
+        return False
+    try:
+        payload = jwt.decode(auth_header[7:], SECRET_KEY, algorithms=[ALGORITHM])
+        user = get_db().execute("SELECT is_admin FROM users WHERE email = ? AND deleted_at IS NULL",
+                                (payload.get("sub"),)).fetchone()
+        return bool(user and user[0])
+    except Exception:
+        return False
+
+def _profile_requested(request: Request):
+    if request.headers.get("x-profile") and _is_admin_request(request):
+        return "header"
+    if profiling_state["remaining"] > 0 and request.url.path.startswith(profiling_state["path_prefix"]):
+        return "armed"
+    return None
+
+def _profile_response(profile_id, profile_format, data, status_code):
+    media_type = "application/json" if profile_format == "speedscope" else "application/octet-stream"
+    extension = "speedscope.json" if profile_format == "speedscope" else "prof"
+    return Response(content=data, media_type=media_type, headers={
+        "Content-Disposition": f'attachment; filename="profile-{profile_id}.{extension}"',
+        "X-Profile-Format": profile_format,
+        "X-Profiled-Status": str(status_code)
+    })
+
 # Global database connection
 db_conn = None
+database_path = None
 
 # Helper function to get database connection
 def get_db():
@@ -53,17 +685,30 @@ def get_db():
 
 # Database initialization
 def init_db():
-    global db_conn
+    global db_conn, database_path
     # Use in-memory database for serverless environments
     # In production, you'd use a proper database service
+    # Try to use a temporary file first (DATABASE_PATH overrides, e.g. for benchmarks)
+    db_path = os.getenv("DATABASE_PATH") or ("/tmp/students.db" if os.path.exists("/tmp") else ":memory:")
+    if DB_SERVICE_SOCKET:
+        # Web worker in single-writer mode: db_service.py already created the schema
+        db_conn = InstrumentedConnection(RemoteDatabase(DB_SERVICE_SOCKET))
+        database_path = db_path
+        return
+    if BACKUP_RESTORE_ON_START and db_path != ":memory:" and not os.path.exists(db_path) and backup_store() is not None:
+        try:
+            report = restore_backup(db_path)
+            print(f"Restored backup {report['backup_id']} plus {report['replayed_transactions']} journaled transactions")
+        except Exception as e:
+            print(f"Restore on start failed: {e}")
     try:
-        # Try to use a temporary file first
-        db_path = "/tmp/students.db" if os.path.exists("/tmp") else ":memory:"
-        db_conn = duckdb.connect(db_path)
+        db_conn = InstrumentedConnection(duckdb.connect(db_path))
+        database_path = db_path
         conn = db_conn
     except Exception as e:
         # Fallback to in-memory database
-        db_conn = duckdb.connect(":memory:")
+        db_conn = InstrumentedConnection(duckdb.connect(":memory:"))
+        database_path = ":memory:"
         conn = db_conn
     
     # Users table
@@ -75,9 +720,14 @@ def init_db():
             email VARCHAR UNIQUE,
             password_hash VARCHAR,
             is_admin BOOLEAN DEFAULT FALSE,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            deleted_at TIMESTAMP -- set when removed, with email cleared so it can register again;
+                                 -- the row goes once its purge job finishes
         )
     """)
+    conn.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS deleted_at TIMESTAMP")
+    # Students removed before their email was cleared at removal
+    conn.execute("UPDATE users SET email = NULL WHERE deleted_at IS NOT NULL AND email IS NOT NULL")
     
     # Courses table
     conn.execute("""
@@ -102,17 +752,28 @@ def init_db():
     """)
     
     # Time tracking
+    create_time_tracking_table(conn)
+    
+    # Monthly totals of archived time entries (see archive_time_tracking)
     conn.execute("""
-        CREATE TABLE IF NOT EXISTS time_tracking (
-            id INTEGER PRIMARY KEY,
+        CREATE TABLE IF NOT EXISTS time_tracking_rollups (
             student_id INTEGER,
             course_id INTEGER,
-            start_time TIMESTAMP,
-            end_time TIMESTAMP,
-            duration INTEGER,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (student_id) REFERENCES users(id),
-            FOREIGN KEY (course_id) REFERENCES courses(id)
+            year INTEGER,
+            month INTEGER,
+            total_duration BIGINT,
+            sessions INTEGER,
+            PRIMARY KEY (student_id, course_id, year, month)
+        )
+    """)
+    
+    # Archive batches whose rows were moved to Parquet
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS time_tracking_archive_batches (
+            batch_id VARCHAR PRIMARY KEY,
+            cutoff TIMESTAMP,
+            row_count INTEGER,
+            archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
     """)
     
@@ -129,6 +790,108 @@ def init_db():
         )
     """)
     
+    # Derived renditions of materials (compressed audio, waveform peaks, lyrics previews)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS material_derivatives (
+            id INTEGER PRIMARY KEY,
+            material_id INTEGER,
+            kind VARCHAR, -- 'audio_opus', 'audio_mp3', 'waveform', 'preview_text', 'preview_image'
+            mime_type VARCHAR,
+            content BLOB,
+            size INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    
+    # Persistent queue for the derivative pipeline
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS derivative_jobs (
+            id INTEGER PRIMARY KEY,
+            material_id INTEGER,
+            status VARCHAR DEFAULT 'pending', -- 'pending', 'running', 'done' or 'failed'
+            attempts INTEGER DEFAULT 0,
+            last_error VARCHAR,
+            next_attempt_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP
+        )
+    """)
+    
+    # Full-text search over material filenames and lyrics text (see index_material_text)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS search_documents (
+            material_id INTEGER PRIMARY KEY,
+            course_id INTEGER,
+            length INTEGER, -- number of words, for BM25 length normalisation
+            text VARCHAR
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS search_postings (
+            term VARCHAR,
+            material_id INTEGER,
+            tf INTEGER,
+            PRIMARY KEY (term, material_id)
+        )
+    """)
+    
+    # Change tracking for delta sync: one row per changed record, newest version wins
+    conn.execute("CREATE SEQUENCE IF NOT EXISTS changelog_version START 1")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS changelog (
+            version BIGINT PRIMARY KEY,
+            table_name VARCHAR,
+            row_key VARCHAR,
+            op VARCHAR, -- 'upsert' or 'delete'
+            changed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    
+    # Keys of time entries recorded offline and synced later, so a replayed batch
+    # never records the same practice twice
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS time_entry_receipts (
+            student_id INTEGER,
+            entry_key VARCHAR,
+            received_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (student_id, entry_key)
+        )
+    """)
+    
+    # Refresh-token sessions: one row per signed-in device. Only hashes of the
+    # secrets are stored; previous_hash is the secret the last rotation replaced
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS refresh_sessions (
+            id VARCHAR PRIMARY KEY,
+            user_id INTEGER,
+            token_hash VARCHAR,
+            previous_hash VARCHAR,
+            created_at TIMESTAMP,
+            rotated_at TIMESTAMP,
+            expires_at TIMESTAMP
+        )
+    """)
+    
+    # Physical deletion of removed students' data, done in the background (see purge_students)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS purge_jobs (
+            id INTEGER PRIMARY KEY,
+            student_id INTEGER,
+            cohort VARCHAR,
+            status VARCHAR DEFAULT 'pending', -- 'pending', 'running', 'done' or 'failed'
+            rows_total BIGINT DEFAULT 0,
+            rows_deleted BIGINT DEFAULT 0,
+            attempts INTEGER DEFAULT 0,
+            last_error VARCHAR,
+            next_attempt_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            finished_at TIMESTAMP
+        )
+    """)
+    
+    migrate_hot_path_indexes(conn)
+    recover_time_tracking_archive(conn)
+    
     # Insert default courses
     courses = ["śravaṇaṃ", "Kirtanam", "Smaranam", "Pada Sevanam", "Archanam", "Vandanam"]
     for i, course in enumerate(courses, 1):
@@ -149,77 +912,3925 @@ def init_db():
         VALUES (?, ?, ?, ?, ?, ?)
     """, (2, "Jaya", "B", "jayab2021@gmail.com", admin_hash2, True))
     
+    # After the rows seeded with fixed ids above
+    sync_id_sequences(conn)
+    configure_backup_journal()
 
-# Models
-class UserCreate(BaseModel):
-    first_name: str
-    last_name: str
-    email: EmailStr
-    password: str
+def create_time_tracking_table(conn):
+    # Also used by re-clustering to rebuild the table in sorted order
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS time_tracking (
+            id INTEGER PRIMARY KEY,
+            student_id INTEGER,
+            course_id INTEGER,
+            start_time TIMESTAMP,
+            end_time TIMESTAMP,
+            duration INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (student_id) REFERENCES users(id),
+            FOREIGN KEY (course_id) REFERENCES courses(id)
+        )
+    """)
 
-class UserLogin(BaseModel):
-    email: EmailStr
-    password: str
+# Row ids come from sequences: nextval is outside transactions, so concurrent
+# writers never hand out the same id the way SELECT MAX(id) + 1 can
+ID_SEQUENCES = [
+    ("users", "users_id"),
+    ("student_courses", "student_courses_id"),
+    ("course_materials", "course_materials_id"),
+    ("material_derivatives", "material_derivatives_id"),
+    ("derivative_jobs", "derivative_jobs_id"),
+    ("purge_jobs", "purge_jobs_id"),
+    # Archived entries keep their ids, so time_tracking continues after the archive too
+    ("time_tracking_all", "time_tracking_id"),
+]
 
-class TimeEntry(BaseModel):
-    course_id: int
-    start_time: datetime
-    end_time: Optional[datetime] = None
-    duration: Optional[int] = None
+def sync_id_sequences(conn):
+    """Create each id sequence, or restart it past the table's highest id when rows
+    were inserted with explicit ids (seeding, older versions of the app)."""
+    sequences = {name: last_value for name, last_value in conn.execute("""
+        SELECT sequence_name, COALESCE(last_value, start_value - increment_by)
+        FROM duckdb_sequences() WHERE schema_name = 'main'
+    """).fetchall()}
+    for source, sequence in ID_SEQUENCES:
+        max_id = conn.execute(f"SELECT COALESCE(MAX(id), 0) FROM {source}").fetchone()[0]
+        if sequence in sequences:
+            if sequences[sequence] >= max_id:
+                continue
+            conn.execute(f"DROP SEQUENCE {sequence}")
+        conn.execute(f"CREATE SEQUENCE {sequence} START {max_id + 1}")
 
-# Utility functions
-def verify_password(plain_password, hashed_password):
-    # Split the stored hash to get salt and hash
+def next_ids(conn, sequence, count=1):
+    """Takes count values from sequence. Writes bind them as parameters rather than
+    calling nextval inline, so the backup journal replays the ids they really got."""
+    return [row[0] for row in conn.execute(f"SELECT nextval('{sequence}') FROM range(?)", (count,)).fetchall()]
+
+# ART indexes for the hot lookup paths: student_courses by student and by
+# (student, course), time_tracking by student, materials and derivatives by owner
+HOT_PATH_INDEXES = [
+    ("idx_student_courses_student", "student_courses (student_id)", False),
+    ("idx_student_courses_student_course", "student_courses (student_id, course_id)", True),
+    ("idx_time_tracking_student", "time_tracking (student_id)", False),
+    ("idx_time_tracking_rollups_student", "time_tracking_rollups (student_id)", False),
+    ("idx_course_materials_course", "course_materials (course_id)", False),
+    ("idx_material_derivatives_material", "material_derivatives (material_id)", False),
+]
+
+def create_hot_path_indexes(conn, table=None):
+    for name, target, unique in HOT_PATH_INDEXES:
+        if table is None or target.startswith(table + " "):
+            conn.execute(f"CREATE {'UNIQUE ' if unique else ''}INDEX IF NOT EXISTS {name} ON {target}")
+
+def migrate_hot_path_indexes(conn):
+    existing = {row[0] for row in conn.execute("SELECT index_name FROM duckdb_indexes()").fetchall()}
+    if "idx_student_courses_student_course" not in existing:
+        # Older databases may hold duplicate assignments; keep the earliest of each pair
+        removed = conn.execute("""
+            DELETE FROM student_courses
+            WHERE id NOT IN (SELECT MIN(id) FROM student_courses GROUP BY student_id, course_id)
+        """).fetchone()[0]
+        if removed:
+            print(f"Removed {removed} duplicate course assignments before adding unique index")
+    create_hot_path_indexes(conn)
+
+# Query-plan regression check: hot queries that must be served by an index rather
+# than a full scan of the named table, each with a query for sample parameters.
+# DuckDB only picks an index scan for selective filters (index_scan_max_count), so
+# run it on representative data, e.g. through `python benchmark.py --check-plans`
+# or tests/test_query_plans.py.
+HOT_QUERIES = [
+    ("student assignments", "student_courses", """
+        SELECT sc.course_id, c.name
+        FROM student_courses sc
+        JOIN courses c ON sc.course_id = c.id
+        WHERE sc.student_id = ?
+        ORDER BY c.name
+    """, "SELECT student_id FROM student_courses"),
+    ("assigned course ids", "student_courses",
+     "SELECT course_id FROM student_courses WHERE student_id = ?", "SELECT student_id FROM student_courses"),
+    ("student practice total", "time_tracking",
+     "SELECT COALESCE(SUM(duration), 0) FROM time_tracking WHERE student_id = ?",
+     "SELECT student_id FROM time_tracking"),
+    ("time stats", "time_tracking", """
+        SELECT c.name, SUM(tt.total_time) as total_time, SUM(tt.sessions) as sessions
+        FROM (
+            SELECT course_id, SUM(duration) AS total_time, COUNT(id) AS sessions
+            FROM time_tracking WHERE student_id = ? GROUP BY course_id
+            UNION ALL
+            SELECT course_id, SUM(total_duration), SUM(sessions)
+            FROM time_tracking_rollups WHERE student_id = ? GROUP BY course_id
+        ) tt
+        JOIN courses c ON tt.course_id = c.id
+        GROUP BY c.id, c.name
+    """, "SELECT student_id, student_id FROM time_tracking"),
+    ("course materials", "course_materials",
+     "SELECT id, material_type, filename, uploaded_at FROM course_materials WHERE course_id = ?",
+     "SELECT course_id FROM course_materials"),
+    ("material derivatives", "material_derivatives",
+     "SELECT kind, mime_type, size FROM material_derivatives WHERE material_id = ?",
+     "SELECT material_id FROM material_derivatives"),
+    ("user by email", "users",
+     "SELECT id, is_admin FROM users WHERE email = ?", "SELECT email FROM users"),
+]
+
+def _plan_scans(node, scans):
+    name = (node.get("operator_name") or node.get("name") or "").strip()
+    if name.endswith("_SCAN"):
+        extra = node.get("extra_info", {})
+        table = extra.get("Table") or extra.get("Text") or ""
+        # Tables are reported qualified (database.schema.table)
+        scans.append((extra.get("Type") or name, table.rsplit(".", 1)[-1]))
+    for child in node.get("children", []):
+        _plan_scans(child, scans)
+    return scans
+
+def check_query_plans(conn):
+    """Returns a list of failures; empty when every hot query uses an index.
+
+    DuckDB decides between an index and a sequential scan when the query runs, and
+    plain EXPLAIN always shows a sequential scan, so the queries run under EXPLAIN ANALYZE.
+    """
+    failures = []
+    for name, table, sql, sample in HOT_QUERIES:
+        # Parameters from an existing row: a value outside the table's range is
+        # answered from zonemaps without any scan
+        params = conn.execute(sample + " LIMIT 1").fetchone()
+        if params is None:
+            continue  # nothing to scan yet
+        plan = json.loads(conn.execute("EXPLAIN (ANALYZE, FORMAT JSON) " + sql, params).fetchall()[0][1])
+        scans = _plan_scans(plan, [])
+        if any(scan_type != "Index Scan" and scanned == table for scan_type, scanned in scans):
+            failures.append(f"{name}: full scan of {table}")
+    return failures
+
+# Re-clustering: rewrite time_tracking ordered by (student_id, start_time) so each
+# student's history sits in a few row groups and zonemaps prune the rest
+RECLUSTER_INTERVAL_HOURS = float(os.getenv("RECLUSTER_INTERVAL_HOURS", "24"))
+RECLUSTER_MIN_NEW_ROWS = int(os.getenv("RECLUSTER_MIN_NEW_ROWS", "1000"))
+_reclustered_row_count = None
+
+def recluster_time_tracking(force=False):
+    global _reclustered_row_count
+    conn = get_db()
+    row_count = conn.execute("SELECT COUNT(*) FROM time_tracking").fetchone()[0]
+    if not force and _reclustered_row_count is not None and row_count - _reclustered_row_count < RECLUSTER_MIN_NEW_ROWS:
+        return None
+
+    start = time.perf_counter()
+    conn.execute("BEGIN TRANSACTION")
     try:
-        stored_salt, stored_hash = hashed_password.split('$', 1)
-        # Hash the plain password with the stored salt
-        password_hash = hashlib.pbkdf2_hmac('sha256', plain_password.encode('utf-8'), stored_salt.encode('utf-8'), 100000)
-        return secrets.compare_digest(password_hash.hex(), stored_hash)
-    except:
-        return False
+        # Rebuild under the original name: a renamed copy would leave the users/courses
+        # foreign keys pointing at the copy's old name
+        conn.execute("""
+            CREATE TEMP TABLE time_tracking_sorted AS
+            SELECT * FROM time_tracking ORDER BY student_id, start_time
+        """)
+        conn.execute("DROP TABLE time_tracking")
+        create_time_tracking_table(conn)
+        conn.execute("INSERT INTO time_tracking SELECT * FROM time_tracking_sorted")
+        conn.execute("DROP TABLE time_tracking_sorted")
+        create_hot_path_indexes(conn, "time_tracking")
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    _reclustered_row_count = row_count
+    return f"re-clustered {row_count} time entries in {time.perf_counter() - start:.2f}s"
 
-def get_password_hash(password):
-    # Generate a random salt
-    salt = secrets.token_hex(32)
-    # Hash the password with the salt
-    password_hash = hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), salt.encode('utf-8'), 100000)
-    # Return salt$hash format
-    return f"{salt}${password_hash.hex()}"
+# Hot/cold tiering: closed months of time_tracking move to Hive-partitioned Parquet
+# (year=YYYY/month=M) under the archive directory. Per (student, course, month)
+# totals go to time_tracking_rollups so dashboards never read the archive, and
+# the time_tracking_all view UNIONs the hot table with the archive for detail
+# queries. Filtering that view on year/month prunes whole partitions.
+TIME_TRACKING_HOT_MONTHS = int(os.getenv("TIME_TRACKING_HOT_MONTHS", "2"))
+ARCHIVE_INTERVAL_HOURS = float(os.getenv("ARCHIVE_INTERVAL_HOURS", "24"))
 
-def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
-    to_encode = data.copy()
-    if expires_delta:
-        expire = datetime.utcnow() + expires_delta
+# Held from an archival transaction until its files are published, so a backup never
+# sees the rows gone from time_tracking but not yet in the archive
+_archive_lock = threading.Lock()
+
+def time_tracking_archive_dir(db_path=None):
+    configured = os.getenv("TIME_TRACKING_ARCHIVE_DIR")
+    if configured:
+        return configured
+    db_path = db_path or database_path
+    if db_path == ":memory:":
+        return os.path.join(tempfile.gettempdir(), "time_tracking_archive")
+    return os.path.join(os.path.dirname(os.path.abspath(db_path)), "time_tracking_archive")
+
+def _archive_files(archive_dir):
+    files = []
+    for root, _, names in os.walk(archive_dir):
+        if "_staging" in root:
+            continue
+        files.extend(os.path.join(root, name) for name in names if name.endswith(".parquet"))
+    return files
+
+def _sql_path(path):
+    return path.replace("'", "''")
+
+def refresh_time_tracking_view(conn):
+    hot = """
+        SELECT id, student_id, course_id, start_time, end_time, duration, created_at,
+               year(start_time) AS year, month(start_time) AS month
+        FROM time_tracking
+    """
+    archive_dir = time_tracking_archive_dir()
+    if _archive_files(archive_dir):
+        cold = f"""
+            SELECT id, student_id, course_id, start_time, end_time, duration, created_at,
+                   CAST(year AS BIGINT) AS year, CAST(month AS BIGINT) AS month
+            FROM read_parquet('{_sql_path(archive_dir)}/year=*/month=*/*.parquet', hive_partitioning = true)
+        """
+        conn.execute(f"CREATE OR REPLACE VIEW time_tracking_all AS {hot} UNION ALL {cold}")
     else:
-        expire = datetime.utcnow() + timedelta(minutes=15)
-    to_encode.update({"exp": expire})
-    encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
-    return encoded_jwt
+        # read_parquet fails on an empty glob, so the view is hot-only until the first archive
+        conn.execute(f"CREATE OR REPLACE VIEW time_tracking_all AS {hot}")
+
+def _publish_archive_batch(archive_dir, staging_dir):
+    for root, _, names in os.walk(staging_dir):
+        relative = os.path.relpath(root, staging_dir)
+        for name in names:
+            target_dir = os.path.join(archive_dir, relative)
+            os.makedirs(target_dir, exist_ok=True)
+            os.replace(os.path.join(root, name), os.path.join(target_dir, name))
+    shutil.rmtree(staging_dir, ignore_errors=True)
+
+def recover_time_tracking_archive(conn):
+    # A staged batch is published only if its DELETE committed (recorded in
+    # time_tracking_archive_batches); otherwise the rows are still hot and it is dropped
+    archive_dir = time_tracking_archive_dir()
+    staging_root = os.path.join(archive_dir, "_staging")
+    if os.path.isdir(staging_root):
+        committed = {row[0] for row in conn.execute("SELECT batch_id FROM time_tracking_archive_batches").fetchall()}
+        for batch_id in os.listdir(staging_root):
+            staging_dir = os.path.join(staging_root, batch_id)
+            if batch_id in committed:
+                _publish_archive_batch(archive_dir, staging_dir)
+            else:
+                shutil.rmtree(staging_dir, ignore_errors=True)
+    refresh_time_tracking_view(conn)
+
+def archive_time_tracking():
+    conn = get_db()
+    today = datetime.utcnow()
+    month_index = today.year * 12 + today.month - 1 - (TIME_TRACKING_HOT_MONTHS - 1)
+    cutoff = datetime(month_index // 12, month_index % 12 + 1, 1)
+    row_count = conn.execute("SELECT COUNT(*) FROM time_tracking WHERE start_time < ?", (cutoff,)).fetchone()[0]
+    if not row_count:
+        return None
+
+    start = time.perf_counter()
+    archive_dir = time_tracking_archive_dir()
+    batch_id = today.strftime("%Y%m%d%H%M%S") + "_" + secrets.token_hex(4)
+    staging_dir = os.path.join(archive_dir, "_staging", batch_id)
+    os.makedirs(os.path.dirname(staging_dir), exist_ok=True)
+    with _archive_lock:
+        _archive_batch(conn, archive_dir, staging_dir, batch_id, cutoff, row_count)
+    refresh_time_tracking_view(conn)
+    # The journal can replay the DELETE but not the new files, so back them up now
+    request_backup()
+    return f"archived {row_count} time entries before {cutoff:%Y-%m} in {time.perf_counter() - start:.2f}s"
+
+def _archive_batch(conn, archive_dir, staging_dir, batch_id, cutoff, row_count):
+    cutoff_sql = f"TIMESTAMP '{cutoff:%Y-%m-%d %H:%M:%S}'"
+    conn.execute("BEGIN TRANSACTION")
+    try:
+        # COPY, rollup and DELETE all see the same snapshot, so exactly the copied rows leave
+        conn.execute(f"""
+            COPY (
+                SELECT *, year(start_time) AS year, month(start_time) AS month
+                FROM time_tracking WHERE start_time < {cutoff_sql}
+            ) TO '{_sql_path(staging_dir)}'
+            (FORMAT PARQUET, PARTITION_BY (year, month), FILENAME_PATTERN 'batch_{batch_id}_{{i}}')
+        """)
+        conn.execute(f"""
+            INSERT INTO time_tracking_rollups (student_id, course_id, year, month, total_duration, sessions)
+            SELECT student_id, course_id, year(start_time), month(start_time),
+                   COALESCE(SUM(duration), 0), COUNT(*)
+            FROM time_tracking WHERE start_time < {cutoff_sql}
+            GROUP BY ALL
+            ON CONFLICT DO UPDATE SET
+                total_duration = total_duration + EXCLUDED.total_duration,
+                sessions = sessions + EXCLUDED.sessions
+        """)
+        record_changes(conn, "time_tracking_rollups", [row[0] for row in conn.execute(f"""
+            SELECT DISTINCT concat_ws(':', student_id, course_id, year(start_time), month(start_time))
+            FROM time_tracking WHERE start_time < {cutoff_sql}
+        """).fetchall()])
+        conn.execute(f"DELETE FROM time_tracking WHERE start_time < {cutoff_sql}")
+        conn.execute("""
+            INSERT INTO time_tracking_archive_batches (batch_id, cutoff, row_count) VALUES (?, ?, ?)
+        """, (batch_id, cutoff, row_count))
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        raise
+    _publish_archive_batch(archive_dir, staging_dir)
+
+def purge_student_from_archive(student_id):
+    """Rewrites only the archive files that hold rows for this student.
+
+    Every rewrite is staged first and the set is swapped in only once all of them
+    succeeded, under _archive_lock so a backup never sees part of it. A failure
+    leaves the archive as it was, and the purge job retries."""
+    conn = get_db()
+    archive_dir = time_tracking_archive_dir()
+    if not _archive_files(archive_dir):
+        return 0
+    files = conn.execute(f"""
+        SELECT DISTINCT filename
+        FROM read_parquet('{_sql_path(archive_dir)}/year=*/month=*/*.parquet', hive_partitioning = true, filename = true)
+        WHERE student_id = ?
+    """, (student_id,)).fetchall()
+    staged = []
+    try:
+        for (path,) in files:
+            rewritten = path + ".rewrite"
+            staged.append((rewritten, path))
+            conn.execute(f"""
+                COPY (SELECT * FROM read_parquet('{_sql_path(path)}', hive_partitioning = false) WHERE student_id != {int(student_id)})
+                TO '{_sql_path(rewritten)}' (FORMAT PARQUET)
+            """)
+    except Exception:
+        for rewritten, _ in staged:
+            if os.path.exists(rewritten):
+                os.remove(rewritten)
+        raise
+    with _archive_lock:
+        for rewritten, path in staged:
+            os.replace(rewritten, path)
+    if files:
+        request_backup()
+    return len(files)
+
+# Student purge. Removing a student takes effect at once: one small transaction marks
+# the user deleted (hidden from every listing and token check, password unusable) and
+# drops their course assignments and refresh sessions. Their practice history (time
+# entries, rollups, offline receipts, archived months) can be years of rows, so a purge
+# job deletes it afterwards in PURGE_BATCH_ROWS batches, one transaction each, pausing
+# between batches so other requests get the database, and deletes the user row last
+# (time_tracking references it). Jobs retry with backoff and record progress; a cohort
+# label groups the jobs of a bulk removal.
+PURGE_BATCH_ROWS = int(os.getenv("PURGE_BATCH_ROWS", "5000"))
+PURGE_BATCH_PAUSE_SECONDS = float(os.getenv("PURGE_BATCH_PAUSE_SECONDS", "0.05"))
+PURGE_MAX_ATTEMPTS = int(os.getenv("PURGE_MAX_ATTEMPTS", "5"))
+PURGE_RETRY_SECONDS = int(os.getenv("PURGE_RETRY_SECONDS", "30"))
+PURGE_POLL_SECONDS = float(os.getenv("PURGE_POLL_SECONDS", "5"))
+
+purge_wakeup = None
+
+def purge_students(conn, student_ids, cohort=None):
+    """Hide the given students and queue their data for deletion. Admins and unknown
+    ids are skipped; returns [(student_id, purge job id)] for the students removed."""
+    placeholders = ", ".join("?" * len(student_ids))
+    conn.execute("BEGIN TRANSACTION")
+    try:
+        found = [row[0] for row in conn.execute(f"""
+            SELECT id FROM users
+            WHERE id IN ({placeholders}) AND is_admin = FALSE AND deleted_at IS NULL
+            ORDER BY id
+        """, student_ids).fetchall()]
+        if not found:
+            conn.execute("ROLLBACK")
+            return []
+        placeholders = ", ".join("?" * len(found))
+        # Tombstones for delta sync, collected before the rows go
+        course_keys = [f"{student_id}:{course_id}" for student_id, course_id in conn.execute(
+            f"SELECT student_id, course_id FROM student_courses WHERE student_id IN ({placeholders})", found
+        ).fetchall()]
+        conn.execute(f"DELETE FROM student_courses WHERE student_id IN ({placeholders})", found)
+        conn.execute(f"DELETE FROM refresh_sessions WHERE user_id IN ({placeholders})", found)
+        conn.execute(f"""
+            UPDATE users SET deleted_at = CURRENT_TIMESTAMP, password_hash = '!', email = NULL
+            WHERE id IN ({placeholders})
+        """, found)
+        jobs = list(zip(found, next_ids(conn, "purge_jobs_id", len(found))))
+        conn.execute(f"""
+            INSERT INTO purge_jobs (id, student_id, cohort) VALUES {", ".join(["(?, ?, ?)"] * len(jobs))}
+        """, [value for student_id, job_id in jobs for value in (job_id, student_id, cohort)])
+        record_changes(conn, "student_courses", course_keys, op="delete")
+        record_changes(conn, "time_tracking", found, op="delete")
+        record_changes(conn, "users", found, op="delete")
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    for student_id in found:
+        course_catalog.remove_student(student_id)
+        event_bus.publish("student_removed", {"id": student_id})
+    if purge_wakeup is not None:
+        purge_wakeup.set()
+    return jobs
+
+def _claim_purge_job():
+    conn = get_db()
+    job = conn.execute("""
+        SELECT id, student_id, attempts FROM purge_jobs
+        WHERE status = 'pending' AND next_attempt_at <= CURRENT_TIMESTAMP
+        ORDER BY id
+        LIMIT 1
+    """).fetchone()
+    if job:
+        job_id, student_id, _ = job
+        rows_total = conn.execute("""
+            SELECT (SELECT COUNT(*) FROM time_tracking WHERE student_id = ?)
+                 + (SELECT COUNT(*) FROM time_tracking_rollups WHERE student_id = ?)
+                 + (SELECT COUNT(*) FROM time_entry_receipts WHERE student_id = ?)
+        """, (student_id, student_id, student_id)).fetchone()[0]
+        conn.execute("""
+            UPDATE purge_jobs SET status = 'running', rows_total = rows_deleted + ? WHERE id = ?
+        """, (rows_total, job_id))
+    return job
+
+def _purge_batches(conn, job_id, table, student_id, tombstones=()):
+    # Tombstones for delta sync go in with the first batch
+    while True:
+        conn.execute("BEGIN TRANSACTION")
+        try:
+            deleted = conn.execute(f"""
+                DELETE FROM {table} WHERE rowid IN (
+                    SELECT rowid FROM {table} WHERE student_id = ? LIMIT ?
+                )
+            """, (student_id, PURGE_BATCH_ROWS)).fetchone()[0]
+            conn.execute("UPDATE purge_jobs SET rows_deleted = rows_deleted + ? WHERE id = ?", (deleted, job_id))
+            record_changes(conn, table, tombstones, op="delete")
+            tombstones = ()
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        if deleted < PURGE_BATCH_ROWS:
+            return
+        time.sleep(PURGE_BATCH_PAUSE_SECONDS)
+
+def _run_purge_job(job_id, student_id):
+    conn = get_db()
+    _purge_batches(conn, job_id, "time_tracking", student_id)
+    rollup_keys = [":".join(str(part) for part in row) for row in conn.execute(
+        "SELECT student_id, course_id, year, month FROM time_tracking_rollups WHERE student_id = ?", (student_id,)
+    ).fetchall()]
+    _purge_batches(conn, job_id, "time_tracking_rollups", student_id, tombstones=rollup_keys)
+    _purge_batches(conn, job_id, "time_entry_receipts", student_id)
+    purge_student_from_archive(student_id)
+    conn.execute("DELETE FROM users WHERE id = ? AND deleted_at IS NOT NULL", (student_id,))
+    conn.execute("""
+        UPDATE purge_jobs SET status = 'done', last_error = NULL, finished_at = CURRENT_TIMESTAMP WHERE id = ?
+    """, (job_id,))
+
+def _fail_purge_job(job_id, attempts, error):
+    status = "failed" if attempts >= PURGE_MAX_ATTEMPTS else "pending"
+    delay = PURGE_RETRY_SECONDS * 2 ** (attempts - 1)
+    get_db().execute("""
+        UPDATE purge_jobs
+        SET status = ?, attempts = ?, last_error = ?,
+            next_attempt_at = CURRENT_TIMESTAMP + to_seconds(?)
+        WHERE id = ?
+    """, (status, attempts, str(error)[:1000], delay, job_id))
+
+async def run_purge_worker():
+    global purge_wakeup
+    purge_wakeup = asyncio.Event()
+    try:
+        # Jobs interrupted by a restart go back to the queue
+        await run_in_threadpool(get_db().execute,
+                                "UPDATE purge_jobs SET status = 'pending' WHERE status = 'running'")
+        while True:
+            job = await run_in_threadpool(_claim_purge_job)
+            if job is None:
+                purge_wakeup.clear()
+                try:
+                    await asyncio.wait_for(purge_wakeup.wait(), PURGE_POLL_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            job_id, student_id, attempts = job
+            try:
+                await run_in_threadpool(_run_purge_job, job_id, student_id)
+            except Exception as e:
+                print(f"Purge job {job_id} for student {student_id} failed: {e}")
+                await run_in_threadpool(_fail_purge_job, job_id, attempts + 1, e)
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        print(f"Purge worker stopped: {e}")
+
+def purge_progress(conn, cohort=None, limit=100):
+    sql = """
+        SELECT id, student_id, cohort, status, rows_total, rows_deleted, attempts, last_error,
+               created_at, finished_at
+        FROM purge_jobs
+    """
+    params = []
+    if cohort is not None:
+        sql += " WHERE cohort = ?"
+        params.append(cohort)
+    rows = conn.execute(sql + " ORDER BY id DESC LIMIT ?", [*params, limit]).fetchall()
+    columns = ["id", "student_id", "cohort", "status", "rows_total", "rows_deleted", "attempts",
+               "last_error", "created_at", "finished_at"]
+    totals = conn.execute(f"""
+        SELECT status, COUNT(*), COALESCE(SUM(rows_total), 0), COALESCE(SUM(rows_deleted), 0)
+        FROM purge_jobs {"WHERE cohort = ?" if cohort is not None else ""}
+        GROUP BY status
+    """, params).fetchall()
+    return {
+        "jobs": [dict(zip(columns, row)) for row in rows],
+        "by_status": {status: count for status, count, _, _ in totals},
+        "rows_total": sum(row[2] for row in totals),
+        "rows_deleted": sum(row[3] for row in totals),
+    }
+
+# Compaction. DuckDB reuses freed blocks but never shrinks the file, and deleted rows
+# (removed students, replaced course assignments, superseded uploads) keep their space
+# until their row group is rewritten, so the database only grows. The daily job
+# estimates the dead space (free blocks, plus the share of deleted rows per table) and,
+# past COMPACTION_MIN_DEAD_RATIO and COMPACTION_MIN_MB, copies the live data into a
+# fresh file next to it. Writes wait during the copy (reads go on); then all
+# statements wait for the moment the file is swapped in and reopened.
+COMPACTION_INTERVAL_HOURS = float(os.getenv("COMPACTION_INTERVAL_HOURS", "24"))
+COMPACTION_MIN_DEAD_RATIO = float(os.getenv("COMPACTION_MIN_DEAD_RATIO", "0.25"))
+COMPACTION_MIN_BYTES = int(float(os.getenv("COMPACTION_MIN_MB", "16")) * 1024 * 1024)
+COMPACTION_DRAIN_SECONDS = float(os.getenv("COMPACTION_DRAIN_SECONDS", "10"))
+
+compaction_history = deque(maxlen=20)
+_compaction_lock = threading.Lock()
+
+def measure_dead_space(conn):
+    block_size, used_blocks, free_blocks = conn.execute("""
+        SELECT block_size, used_blocks, free_blocks FROM pragma_database_size()
+        WHERE database_name = current_database()
+    """).fetchone()
+    tables = {}
+    for table, stored_rows in conn.execute("""
+        SELECT table_name, estimated_size FROM duckdb_tables()
+        WHERE database_name = current_database() AND schema_name = 'main' AND NOT internal
+    """).fetchall():
+        live_rows = conn.execute(f'SELECT COUNT(*) FROM "{table}"').fetchone()[0]
+        tables[table] = {"live_rows": live_rows, "deleted_rows": max(stored_rows - live_rows, 0)}
+    stored = sum(t["live_rows"] + t["deleted_rows"] for t in tables.values())
+    dead_row_ratio = sum(t["deleted_rows"] for t in tables.values()) / stored if stored else 0.0
+    used_bytes = used_blocks * block_size
+    reclaimable = free_blocks * block_size + int(used_bytes * dead_row_ratio)
+    file_bytes = sum(os.path.getsize(path) for path in (database_path, database_path + ".wal")
+                     if os.path.exists(path))
+    return {
+        "file_bytes": file_bytes,
+        "used_bytes": used_bytes,
+        "free_bytes": free_blocks * block_size,
+        "dead_row_ratio": round(dead_row_ratio, 4),
+        "reclaimable_bytes": reclaimable,
+        "dead_ratio": round(reclaimable / max(used_bytes + free_blocks * block_size, 1), 4),
+        "tables": tables,
+    }
+
+def _schema_objects(cursor):
+    """The main schema of the cursor's database, with tables in foreign-key order
+    (referenced tables first). Shared by compaction and backups."""
+    source = cursor.execute("SELECT current_database()").fetchone()[0]
+    scope = f"database_name = '{source}' AND schema_name = 'main'"
+    sequences = cursor.execute(f"""
+        SELECT sequence_name, COALESCE(last_value, start_value - increment_by), increment_by
+        FROM duckdb_sequences() WHERE {scope}
+    """).fetchall()
+    tables = dict(cursor.execute(f"SELECT table_name, sql FROM duckdb_tables() WHERE {scope} AND NOT internal").fetchall())
+    references = {}
+    primary_keys = {}
+    for table, constraint_type, columns, referenced in cursor.execute(f"""
+        SELECT table_name, constraint_type, constraint_column_names, referenced_table FROM duckdb_constraints()
+        WHERE {scope} AND constraint_type IN ('FOREIGN KEY', 'PRIMARY KEY')
+    """).fetchall():
+        if constraint_type == "FOREIGN KEY":
+            references.setdefault(table, set()).add(referenced)
+        else:
+            primary_keys[table] = list(columns)
+    column_types = {}
+    for table, column, data_type in cursor.execute(f"""
+        SELECT table_name, column_name, data_type FROM duckdb_columns() WHERE {scope} ORDER BY column_index
+    """).fetchall():
+        column_types.setdefault(table, {})[column] = data_type
+    indexes = [sql for (sql,) in cursor.execute(f"SELECT sql FROM duckdb_indexes() WHERE {scope} AND sql IS NOT NULL").fetchall()]
+    views = [sql for (sql,) in cursor.execute(f"SELECT sql FROM duckdb_views() WHERE {scope} AND NOT internal").fetchall()]
+    
+    order = []
+    def visit(table):
+        if table not in order:
+            for referenced in sorted(references.get(table, ())):
+                if referenced != table:
+                    visit(referenced)
+            order.append(table)
+    for table in sorted(tables):
+        visit(table)
+    return {
+        "source": source,
+        "sequences": [list(sequence) for sequence in sequences],
+        "tables": tables,
+        "order": order,
+        "primary_keys": primary_keys,
+        "column_types": column_types,
+        "indexes": indexes,
+        "views": views,
+    }
+
+def _copy_live_data(cursor, target):
+    # COPY FROM DATABASE copies tables in name order, which trips the foreign keys, so
+    # the schema is recreated here with referenced tables first
+    schema = _schema_objects(cursor)
+    source = schema["source"]
+    cursor.execute(f"ATTACH '{_sql_path(target)}' AS compact_target")
+    try:
+        cursor.execute("USE compact_target")
+        for name, last_value, increment in schema["sequences"]:
+            # Continue after the last value handed out, never repeat one
+            start = (last_value if last_value is not None else 0) + increment
+            cursor.execute(f"CREATE SEQUENCE {name} INCREMENT BY {increment} START {start}")
+        for table in schema["order"]:
+            cursor.execute(schema["tables"][table])
+            cursor.execute(f'INSERT INTO compact_target.main."{table}" SELECT * FROM "{source}".main."{table}"')
+        for sql in schema["indexes"] + schema["views"]:
+            cursor.execute(sql)
+    finally:
+        cursor.execute(f"USE \"{source}\"")
+        cursor.execute("DETACH compact_target")
+
+def compact_database(force=False):
+    """Copy-and-swap compaction; returns a report, or None when there is too little
+    dead space (unless forced) or no database file."""
+    conn = get_db()
+    if isinstance(conn._conn, RemoteDatabase):
+        return conn._conn.compact(force)
+    if database_path in (None, ":memory:"):
+        return None
+    if not _compaction_lock.acquire(blocking=False):
+        raise RuntimeError("Compaction already running")
+    try:
+        before = measure_dead_space(conn)
+        if not force and (before["dead_ratio"] < COMPACTION_MIN_DEAD_RATIO
+                          or before["reclaimable_bytes"] < COMPACTION_MIN_BYTES):
+            return None
+        
+        target = database_path + ".compact"
+        for leftover in (target, target + ".wal"):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+        started = time.perf_counter()
+        if not conn.gate.pause("writes", COMPACTION_DRAIN_SECONDS):
+            raise RuntimeError(f"Writes still running after {COMPACTION_DRAIN_SECONDS:g}s; compaction skipped")
+        paused = time.perf_counter()
+        try:
+            cursor = conn.cursor()
+            try:
+                _copy_live_data(cursor, target)
+            except Exception:
+                if os.path.exists(target):
+                    os.remove(target)
+                raise
+            copied = time.perf_counter()
+            if not conn.gate.pause("all", COMPACTION_DRAIN_SECONDS):
+                os.remove(target)
+                raise RuntimeError(f"Reads or downloads still running after {COMPACTION_DRAIN_SECONDS:g}s; "
+                                   "compaction skipped")
+            conn.swap_database(database_path, target)
+        finally:
+            conn.gate.resume()
+        resumed = time.perf_counter()
+        
+        after = measure_dead_space(conn)
+        report = {
+            "compacted_at": datetime.utcnow().isoformat(),
+            "before_bytes": before["file_bytes"],
+            "after_bytes": after["file_bytes"],
+            "reclaimed_bytes": before["file_bytes"] - after["file_bytes"],
+            "estimated_reclaimable_bytes": before["reclaimable_bytes"],
+            "write_pause_ms": round((resumed - paused) * 1000, 1),
+            "full_pause_ms": round((resumed - copied) * 1000, 1),
+            "drain_ms": round((paused - started) * 1000, 1),
+        }
+        compaction_history.append(report)
+        return report
+    finally:
+        _compaction_lock.release()
+
+def scheduled_compaction():
+    report = compact_database()
+    if report is None:
+        return None
+    return (f"{report['before_bytes'] / 1048576:.1f} MB -> {report['after_bytes'] / 1048576:.1f} MB, "
+            f"writes paused {report['write_pause_ms']:.0f} ms")
+
+# Backups. take_backup() copies the database as of one instant: writes pause only
+# while a read transaction is opened on it (and the journal moves to a new segment),
+# then every table is exported from that transaction as Parquet partitions (id ranges
+# of BACKUP_PARTITION_ROWS, BACKUP_BLOB_PARTITION_ROWS for tables holding files) to
+# BACKUP_DIR or an S3-compatible bucket. A partition whose row count and row-hash
+# checksum match the previous backup is not exported again, only referenced by the new
+# manifest, so a backup ships the partitions that changed. Archived time tracking
+# files are shipped by content hash. Between backups every committed write is appended
+# to the write journal (the statements and their parameters, per transaction) and
+# shipped every BACKUP_JOURNAL_SHIP_SECONDS, so `backup.py restore --until` can load
+# the last backup before a point in time and replay the journal up to it.
+BACKUP_DIR = os.getenv("BACKUP_DIR")
+BACKUP_S3_BUCKET = os.getenv("BACKUP_S3_BUCKET")
+BACKUP_S3_PREFIX = os.getenv("BACKUP_S3_PREFIX", "sloka")
+BACKUP_S3_ENDPOINT = os.getenv("BACKUP_S3_ENDPOINT")  # for MinIO, R2 and other S3-compatible stores
+BACKUP_INTERVAL_HOURS = float(os.getenv("BACKUP_INTERVAL_HOURS", "6"))
+BACKUP_KEEP = int(os.getenv("BACKUP_KEEP", "14"))
+BACKUP_PARTITION_ROWS = int(os.getenv("BACKUP_PARTITION_ROWS", "50000"))
+BACKUP_BLOB_PARTITION_ROWS = int(os.getenv("BACKUP_BLOB_PARTITION_ROWS", "32"))
+BACKUP_UPLOAD_WORKERS = int(os.getenv("BACKUP_UPLOAD_WORKERS", "4"))
+BACKUP_DRAIN_SECONDS = float(os.getenv("BACKUP_DRAIN_SECONDS", "10"))
+BACKUP_JOURNAL_SHIP_SECONDS = float(os.getenv("BACKUP_JOURNAL_SHIP_SECONDS", "60"))
+BACKUP_JOURNAL_FSYNC = os.getenv("BACKUP_JOURNAL_FSYNC", "false").lower() == "true"
+# How often the journal records checksums of the tables written, for replay to verify
+BACKUP_JOURNAL_CHECK_SECONDS = float(os.getenv("BACKUP_JOURNAL_CHECK_SECONDS", "900"))
+# Restore the latest backup when the database file is missing at startup
+BACKUP_RESTORE_ON_START = os.getenv("BACKUP_RESTORE_ON_START", "false").lower() == "true"
+
+# Journaled statements; the archive view is rebuilt at startup for the archive
+# directory in use, and analytics copies go to their own file
+JOURNAL_KEYWORDS = ("INSERT", "UPDATE", "DELETE", "CREATE", "DROP", "ALTER")
+_JOURNAL_SKIP = re.compile(r"^\s*CREATE\s+OR\s+REPLACE\s+VIEW|\banalytics_staging\.", re.IGNORECASE)
+# Replay pins the clock: statements and CURRENT_TIMESTAMP column defaults read the
+# journaled transaction's clock from this variable instead
+JOURNAL_CLOCK = re.compile(r"\bCURRENT_TIMESTAMP\b|\b(?:now|get_current_timestamp|transaction_timestamp)\(\)", re.IGNORECASE)
+PINNED_CLOCK = "getvariable('journal_clock')"
+_INTEGER_TYPES = ("TINYINT", "SMALLINT", "INTEGER", "BIGINT", "HUGEINT", "UTINYINT", "USMALLINT", "UINTEGER", "UBIGINT")
+
+class LocalBackupStore:
+    """Backup objects as files under a directory (another disk, a mounted volume)."""
+
+    def __init__(self, root):
+        self.root = root
+        self.location = os.path.abspath(root)
+
+    def _path(self, key):
+        return os.path.join(self.root, *key.split("/"))
+
+    def put_file(self, key, path):
+        target = self._path(key)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        shutil.copyfile(path, target + ".tmp")
+        os.replace(target + ".tmp", target)
+
+    def put_bytes(self, key, data):
+        target = self._path(key)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with open(target + ".tmp", "wb") as f:
+            f.write(data)
+        os.replace(target + ".tmp", target)
+
+    def get_file(self, key, path):
+        shutil.copyfile(self._path(key), path)
+
+    def get_bytes(self, key):
+        with open(self._path(key), "rb") as f:
+            return f.read()
+
+    def list(self, prefix):
+        keys = []
+        for root, _, names in os.walk(self._path(prefix.rstrip("/"))):
+            relative = os.path.relpath(root, self.root).replace(os.sep, "/")
+            keys.extend(f"{relative}/{name}" for name in names if not name.endswith(".tmp"))
+        return sorted(keys)
+
+    def delete(self, keys):
+        for key in keys:
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+
+class S3BackupStore:
+    """Backup objects in an S3 (or S3-compatible) bucket under BACKUP_S3_PREFIX."""
+
+    def __init__(self, bucket, prefix, endpoint_url=None):
+        if boto3 is None:
+            raise RuntimeError("BACKUP_S3_BUCKET is set but boto3 is not installed")
+        self.bucket = bucket
+        self.prefix = prefix.strip("/")
+        self.location = f"s3://{bucket}/{self.prefix}"
+        self._client = boto3.client("s3", endpoint_url=endpoint_url)
+
+    def _key(self, key):
+        return f"{self.prefix}/{key}" if self.prefix else key
+
+    def put_file(self, key, path):
+        self._client.upload_file(path, self.bucket, self._key(key))
+
+    def put_bytes(self, key, data):
+        self._client.put_object(Bucket=self.bucket, Key=self._key(key), Body=data)
+
+    def get_file(self, key, path):
+        self._client.download_file(self.bucket, self._key(key), path)
+
+    def get_bytes(self, key):
+        return self._client.get_object(Bucket=self.bucket, Key=self._key(key))["Body"].read()
+
+    def list(self, prefix):
+        keys = []
+        skip = len(self.prefix) + 1 if self.prefix else 0
+        for page in self._client.get_paginator("list_objects_v2").paginate(Bucket=self.bucket, Prefix=self._key(prefix)):
+            keys.extend(item["Key"][skip:] for item in page.get("Contents", ()))
+        return sorted(keys)
+
+    def delete(self, keys):
+        keys = list(keys)
+        for i in range(0, len(keys), 1000):
+            self._client.delete_objects(Bucket=self.bucket, Delete={
+                "Objects": [{"Key": self._key(key)} for key in keys[i:i + 1000]], "Quiet": True
+            })
+
+_backup_store = None
+
+def backup_store():
+    """The configured backup target, or None when backups are off."""
+    global _backup_store
+    if _backup_store is None:
+        if BACKUP_DIR:
+            _backup_store = LocalBackupStore(BACKUP_DIR)
+        elif BACKUP_S3_BUCKET:
+            _backup_store = S3BackupStore(BACKUP_S3_BUCKET, BACKUP_S3_PREFIX, BACKUP_S3_ENDPOINT)
+    return _backup_store
+
+def backup_journal_dir(db_path=None):
+    configured = os.getenv("BACKUP_JOURNAL_DIR")
+    if configured:
+        return configured
+    db_path = db_path or database_path
+    if db_path == ":memory:":
+        return os.path.join(tempfile.gettempdir(), "sloka-journal")
+    return os.path.abspath(db_path) + ".journal"
+
+class WriteJournal:
+    """Committed writes since the last backup, as length-prefixed JSON frames of
+    (committed_at, [(sql, params), ...], stamp) in segment files named after the backup
+    they follow (see _journal_json for the parameter types JSON lacks). Statements of a transaction are held per caller until its COMMIT and
+    dropped on ROLLBACK; segments are shipped to the store in byte ranges.
+
+    The stamp holds what a statement can't carry in its parameters: the transaction's
+    clock, which CURRENT_TIMESTAMP and column defaults read, and the sequence positions.
+    Ids are bound as parameters (see next_ids). Every BACKUP_JOURNAL_CHECK_SECONDS a
+    ("check", checked_at, offset, {table: (rows, checksum)}) frame records the tables
+    written since the last one as of journal offset `offset`, for replay to verify."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.segment = None
+        self.offset = 0
+        self._file = None
+        self._shipped = {}
+        self._written = set()
+        self._clock_tables = None
+        self._checked_at = time.monotonic()
+        os.makedirs(directory, exist_ok=True)
+        segments = self.segments()
+        if segments:
+            # Resume after the last complete entry; a torn one from a crash is cut off
+            self.segment = segments[-1]
+            path = self._path(self.segment)
+            with open(path, "rb") as f:
+                valid = _journal_frames_end(f)
+                f.seek(_FRAME_HEADER.size)
+                if valid and f.read(1) != b"[":
+                    # Pickled frames from an older version aren't continued or read back
+                    print("Write journal is in an old format, taking a new backup")
+                    self.segment = None
+                    request_backup()
+                    return
+            self._file = open(path, "r+b")
+            self._file.truncate(valid)
+            self._file.seek(valid)
+            self.offset = valid
+
+    def _path(self, segment):
+        return os.path.join(self.directory, segment + ".journal")
+
+    def segments(self):
+        return sorted(name[:-len(".journal")] for name in os.listdir(self.directory) if name.endswith(".journal"))
+
+    def applies(self, sql):
+        return sql.lstrip()[:6].upper().startswith(JOURNAL_KEYWORDS) and not _JOURNAL_SKIP.search(sql)
+
+    def commits(self, sql, in_transaction):
+        """Whether running sql commits journaled writes (so must hold the lock)."""
+        if in_transaction:
+            return _ends_transaction(sql)
+        return self.applies(sql)
+
+    def execute(self, cursor, sql, params, in_transaction, pending):
+        """Runs sql on cursor, stamping journaled commits; returns (result, stamp).
+        An autocommit write is stamped just before it runs, outside any transaction,
+        unless it reads the clock: that one runs in a transaction of its own on a
+        separate cursor, its rows fetched before the COMMIT, so the stamp has its clock."""
+        run = lambda target: target.execute(sql, params) if params is not None else target.execute(sql)
+        if in_transaction:
+            committing = pending and sql.lstrip()[:6].upper().startswith(("COMMIT", "END"))
+            stamp = _journal_stamp(cursor) if committing else None
+            return run(cursor), stamp
+        if not self.applies(sql):
+            return run(cursor), None
+        if not self._reads_clock(cursor, sql):
+            # Replay takes only the sequence positions from this stamp
+            stamp = _journal_stamp(cursor)
+            return run(cursor), stamp
+        own = cursor.cursor()
+        try:
+            own.execute("BEGIN TRANSACTION")
+            try:
+                stamp = _journal_stamp(own)
+                result = run(own)
+                description = result.description
+                result = FetchedResult(result.fetchall() if description else [], description)
+                own.execute("COMMIT")
+            except Exception:
+                own.execute("ROLLBACK")
+                raise
+        finally:
+            own.close()
+        return result, stamp
+
+    def _reads_clock(self, cursor, sql):
+        # In its text, or through a CURRENT_TIMESTAMP default of the table it inserts into
+        if JOURNAL_CLOCK.search(sql):
+            return True
+        match = WRITE_TARGET.match(sql)
+        if match is None or not sql.lstrip()[:6].upper().startswith("INSERT"):
+            return False
+        if self._clock_tables is None:
+            self._clock_tables = {table.lower() for table, default in cursor.execute("""
+                SELECT table_name, column_default FROM duckdb_columns()
+                WHERE schema_name = 'main' AND column_default IS NOT NULL
+            """).fetchall() if JOURNAL_CLOCK.search(default)}
+        return match.group(1).lower() in self._clock_tables
+
+    def record(self, pending, sql, params, in_transaction, succeeded, stamp=None):
+        """Called after every statement with the caller's pending transaction
+        statements and the stamp from execute; returns the new pending list."""
+        if succeeded and sql.lstrip()[:6].upper().startswith(("CREATE", "ALTER", "DROP")):
+            self._clock_tables = None
+        if not in_transaction:
+            if _starts_transaction(sql):
+                return [] if succeeded else None
+            if succeeded and self.applies(sql):
+                self._append([(sql, params)], stamp)
+            return None
+        if _ends_transaction(sql):
+            if succeeded and pending and sql.lstrip()[:6].upper().startswith(("COMMIT", "END")):
+                self._append(pending, stamp)
+            return None
+        # A failed statement aborts the transaction, so its COMMIT fails too
+        if succeeded and pending is not None and self.applies(sql):
+            pending.append((sql, params))
+        return pending
+
+    def _append(self, statements, stamp):
+        # Called with self.lock held
+        for sql, _ in statements:
+            match = WRITE_TARGET.match(sql)
+            if match:
+                self._written.add(match.group(1).lower())
+        self._write_frame((datetime.utcnow(), statements, stamp))
+
+    def _write_frame(self, frame):
+        if self._file is None:
+            return
+        try:
+            data = json.dumps(frame, default=_journal_json, separators=(",", ":")).encode("utf-8")
+            self._file.write(_FRAME_HEADER.pack(len(data)) + data)
+            self._file.flush()
+            if BACKUP_JOURNAL_FSYNC:
+                os.fsync(self._file.fileno())
+            self.offset += _FRAME_HEADER.size + len(data)
+        except (OSError, TypeError) as e:
+            # The write is committed but not journaled; restart from a new backup
+            print(f"Write journal failed, taking a new backup: {e}")
+            self._close()
+            self.segment = None
+            request_backup()
+
+    def _close(self):
+        if self._file is not None:
+            try:
+                self._file.close()
+            except OSError:
+                pass
+        self._file = None
+
+    def rotate(self, segment):
+        """Start the segment that follows backup `segment`. Call with writes paused."""
+        with self.lock:
+            self._close()
+            self.segment = segment
+            self._file = open(self._path(segment), "ab")
+            self.offset = 0
+            self._written = set()
+
+    def check_due(self):
+        return time.monotonic() - self._checked_at >= BACKUP_JOURNAL_CHECK_SECONDS
+
+    def check(self, conn):
+        """Append a check frame for the tables written since the last one; returns
+        how many were checked."""
+        self._checked_at = time.monotonic()
+        # A stream, so compaction doesn't swap the file under the read transaction
+        cursor = conn.stream_cursor()
+        try:
+            with self.lock:
+                tables, self._written = sorted(self._written), set()
+                if not tables or self._file is None:
+                    return 0
+                segment, offset = self.segment, self.offset
+                # No journaled commit is in flight while the lock is held, so the
+                # snapshot pinned here is the state as of offset
+                cursor.execute("BEGIN TRANSACTION")
+                cursor.execute(f'SELECT 1 FROM "{tables[0]}" LIMIT 1').fetchall()
+            checksums = {table: cursor.execute(
+                f'SELECT COUNT(*), COALESCE(sum(hash(t)), 0) FROM "{table}" AS t'
+            ).fetchone() for table in tables}
+            cursor.execute("ROLLBACK")
+        finally:
+            conn.close_cursor(cursor, stream=True)
+        with self.lock:
+            # After a rotation the new backup covers these writes
+            if self.segment == segment:
+                self._write_frame(("check", datetime.utcnow(), offset, checksums))
+        return len(checksums)
+
+    def ship(self, store):
+        """Upload the journal written since the last call; returns the bytes shipped."""
+        with self.lock:
+            current, end = self.segment, self.offset
+        shipped_bytes = 0
+        for segment in self.segments():
+            path = self._path(segment)
+            size = end if segment == current else os.path.getsize(path)
+            start = self._shipped.get(segment)
+            if start is None:
+                start = max((int(key.rsplit("/", 1)[1].split("-")[1].split(".")[0])
+                             for key in store.list(f"journal/{segment}/")), default=0)
+            if size > start:
+                with open(path, "rb") as f:
+                    f.seek(start)
+                    data = f.read(size - start)
+                store.put_bytes(f"journal/{segment}/{start:016d}-{size:016d}.part", data)
+                shipped_bytes += len(data)
+            self._shipped[segment] = max(size, start)
+            if segment != current:
+                os.remove(path)
+                self._shipped.pop(segment, None)
+        return shipped_bytes
+
+def _journal_frames_end(f):
+    # Offset just past the last complete frame
+    valid = 0
+    while True:
+        header = f.read(_FRAME_HEADER.size)
+        if len(header) < _FRAME_HEADER.size:
+            return valid
+        (length,) = _FRAME_HEADER.unpack(header)
+        f.seek(length, os.SEEK_CUR)
+        if f.tell() > os.fstat(f.fileno()).st_size:
+            return valid
+        valid = f.tell()
+
+def _journal_entries(data):
+    # (offset just past the frame, frame)
+    offset = 0
+    while offset + _FRAME_HEADER.size <= len(data):
+        (length,) = _FRAME_HEADER.unpack_from(data, offset)
+        end = offset + _FRAME_HEADER.size + length
+        if end > len(data):
+            return  # torn tail
+        yield end, json.loads(data[offset + _FRAME_HEADER.size:end], object_hook=_journal_object)
+        offset = end
+
+# Parameter types JSON has no form for, as {"$<tag>": encoded}. datetime comes before
+# date, its base class
+_JOURNAL_TYPES = {
+    "datetime": (datetime, datetime.isoformat, datetime.fromisoformat),
+    "date": (date, date.isoformat, date.fromisoformat),
+    "timedelta": (timedelta, lambda value: [value.days, value.seconds, value.microseconds],
+                  lambda parts: timedelta(*parts)),
+    "bytes": ((bytes, bytearray, memoryview), lambda value: base64.b64encode(value).decode("ascii"),
+              base64.b64decode),
+    "decimal": (Decimal, str, Decimal),
+}
+
+def _journal_json(value):
+    for tag, (types, encode, _) in _JOURNAL_TYPES.items():
+        if isinstance(value, types):
+            return {"$" + tag: encode(value)}
+    raise TypeError(f"Can't journal a {type(value).__name__} parameter")
+
+def _journal_object(obj):
+    if len(obj) == 1:
+        (key, encoded), = obj.items()
+        if key[:1] == "$" and key[1:] in _JOURNAL_TYPES:
+            return _JOURNAL_TYPES[key[1:]][2](encoded)
+    return obj
+
+def _journal_stamp(cursor):
+    # CURRENT_TIMESTAMP is the transaction's start, as its statements and defaults saw it
+    clock, sequences = cursor.execute("""
+        SELECT CAST(CURRENT_TIMESTAMP AS TIMESTAMP),
+               (SELECT map(list(sequence_name), list(last_value)) FROM duckdb_sequences()
+                WHERE schema_name = 'main' AND last_value IS NOT NULL)
+    """).fetchone()
+    return {"clock": clock, "sequences": dict(sequences or {})}
+
+class FetchedResult:
+    """Rows fetched ahead of time, for a statement whose cursor has moved on."""
+
+    def __init__(self, rows, description):
+        self._rows = rows
+        self._pos = 0
+        self.description = description
+
+    def fetchone(self):
+        if self._pos >= len(self._rows):
+            return None
+        row = self._rows[self._pos]
+        self._pos += 1
+        return row
+
+    def fetchall(self):
+        rows = self._rows[self._pos:]
+        self._pos = len(self._rows)
+        return rows
+
+backup_journal = None
+_backup_requested = threading.Event()
+_last_backup_at = None
+
+def configure_backup_journal():
+    global backup_journal
+    if backup_store() is not None and backup_journal is None:
+        backup_journal = WriteJournal(backup_journal_dir())
+
+def request_backup():
+    """Take a backup at the scheduler's next poll instead of waiting for the interval."""
+    _backup_requested.set()
+
+def list_backup_manifests(store):
+    return [key[len("manifests/"):-len(".json")] for key in store.list("manifests/") if key.endswith(".json")]
+
+def load_backup_manifest(store, backup_id):
+    return json.loads(store.get_bytes(f"manifests/{backup_id}.json"))
+
+def _partition_column(schema, table):
+    # The first integer primary-key column: ids grow, so new rows land in the last partitions
+    types = schema["column_types"].get(table, {})
+    for column in schema["primary_keys"].get(table, ()):
+        if types.get(column) in _INTEGER_TYPES:
+            return column
+    return None
+
+def _link_archive_files(archive_dir, snapshot_dir):
+    # Hard links keep the files as of this instant: archival publishes and purges
+    # rewrite archive files with os.replace, which leaves a linked inode alone
+    files = {}
+    for path in _archive_files(archive_dir):
+        relative = os.path.relpath(path, archive_dir).replace(os.sep, "/")
+        linked = os.path.join(snapshot_dir, relative)
+        os.makedirs(os.path.dirname(linked), exist_ok=True)
+        try:
+            os.link(path, linked)
+        except OSError:
+            shutil.copy2(path, linked)
+        files[relative] = linked
+    return files
+
+def _file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def take_backup():
+    """Ship an incremental backup; returns its summary, or None when no backup
+    target is configured."""
+    store = backup_store()
+    if store is None:
+        return None
+    conn = get_db()
+    if isinstance(conn._conn, RemoteDatabase):
+        return conn._conn.backup()
+    # A swap would close the snapshot cursor, so backups and compaction take turns
+    if not _compaction_lock.acquire(blocking=False):
+        raise RuntimeError("Compaction or another backup is running")
+    try:
+        return _take_backup(conn, store)
+    finally:
+        _compaction_lock.release()
+
+def _take_backup(conn, store):
+    global _last_backup_at
+    started = time.perf_counter()
+    manifests = list_backup_manifests(store)
+    previous = load_backup_manifest(store, manifests[-1]) if manifests else None
+    previous_partitions = {}
+    previous_archive = {}
+    if previous is not None:
+        for table, info in previous["tables"].items():
+            for part in info["partitions"].values():
+                previous_partitions[part["key"]] = part
+        previous_archive = previous["archive"]
+    
+    taken_at = datetime.utcnow()
+    backup_id = taken_at.strftime("%Y%m%dT%H%M%S%fZ")
+    archive_dir = time_tracking_archive_dir()
+    # Under _staging, which the archive view skips and startup recovery clears
+    archive_snapshot = os.path.join(archive_dir, "_staging", "backup-" + backup_id)
+    work_dir = tempfile.mkdtemp(prefix="sloka-backup-")
+    # Compaction must not swap the file under the export's read transaction
+    cursor = conn.stream_cursor()
+    uploads = ThreadPoolExecutor(BACKUP_UPLOAD_WORKERS)
+    try:
+        with _archive_lock:
+            drain_started = time.perf_counter()
+            if not conn.gate.pause("writes", BACKUP_DRAIN_SECONDS):
+                raise RuntimeError(f"Writes still running after {BACKUP_DRAIN_SECONDS:g}s; backup skipped")
+            paused = time.perf_counter()
+            try:
+                cursor.execute("BEGIN TRANSACTION")
+                schema = _schema_objects(cursor)
+                # Reading a table pins the transaction's snapshot before writes resume
+                cursor.execute(f'SELECT 1 FROM "{schema["order"][0]}" LIMIT 1').fetchall()
+                archive_files = _link_archive_files(archive_dir, archive_snapshot)
+                if backup_journal is not None:
+                    backup_journal.rotate(backup_id)
+            finally:
+                conn.gate.resume()
+            resumed = time.perf_counter()
+        
+        tables = {}
+        pending = []
+        uploaded_bytes = 0
+        for table in schema["order"]:
+            column = _partition_column(schema, table)
+            has_blobs = "BLOB" in schema["column_types"].get(table, {}).values()
+            size = BACKUP_BLOB_PARTITION_ROWS if has_blobs else BACKUP_PARTITION_ROWS
+            if column is None:
+                checksums = cursor.execute(f'SELECT \'all\', COUNT(*), sum(hash(t)) FROM "{table}" AS t').fetchall()
+            else:
+                checksums = cursor.execute(f'''
+                    SELECT COALESCE(CAST("{column}" // {size} AS VARCHAR), 'null'), COUNT(*), sum(hash(t))
+                    FROM "{table}" AS t GROUP BY 1
+                ''').fetchall()
+            partitions = {}
+            for part, rows, checksum in checksums:
+                if not rows:
+                    continue
+                digest = hashlib.sha256(f"{schema['tables'][table]}|{rows}|{checksum}".encode()).hexdigest()[:24]
+                key = f"tables/{table}/{part}-{digest}.parquet"
+                reused = previous_partitions.get(key)
+                if reused is not None:
+                    partitions[part] = dict(reused, reused=True)
+                    continue
+                if column is None:
+                    where = ""
+                elif part == "null":
+                    where = f'WHERE "{column}" IS NULL'
+                else:
+                    where = f'WHERE "{column}" // {size} = {part}'
+                path = os.path.join(work_dir, f"{table}-{part}.parquet")
+                cursor.execute(f'''
+                    COPY (SELECT * FROM "{table}" {where}) TO '{_sql_path(path)}' (FORMAT PARQUET, COMPRESSION ZSTD)
+                ''')
+                part_bytes = os.path.getsize(path)
+                uploaded_bytes += part_bytes
+                partitions[part] = {"key": key, "rows": rows, "checksum": str(checksum), "bytes": part_bytes, "reused": False}
+                pending.append(uploads.submit(_upload_and_remove, store, key, path))
+            tables[table] = {
+                "sql": schema["tables"][table],
+                "partition_column": column,
+                "partition_rows": size if column else None,
+                "rows": sum(part["rows"] for part in partitions.values()),
+                "checksum": str(sum(int(part["checksum"]) for part in partitions.values())),
+                "partitions": partitions,
+            }
+        cursor.execute("ROLLBACK")
+        
+        archive = {}
+        for relative, path in sorted(archive_files.items()):
+            stat = os.stat(path)
+            known = previous_archive.get(relative)
+            if known and known["bytes"] == stat.st_size and known["mtime_ns"] == stat.st_mtime_ns:
+                archive[relative] = known
+                continue
+            sha = _file_sha256(path)
+            key = f"archive/{sha}.parquet"
+            archive[relative] = {"key": key, "bytes": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+            if not any(entry["key"] == key for entry in previous_archive.values()):
+                uploaded_bytes += stat.st_size
+                pending.append(uploads.submit(store.put_file, key, path))
+        for future in pending:
+            future.result()
+        
+        partition_count = sum(len(info["partitions"]) for info in tables.values())
+        uploaded = sum(1 for info in tables.values() for part in info["partitions"].values() if not part["reused"])
+        manifest = {
+            "id": backup_id,
+            "taken_at": taken_at.isoformat(),
+            "previous": previous["id"] if previous else None,
+            "duckdb_version": duckdb.__version__,
+            "sequences": schema["sequences"],
+            "order": schema["order"],
+            "tables": tables,
+            "indexes": schema["indexes"],
+            "views": schema["views"],
+            "archive": archive,
+            "stats": {
+                "rows": sum(info["rows"] for info in tables.values()),
+                "partitions": partition_count,
+                "uploaded_partitions": uploaded,
+                "reused_partitions": partition_count - uploaded,
+                "archive_files": len(archive),
+                "uploaded_bytes": uploaded_bytes,
+                "total_bytes": sum(part["bytes"] for info in tables.values() for part in info["partitions"].values())
+                               + sum(entry["bytes"] for entry in archive.values()),
+                "write_pause_ms": round((resumed - paused) * 1000, 1),
+                "drain_ms": round((paused - drain_started) * 1000, 1),
+                "duration_ms": round((time.perf_counter() - started) * 1000, 1),
+            },
+        }
+        # The manifest goes last: a backup exists once everything it references does
+        store.put_bytes(f"manifests/{backup_id}.json", json.dumps(manifest).encode())
+    finally:
+        uploads.shutdown(wait=True)
+        conn.close_cursor(cursor, stream=True)
+        shutil.rmtree(work_dir, ignore_errors=True)
+        shutil.rmtree(archive_snapshot, ignore_errors=True)
+    
+    _backup_requested.clear()
+    _last_backup_at = taken_at
+    if backup_journal is not None:
+        backup_journal.ship(store)
+    _prune_backups(store)
+    return dict(manifest["stats"], id=backup_id, taken_at=manifest["taken_at"])
+
+def _upload_and_remove(store, key, path):
+    store.put_file(key, path)
+    os.remove(path)
+
+def _prune_backups(store):
+    # Keep the newest BACKUP_KEEP manifests and whatever they reference, plus the
+    # journal from the oldest kept backup on
+    manifests = list_backup_manifests(store)
+    expired, kept = manifests[:-BACKUP_KEEP], manifests[-BACKUP_KEEP:]
+    if not kept:
+        return
+    store.delete(f"manifests/{backup_id}.json" for backup_id in expired)
+    referenced = set()
+    for backup_id in kept:
+        manifest = load_backup_manifest(store, backup_id)
+        referenced.update(part["key"] for info in manifest["tables"].values() for part in info["partitions"].values())
+        referenced.update(entry["key"] for entry in manifest["archive"].values())
+    unreferenced = [key for key in store.list("tables/") + store.list("archive/") if key not in referenced]
+    stale_journal = [key for key in store.list("journal/") if key.split("/")[1] < kept[0]]
+    store.delete(unreferenced + stale_journal)
+
+def ship_backup_journal():
+    store = backup_store()
+    if store is None or backup_journal is None:
+        return None
+    checked = backup_journal.check(get_db()) if backup_journal.check_due() else 0
+    shipped = backup_journal.ship(store)
+    if not shipped:
+        return None
+    return f"shipped {shipped} journal bytes" + (f", checksums of {checked} tables" if checked else "")
+
+def backup_due():
+    if backup_journal is not None and backup_journal.segment is None:
+        return True  # no backup to replay the journal onto yet
+    if _backup_requested.is_set():
+        return True
+    global _last_backup_at
+    if _last_backup_at is None:
+        manifests = list_backup_manifests(backup_store())
+        if not manifests:
+            return True
+        _last_backup_at = datetime.fromisoformat(load_backup_manifest(backup_store(), manifests[-1])["taken_at"])
+    return (datetime.utcnow() - _last_backup_at).total_seconds() >= BACKUP_INTERVAL_HOURS * 3600
+
+async def run_backup_scheduler():
+    # Runs where the database file is open (the database service in multi-worker mode)
+    if backup_store() is None:
+        return
+    while True:
+        try:
+            if await run_in_threadpool(backup_due):
+                report = await run_in_threadpool(take_backup)
+                print(f"Backup {report['id']}: {report['uploaded_partitions']} of {report['partitions']} partitions "
+                      f"shipped ({report['uploaded_bytes'] / 1048576:.1f} MB), writes paused {report['write_pause_ms']:.0f} ms")
+            else:
+                result = await run_in_threadpool(ship_backup_journal)
+                if result:
+                    print(f"Backup journal: {result}")
+        except Exception as e:
+            print(f"Backup failed: {e}")
+        await asyncio.sleep(BACKUP_JOURNAL_SHIP_SECONDS)
+
+def _read_journal_segment(store, segment):
+    # Concatenates the shipped byte ranges while they are contiguous
+    parts = []
+    for key in store.list(f"journal/{segment}/"):
+        start, end = key.rsplit("/", 1)[1].split(".")[0].split("-")
+        parts.append((int(start), int(end), key))
+    data = bytearray()
+    for start, end, key in sorted(parts):
+        if end <= len(data):
+            continue
+        if start > len(data):
+            break  # a gap: nothing after it can be replayed in order
+        data.extend(store.get_bytes(key)[len(data) - start:])
+    return bytes(data)
+
+def _replay_journal(db, store, segments, until):
+    """Re-run the journaled transactions on the restored backup, each with the clock
+    it had, verifying the tables at every check frame. Returns (transactions replayed,
+    last commit time, error or None, check results)."""
+    replayed, replayed_to, checks = 0, None, []
+    sequences = {}
+    clock_defaults = [row for row in db.execute("""
+        SELECT table_name, column_name, column_default FROM duckdb_columns()
+        WHERE schema_name = 'main' AND column_default IS NOT NULL
+    """).fetchall() if JOURNAL_CLOCK.search(row[2])]
+    for table, column, default in clock_defaults:
+        db.execute(f'ALTER TABLE "{table}" ALTER COLUMN "{column}" SET DEFAULT {JOURNAL_CLOCK.sub(PINNED_CLOCK, default)}')
+    try:
+        for segment in segments:
+            entries = list(_journal_entries(_read_journal_segment(store, segment)))
+            # A check describes the state just after the frame ending at its offset
+            expected = {frame[2]: frame for _, frame in entries if frame[0] == "check"}
+            for end, frame in entries:
+                if frame[0] == "check":
+                    continue
+                committed_at, statements, stamp = frame if len(frame) == 3 else (*frame, None)
+                if until is not None and committed_at > until:
+                    return replayed, replayed_to, None, checks
+                try:
+                    db.execute("BEGIN TRANSACTION")
+                    # Entries from before stamps fall back to the commit time
+                    db.execute("SET VARIABLE journal_clock = ?", (stamp["clock"] if stamp else committed_at,))
+                    for sql, params in statements:
+                        sql = JOURNAL_CLOCK.sub(PINNED_CLOCK, sql)
+                        db.execute(sql, params) if params is not None else db.execute(sql)
+                    db.execute("COMMIT")
+                except duckdb.Error as e:
+                    db.execute("ROLLBACK")
+                    return (replayed, replayed_to,
+                            f"stopped at the transaction committed at {committed_at.isoformat()}: {e}", checks)
+                replayed += 1
+                replayed_to = committed_at
+                for name, value in (stamp["sequences"] if stamp else {}).items():
+                    sequences[name] = max(value, sequences.get(name, value))
+                if end in expected:
+                    _, checked_at, _, tables = expected[end]
+                    mismatched = [table for table, result in tables.items() if tuple(db.execute(
+                        f'SELECT COUNT(*), COALESCE(sum(hash(t)), 0) FROM "{table}" AS t'
+                    ).fetchone()) != tuple(result)]
+                    checks.append({"checked_at": checked_at.isoformat(), "tables": len(tables), "mismatched": mismatched})
+        return replayed, replayed_to, None, checks
+    finally:
+        for table, column, default in clock_defaults:
+            db.execute(f'ALTER TABLE "{table}" ALTER COLUMN "{column}" SET DEFAULT {default}')
+        # Ids taken by reads (SELECT nextval) aren't journaled, so move each sequence
+        # past the last position seen
+        for name, last_value, increment in db.execute("""
+            SELECT sequence_name, COALESCE(last_value, start_value - increment_by), increment_by
+            FROM duckdb_sequences() WHERE schema_name = 'main'
+        """).fetchall():
+            if sequences.get(name, last_value) > last_value:
+                db.execute(f"CREATE OR REPLACE SEQUENCE {name} INCREMENT BY {increment} START {sequences[name] + increment}")
+
+def restore_backup(target, until=None, backup_id=None, store=None, archive_dir=None,
+                   replay=True, verify=True, force=False):
+    """Rebuild a database file at target from a backup: the latest one taken at or
+    before `until` (a UTC datetime, default now) or the one named, then replay the
+    journal up to `until`. Returns a report with per-table verification and timings."""
+    store = store or backup_store()
+    if store is None:
+        raise RuntimeError("No backup target configured (set BACKUP_DIR or BACKUP_S3_BUCKET)")
+    if os.path.exists(target) and not force:
+        raise RuntimeError(f"{target} already exists")
+    manifests = list_backup_manifests(store)
+    if backup_id is None:
+        candidates = [m for m in manifests
+                      if until is None or datetime.fromisoformat(load_backup_manifest(store, m)["taken_at"]) <= until]
+        if not candidates:
+            raise RuntimeError("No backup taken before " + (until.isoformat() if until else "now"))
+        backup_id = candidates[-1]
+    manifest = load_backup_manifest(store, backup_id)
+    archive_dir = archive_dir or time_tracking_archive_dir(target)
+    
+    started = time.perf_counter()
+    work_dir = tempfile.mkdtemp(prefix="sloka-restore-")
+    building = target + ".restoring"
+    for leftover in (building, building + ".wal"):
+        if os.path.exists(leftover):
+            os.remove(leftover)
+    db = duckdb.connect(building)
+    report = {"backup_id": backup_id, "taken_at": manifest["taken_at"], "until": until.isoformat() if until else None}
+    try:
+        downloads = ThreadPoolExecutor(BACKUP_UPLOAD_WORKERS)
+        try:
+            # Downloads run ahead while earlier partitions load
+            fetched = {}
+            for table in manifest["order"]:
+                for part, info in manifest["tables"][table]["partitions"].items():
+                    path = os.path.join(work_dir, f"{table}-{part}.parquet")
+                    fetched[(table, part)] = (downloads.submit(store.get_file, info["key"], path), path)
+            for name, last_value, increment in manifest["sequences"]:
+                start = (last_value if last_value is not None else 0) + increment
+                db.execute(f"CREATE SEQUENCE {name} INCREMENT BY {increment} START {start}")
+            loaded_bytes = 0
+            for table in manifest["order"]:
+                db.execute(manifest["tables"][table]["sql"])
+                for part in manifest["tables"][table]["partitions"]:
+                    future, path = fetched[(table, part)]
+                    future.result()
+                    loaded_bytes += os.path.getsize(path)
+                    db.execute(f'INSERT INTO "{table}" SELECT * FROM read_parquet(\'{_sql_path(path)}\')')
+                    os.remove(path)
+        finally:
+            downloads.shutdown(wait=True, cancel_futures=True)
+        loaded = time.perf_counter()
+        report["loaded_bytes"] = loaded_bytes
+        report["load_ms"] = round((loaded - started) * 1000, 1)
+        
+        tables = {}
+        for table in manifest["order"]:
+            expected = manifest["tables"][table]
+            rows, checksum = db.execute(f'SELECT COUNT(*), COALESCE(sum(hash(t)), 0) FROM "{table}" AS t').fetchone()
+            tables[table] = {"rows": rows, "expected_rows": expected["rows"],
+                             "ok": rows == expected["rows"] and str(checksum) == expected["checksum"]}
+        mismatched = [table for table, result in tables.items() if not result["ok"]]
+        report["tables"] = tables
+        report["verified"] = not mismatched
+        if verify and mismatched:
+            raise RuntimeError(f"Restored data does not match backup {backup_id}: {', '.join(mismatched)}")
+        verified = time.perf_counter()
+        report["verify_ms"] = round((verified - loaded) * 1000, 1)
+        
+        for sql in manifest["indexes"]:
+            db.execute(sql)
+        for sql in manifest["views"]:
+            try:
+                db.execute(sql)
+            except duckdb.Error:
+                pass  # the archive view is rebuilt at startup
+        
+        os.makedirs(archive_dir, exist_ok=True)
+        for relative, entry in manifest["archive"].items():
+            path = os.path.join(archive_dir, *relative.split("/"))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            store.get_file(entry["key"], path)
+        report["archive_files"] = len(manifest["archive"])
+        indexed = time.perf_counter()
+        report["index_ms"] = round((indexed - verified) * 1000, 1)
+        
+        replayed = 0
+        if replay:
+            # The journal of this backup runs until the next one; a backup that failed
+            # after rotating leaves a segment without a manifest, which still belongs here
+            later = [m for m in manifests if m > backup_id]
+            segments = [segment for segment in sorted({key.split("/")[1] for key in store.list("journal/")})
+                        if segment >= backup_id and not (later and segment >= later[0])]
+            replayed, replayed_to, error, checks = _replay_journal(db, store, segments, until)
+            report["replayed_to"] = replayed_to.isoformat() if replayed_to else None
+            if error:
+                report["replay_error"] = error
+            report["replay_checks"] = checks
+            report["replay_verified"] = not any(check["mismatched"] for check in checks)
+            if verify and not report["replay_verified"]:
+                failed = next(check for check in checks if check["mismatched"])
+                raise RuntimeError(f"Replayed journal does not match the state checked at {failed['checked_at']}: "
+                                   f"{', '.join(failed['mismatched'])}")
+        report["replayed_transactions"] = replayed
+        report["replay_ms"] = round((time.perf_counter() - indexed) * 1000, 1)
+        db.execute("CHECKPOINT")
+    except Exception:
+        db.close()
+        for leftover in (building, building + ".wal"):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+        raise
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    db.close()
+    if os.path.exists(target + ".wal"):
+        os.remove(target + ".wal")
+    os.replace(building, target)
+    # The old file's journal doesn't continue the restored one; kept aside, not deleted
+    journal_dir = backup_journal_dir(target)
+    if os.path.isdir(journal_dir):
+        os.replace(journal_dir, f"{journal_dir}.before-restore-{datetime.utcnow():%Y%m%d%H%M%S}")
+    report["total_ms"] = round((time.perf_counter() - started) * 1000, 1)
+    return report
+
+# Analytics snapshot: heavy admin reports read a periodically refreshed, read-only
+# copy of the reporting tables so their scans never contend with student writes.
+# Each copy is written to its own file next to the database and published by
+# atomically swapping a symlink (DuckDB caches open databases by path, so a file
+# renamed over an open one would not be picked up). Every process, including
+# single-writer web workers, opens the current copy read-only and reopens it when
+# the link moves. Responses say how old the data is.
+ANALYTICS_SNAPSHOT_MINUTES = float(os.getenv("ANALYTICS_SNAPSHOT_MINUTES", "5"))
+ANALYTICS_MAX_STALENESS_SECONDS = int(os.getenv("ANALYTICS_MAX_STALENESS_SECONDS", "900"))
+ANALYTICS_TABLES = ["users", "courses", "student_courses", "time_tracking", "time_tracking_rollups"]
+
+def analytics_snapshot_path():
+    configured = os.getenv("ANALYTICS_SNAPSHOT_PATH")
+    if configured:
+        return configured
+    if database_path in (None, ":memory:"):
+        return None
+    return database_path + ".analytics"
+
+def take_analytics_snapshot():
+    path = analytics_snapshot_path()
+    if path is None:
+        return None
+    conn = get_db()
+    start = time.perf_counter()
+    taken_at = datetime.utcnow()
+    target = f"{path}.{taken_at:%Y%m%d%H%M%S%f}"
+    conn.execute(f"ATTACH '{_sql_path(target)}' AS analytics_staging")
+    try:
+        # One transaction, so every table is copied as of the same instant
+        conn.execute("BEGIN")
+        for table in ANALYTICS_TABLES:
+            conn.execute(f"CREATE TABLE analytics_staging.{table} AS SELECT * FROM {table}")
+        conn.execute("CREATE TABLE analytics_staging.snapshot_info AS SELECT CAST(? AS TIMESTAMP) AS taken_at",
+                     (taken_at,))
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        conn.execute("DETACH analytics_staging")
+        os.remove(target)
+        raise
+    conn.execute("DETACH analytics_staging")
+
+    link = path + ".link"
+    if os.path.lexists(link):
+        os.remove(link)
+    os.symlink(os.path.basename(target), link)
+    os.replace(link, path)
+    # Keep the previous copy for readers that opened it just before the swap
+    prefix = os.path.basename(path) + "."
+    directory = os.path.dirname(os.path.abspath(path))
+    copies = sorted(name for name in os.listdir(directory)
+                    if name.startswith(prefix) and name[len(prefix):].isdigit())
+    for name in copies[:-2]:
+        os.remove(os.path.join(directory, name))
+    return f"analytics snapshot refreshed in {time.perf_counter() - start:.2f}s"
+
+class AnalyticsSnapshot:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._key = None
+        self._conn = None
+        self._taken_at = None
+
+    def acquire(self, max_staleness):
+        path = analytics_snapshot_path()
+        if path is None:
+            return None
+        key = os.path.realpath(path)
+        if not os.path.exists(key):
+            return None
+        with self._lock:
+            if key != self._key:
+                conn = InstrumentedConnection(duckdb.connect(key, read_only=True))
+                taken_at = conn.execute("SELECT taken_at FROM snapshot_info").fetchone()[0]
+                # Requests may still be reading the previous copy, so it isn't closed
+                # here: it is freed, and closed, once the last of them drops it
+                self._key, self._conn, self._taken_at = key, conn, taken_at
+            conn, taken_at = self._conn, self._taken_at
+        if (datetime.utcnow() - taken_at).total_seconds() > max_staleness:
+            return None
+        return conn, taken_at
+
+analytics_snapshot = AnalyticsSnapshot()
+
+def analytics_db(response, max_staleness=None):
+    """Connection for a reporting query: the snapshot if it is fresh enough, else live.
+
+    Sets X-Data-Source, and for snapshot reads X-Data-As-Of / X-Data-Staleness.
+    """
+    if max_staleness is None:
+        max_staleness = ANALYTICS_MAX_STALENESS_SECONDS
+    snapshot = None
+    if max_staleness > 0:
+        try:
+            snapshot = analytics_snapshot.acquire(min(max_staleness, ANALYTICS_MAX_STALENESS_SECONDS))
+        except Exception as e:
+            print(f"Analytics snapshot unavailable, reading live data: {e}")
+    if snapshot is None:
+        response.headers["X-Data-Source"] = "live"
+        return get_db()
+    conn, taken_at = snapshot
+    response.headers["X-Data-Source"] = "snapshot"
+    response.headers["X-Data-As-Of"] = taken_at.isoformat() + "Z"
+    response.headers["X-Data-Staleness"] = str(int((datetime.utcnow() - taken_at).total_seconds()))
+    return conn
+
+# Server-side practice sessions. The browser starts a session, heartbeats while the
+# timer runs and stops it; the server decides the duration. Open sessions are a
+# few slots each in memory; a sweeper closes sessions whose heartbeats stopped
+# (closed tab, lost network) at their last heartbeat, and completed sessions are
+# written to time_tracking in batches rather than one INSERT per stop.
+PRACTICE_HEARTBEAT_SECONDS = int(os.getenv("PRACTICE_HEARTBEAT_SECONDS", "30"))
+PRACTICE_SESSION_TIMEOUT_SECONDS = int(os.getenv("PRACTICE_SESSION_TIMEOUT_SECONDS", "90"))
+PRACTICE_FLUSH_SECONDS = float(os.getenv("PRACTICE_FLUSH_SECONDS", "5"))
+PRACTICE_FLUSH_BATCH = int(os.getenv("PRACTICE_FLUSH_BATCH", "500"))
+# Offline entries replayed through /api/time-tracking/batch
+OFFLINE_BATCH_LIMIT = int(os.getenv("OFFLINE_BATCH_LIMIT", "200"))
+OFFLINE_RECEIPT_RETENTION_DAYS = int(os.getenv("OFFLINE_RECEIPT_RETENTION_DAYS", "90"))
+
+class PracticeSession:
+    __slots__ = ("student_id", "course_id", "started", "last_beat")
+
+    def __init__(self, student_id, course_id, started):
+        self.student_id = student_id
+        self.course_id = course_id
+        self.started = started
+        self.last_beat = started
+
+class PracticeSessions:
+    """Open sessions keyed by id, one per student, plus the completed-but-unflushed buffer.
+
+    Routes call in from the threadpool and the sweeper from the event loop, so every
+    method takes the lock. Methods given a student_id return None when the session
+    does not exist or belongs to someone else.
+    """
+
+    def __init__(self):
+        self._sessions = {}     # session_id -> PracticeSession
+        self._by_student = {}   # student_id -> session_id
+        self.completed = []     # (student_id, course_id, start_time, end_time, duration)
+        self.stats = {"started": 0, "stopped": 0, "expired": 0, "flushed": 0}
+        self._lock = threading.RLock()
+
+    def start(self, student_id, course_id):
+        with self._lock:
+            # A second tab (or a client reconnecting after it lost the network) replaces the
+            # running session, credited up to its last heartbeat rather than double-counting
+            previous = self._by_student.get(student_id)
+            if previous is not None:
+                self._stop(previous, self._sessions[previous].last_beat)
+            session_id = secrets.token_urlsafe(12)
+            session = self._sessions[session_id] = PracticeSession(student_id, course_id, time.time())
+            self._by_student[student_id] = session_id
+            self.stats["started"] += 1
+        event_bus.publish("practice_started", {"student_id": student_id, "course_id": course_id})
+        return session_id, session.started
+
+    def heartbeat(self, session_id, student_id):
+        with self._lock:
+            session = self._owned(session_id, student_id)
+            if session is None:
+                return None
+            now = time.time()
+            if now - session.last_beat > PRACTICE_SESSION_TIMEOUT_SECONDS:
+                # Missed beats: credit up to the last one and start counting again from now
+                self._complete(session, session.last_beat)
+                session.started = now
+            session.last_beat = now
+            return int(now - session.started)
+
+    def stop(self, session_id, student_id, discard=False):
+        with self._lock:
+            if self._owned(session_id, student_id) is None:
+                return None
+            return self._stop(session_id, time.time(), discard)
+
+    def sweep(self):
+        with self._lock:
+            cutoff = time.time() - PRACTICE_SESSION_TIMEOUT_SECONDS
+            expired = [session_id for session_id, session in self._sessions.items() if session.last_beat < cutoff]
+            for session_id in expired:
+                self._stop(session_id, self._sessions[session_id].last_beat)
+            self.stats["expired"] += len(expired)
+            return len(expired)
+
+    def close_all(self):
+        with self._lock:
+            for session_id in list(self._sessions):
+                self._stop(session_id, time.time())
+
+    def take_completed(self):
+        with self._lock:
+            batch, self.completed = self.completed, []
+            return batch
+
+    def requeue(self, rows):
+        with self._lock:
+            self.completed[:0] = rows
+
+    def count_flushed(self, count):
+        with self._lock:
+            self.stats["flushed"] += count
+
+    def summary(self):
+        with self._lock:
+            return {"open": len(self._sessions), "pending_flush": len(self.completed), **self.stats}
+
+    def _owned(self, session_id, student_id):
+        session = self._sessions.get(session_id)
+        if session is None or session.student_id != student_id:
+            return None
+        return session
+
+    def _stop(self, session_id, now, discard=False):
+        session = self._sessions.pop(session_id)
+        if self._by_student.get(session.student_id) == session_id:
+            del self._by_student[session.student_id]
+        end = now if now - session.last_beat <= PRACTICE_SESSION_TIMEOUT_SECONDS else session.last_beat
+        self.stats["stopped"] += 1
+        event_bus.publish("practice_stopped", {"student_id": session.student_id, "course_id": session.course_id})
+        return 0 if discard else self._complete(session, end)
+
+    def _complete(self, session, end):
+        duration = int(end - session.started)
+        if duration > 0:
+            self.completed.append((session.student_id, session.course_id,
+                                   datetime.utcfromtimestamp(session.started),
+                                   datetime.utcfromtimestamp(end), duration))
+        return duration
+
+    def __len__(self):
+        return len(self._sessions)
+
+class SharedPracticeSessions:
+    """Sessions held by the database service, so a session started on one web worker
+    can be heartbeated and stopped on any other."""
+
+    def start(self, student_id, course_id):
+        return get_db().practice("start", student_id, course_id)
+
+    def heartbeat(self, session_id, student_id):
+        return get_db().practice("heartbeat", session_id, student_id)
+
+    def stop(self, session_id, student_id, discard=False):
+        return get_db().practice("stop", session_id, student_id, discard)
+
+    def summary(self):
+        return get_db().practice("summary")
+
+practice_sessions = PracticeSessions()
+shared_practice_sessions = SharedPracticeSessions()
+# What the service runs on behalf of workers
+PRACTICE_SERVICE_METHODS = ("start", "heartbeat", "stop", "summary")
+
+def practice_backend():
+    # Web workers behind the database service share its sessions; the service itself
+    # (and a single-process deployment) holds them here
+    return shared_practice_sessions if DB_SERVICE_SOCKET else practice_sessions
+
+def flush_practice_sessions():
+    batch = practice_sessions.take_completed()
+    if not batch:
+        return 0
+    try:
+        for offset in range(0, len(batch), PRACTICE_FLUSH_BATCH):
+            rows = batch[offset:offset + PRACTICE_FLUSH_BATCH]
+            conn = get_db()
+            conn.execute("BEGIN")
+            try:
+                # One statement per batch
+                conn.execute(f"""
+                    INSERT INTO time_tracking (id, student_id, course_id, start_time, end_time, duration)
+                    VALUES {", ".join(["(?, ?, ?, ?, ?, ?)"] * len(rows))}
+                """, [value for row_id, row in zip(next_ids(conn, "time_tracking_id", len(rows)), rows)
+                      for value in (row_id, *row)])
+                record_changes(conn, "time_tracking", sorted({row[0] for row in rows}))
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            practice_sessions.count_flushed(len(rows))
+            for student_id, course_id, _, _, duration in rows:
+                event_bus.publish("practice_time", {
+                    "student_id": student_id, "course_id": course_id, "duration": duration
+                })
+    except Exception:
+        # Keep the unwritten sessions for the next flush
+        practice_sessions.requeue(batch[offset:])
+        raise
+    return len(batch)
+
+async def run_practice_session_sweeper():
+    last_sweep = 0.0
+    while True:
+        await asyncio.sleep(PRACTICE_FLUSH_SECONDS)
+        try:
+            if time.monotonic() - last_sweep >= PRACTICE_HEARTBEAT_SECONDS:
+                practice_sessions.sweep()
+                last_sweep = time.monotonic()
+            if practice_sessions.completed:
+                await run_in_threadpool(flush_practice_sessions)
+        except Exception as e:
+            print(f"Practice session flush failed: {e}")
+
+async def run_periodic(name, interval_seconds, job):
+    while True:
+        await asyncio.sleep(interval_seconds)
+        try:
+            result = await run_in_threadpool(job)
+            if result:
+                print(f"{name}: {result}")
+        except Exception as e:
+            print(f"{name} failed: {e}")
+
+# Models
+class UserCreate(BaseModel):
+    first_name: str
+    last_name: str
+    email: EmailStr
+    password: str
+
+class UserLogin(BaseModel):
+    email: EmailStr
+    password: str
+
+class PracticeSessionStart(BaseModel):
+    course_id: int
+
+class TimeEntry(BaseModel):
+    course_id: int
+    start_time: datetime
+    end_time: Optional[datetime] = None
+    duration: Optional[int] = None
+
+class OfflineTimeEntry(BaseModel):
+    entry_key: str
+    course_id: int
+    start_time: datetime
+    end_time: datetime
+    duration: int
+
+class TimeEntryBatch(BaseModel):
+    entries: List[OfflineTimeEntry]
+
+# Password hashing. Hashes are stored as "$pbkdf2-sha256$i=<iterations>$<salt hex>$<hash hex>",
+# so the cost can change without invalidating existing passwords. Hashes in the original
+# "<salt>$<hash>" format (100,000 iterations, the hex salt text used as the salt) still
+# verify. PASSWORD_HASH_ITERATIONS sets the cost directly; otherwise, with
+# PASSWORD_HASH_TARGET_MS, the first hash benchmarks this host and picks the iteration
+# count that takes about that long on one core (see calibrate_hash.py), never below
+# PASSWORD_HASH_MIN_ITERATIONS. After a successful login, a hash weaker than the current
+# cost is replaced in the background.
+PASSWORD_HASH_ALGORITHM = "pbkdf2-sha256"
+LEGACY_HASH_ITERATIONS = 100000
+PASSWORD_HASH_MIN_ITERATIONS = int(os.getenv("PASSWORD_HASH_MIN_ITERATIONS", "100000"))
+PASSWORD_HASH_TARGET_MS = float(os.getenv("PASSWORD_HASH_TARGET_MS", "0"))
+
+_password_hash_iterations = int(os.getenv("PASSWORD_HASH_ITERATIONS", "0")) or None
+
+def calibrate_password_hash(target_ms, samples=5, probe_iterations=20000):
+    """Iteration count whose PBKDF2-SHA256 takes about target_ms here, plus the
+    measured cost per 1,000 iterations in ms (best of samples, to skip noise)."""
+    salt = secrets.token_bytes(16)
+    best = min(
+        _timed_pbkdf2(b"calibration-password", salt, probe_iterations)
+        for _ in range(samples)
+    )
+    per_thousand_ms = best * 1000 / probe_iterations
+    iterations = int(target_ms / per_thousand_ms) * 1000
+    return max(iterations, PASSWORD_HASH_MIN_ITERATIONS), per_thousand_ms
+
+def _timed_pbkdf2(password, salt, iterations):
+    start = time.perf_counter()
+    hashlib.pbkdf2_hmac("sha256", password, salt, iterations)
+    return (time.perf_counter() - start) * 1000
+
+def password_hash_iterations():
+    global _password_hash_iterations
+    if _password_hash_iterations is None:
+        if PASSWORD_HASH_TARGET_MS > 0:
+            _password_hash_iterations, per_thousand_ms = calibrate_password_hash(PASSWORD_HASH_TARGET_MS)
+            print(f"Password hashing calibrated: {_password_hash_iterations} iterations "
+                  f"(~{_password_hash_iterations * per_thousand_ms / 1000:.0f} ms)")
+        else:
+            _password_hash_iterations = PASSWORD_HASH_MIN_ITERATIONS
+    return _password_hash_iterations
+
+def _parse_password_hash(hashed_password):
+    """(iterations, salt bytes, hash hex) for either stored format."""
+    if hashed_password.startswith("$"):
+        _, algorithm, params, salt, stored_hash = hashed_password.split("$")
+        if algorithm != PASSWORD_HASH_ALGORITHM or not params.startswith("i="):
+            raise ValueError(f"Unsupported password hash: {algorithm}")
+        return int(params[2:]), bytes.fromhex(salt), stored_hash
+    stored_salt, stored_hash = hashed_password.split("$", 1)
+    return LEGACY_HASH_ITERATIONS, stored_salt.encode("utf-8"), stored_hash
+
+# Utility functions
+def verify_password(plain_password, hashed_password):
+    start = time.perf_counter()
+    try:
+        iterations, salt, stored_hash = _parse_password_hash(hashed_password)
+        password_hash = hashlib.pbkdf2_hmac('sha256', plain_password.encode('utf-8'), salt, iterations)
+        return secrets.compare_digest(password_hash.hex(), stored_hash)
+    except Exception:
+        return False
+    finally:
+        _add_request_timing("hash", (time.perf_counter() - start) * 1000)
+
+def get_password_hash(password):
+    salt = secrets.token_bytes(16)
+    iterations = password_hash_iterations()
+    start = time.perf_counter()
+    password_hash = hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), salt, iterations)
+    _add_request_timing("hash", (time.perf_counter() - start) * 1000)
+    return f"${PASSWORD_HASH_ALGORITHM}$i={iterations}${salt.hex()}${password_hash.hex()}"
+
+def password_needs_rehash(hashed_password):
+    # Only weaker hashes: workers that calibrated slightly differently shouldn't
+    # keep rehashing each other's work
+    try:
+        iterations = _parse_password_hash(hashed_password)[0]
+    except Exception:
+        return False
+    return not hashed_password.startswith("$") or iterations < password_hash_iterations()
+
+def rehash_password(user_id, old_hash, password):
+    # Runs after the login response; the WHERE on the old hash skips the update if the
+    # password was changed (or rehashed by another login) in the meantime
+    new_hash = get_password_hash(password)
+    get_db().execute("UPDATE users SET password_hash = ? WHERE id = ? AND password_hash = ?",
+                     (new_hash, user_id, old_hash))
+
+def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
+    to_encode = data.copy()
+    if expires_delta:
+        expire = datetime.utcnow() + expires_delta
+    else:
+        expire = datetime.utcnow() + timedelta(minutes=15)
+    to_encode.update({"exp": expire})
+    encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+    return encoded_jwt
+
+def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    return user_from_token(credentials.credentials)
+
+def user_from_token(token):
+    credentials_exception = HTTPException(
+        status_code=401,
+        detail="Could not validate credentials",
+        headers={"WWW-Authenticate": "Bearer"},
+    )
+    try:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        email: str = payload.get("sub")
+        # Link tokens open one resource, never the whole API
+        if email is None or "scope" in payload:
+            raise credentials_exception
+    except JWTError:
+        raise credentials_exception
+    return _active_user(email, credentials_exception)
+
+def _active_user(email, credentials_exception):
+    conn = get_db()
+    user = conn.execute("""
+        SELECT id, first_name, last_name, email, password_hash, is_admin 
+        FROM users 
+        WHERE email = ? AND deleted_at IS NULL
+    """, (email,)).fetchone()
+    
+    if user is None:
+        raise credentials_exception
+    return user
+
+# Link tokens. A plain link (a download, an EventSource) can't send the Authorization
+# header, so the client trades its access token for a signed token that opens one
+# resource for LINK_TOKEN_SECONDS, and only that goes in the URL (and so in browser
+# history and access logs). Access tokens are never accepted in a query string.
+LINK_TOKEN_SECONDS = int(os.getenv("LINK_TOKEN_SECONDS", "60"))
+
+def create_link_token(user, scope):
+    return create_access_token({"sub": user[3], "scope": scope}, timedelta(seconds=LINK_TOKEN_SECONDS))
+
+def user_from_link_token(token, scope):
+    invalid = HTTPException(status_code=401, detail="Link expired or invalid")
+    try:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    except JWTError:
+        raise invalid
+    if payload.get("scope") != scope or payload.get("sub") is None:
+        raise invalid
+    return _active_user(payload["sub"], invalid)
+
+def link_or_bearer_user(request, token, scope):
+    """The user behind a link token in the query, or else the Authorization header."""
+    if token is not None:
+        return user_from_link_token(token, scope)
+    authorization = request.headers.get("authorization", "")
+    if not authorization.lower().startswith("bearer "):
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    return user_from_token(authorization[7:])
+
+# Refresh tokens. Login issues "<session id>.<secret>" next to the short-lived access
+# token; /api/token/refresh trades it for a new access token and a new secret with one
+# SHA-256 and one indexed lookup, so a device signs in with its password once instead
+# of every ACCESS_TOKEN_EXPIRE_MINUTES. Each use slides the expiry forward by
+# REFRESH_TOKEN_IDLE_DAYS, up to REFRESH_TOKEN_MAX_DAYS after the login. Presenting a
+# secret that was already rotated away means a copy of the token leaked: the session
+# is revoked, unless it was rotated moments ago (two tabs refreshing at once).
+REFRESH_TOKEN_IDLE_DAYS = int(os.getenv("REFRESH_TOKEN_IDLE_DAYS", "30"))
+REFRESH_TOKEN_MAX_DAYS = int(os.getenv("REFRESH_TOKEN_MAX_DAYS", "180"))
+REFRESH_REUSE_GRACE_SECONDS = int(os.getenv("REFRESH_REUSE_GRACE_SECONDS", "30"))
+
+def _refresh_digest(secret):
+    return hashlib.sha256(secret.encode("utf-8")).hexdigest()
+
+def create_refresh_session(conn, user_id):
+    session_id = secrets.token_urlsafe(12)
+    secret = secrets.token_urlsafe(32)
+    now = datetime.utcnow()
+    conn.execute("""
+        INSERT INTO refresh_sessions (id, user_id, token_hash, previous_hash, created_at, rotated_at, expires_at)
+        VALUES (?, ?, ?, NULL, ?, ?, ?)
+    """, (session_id, user_id, _refresh_digest(secret), now, now,
+          now + timedelta(days=min(REFRESH_TOKEN_IDLE_DAYS, REFRESH_TOKEN_MAX_DAYS))))
+    return f"{session_id}.{secret}"
+
+def rotate_refresh_session(conn, token):
+    """Returns (user, new refresh token); the token is None when a concurrent refresh
+    already rotated it and the caller should keep using the one it has."""
+    invalid = HTTPException(status_code=401, detail="Invalid refresh token")
+    session_id, _, secret = token.partition(".")
+    row = conn.execute("""
+        SELECT s.token_hash, s.previous_hash, s.created_at, s.rotated_at, s.expires_at,
+               u.id, u.first_name, u.last_name, u.email, u.password_hash, u.is_admin
+        FROM refresh_sessions s JOIN users u ON u.id = s.user_id
+        WHERE s.id = ?
+    """, (session_id,)).fetchone()
+    if row is None or not secret:
+        raise invalid
+    token_hash, previous_hash, created_at, rotated_at, expires_at = row[:5]
+    user = row[5:]
+    now = datetime.utcnow()
+    if expires_at <= now:
+        conn.execute("DELETE FROM refresh_sessions WHERE id = ?", (session_id,))
+        raise invalid
+    
+    digest = _refresh_digest(secret)
+    if secrets.compare_digest(digest, token_hash):
+        new_secret = secrets.token_urlsafe(32)
+        expires = min(now + timedelta(days=REFRESH_TOKEN_IDLE_DAYS),
+                      created_at + timedelta(days=REFRESH_TOKEN_MAX_DAYS))
+        # Compare-and-swap on the old hash: of two workers rotating the same secret,
+        # only one wins
+        rotated = conn.execute("""
+            UPDATE refresh_sessions
+            SET token_hash = ?, previous_hash = ?, rotated_at = ?, expires_at = ?
+            WHERE id = ? AND token_hash = ?
+            RETURNING id
+        """, (_refresh_digest(new_secret), digest, now, expires, session_id, digest)).fetchone()
+        if rotated is not None:
+            return user, f"{session_id}.{new_secret}"
+        return user, None
+    if previous_hash is not None and secrets.compare_digest(digest, previous_hash):
+        if (now - rotated_at).total_seconds() <= REFRESH_REUSE_GRACE_SECONDS:
+            return user, None
+        conn.execute("DELETE FROM refresh_sessions WHERE id = ?", (session_id,))
+        print(f"Refresh token reuse for user {user[0]}: session revoked")
+    raise invalid
+
+def revoke_refresh_session(conn, token):
+    session_id, _, secret = token.partition(".")
+    digest = _refresh_digest(secret)
+    conn.execute("""
+        DELETE FROM refresh_sessions
+        WHERE id = ? AND (token_hash = ? OR previous_hash = ?)
+    """, (session_id, digest, digest))
+
+def prune_refresh_sessions():
+    conn = get_db()
+    count = conn.execute("SELECT COUNT(*) FROM refresh_sessions WHERE expires_at <= ?",
+                         (datetime.utcnow(),)).fetchone()[0]
+    if count:
+        conn.execute("DELETE FROM refresh_sessions WHERE expires_at <= ?", (datetime.utcnow(),))
+        return f"removed {count} expired sessions"
+    return None
+
+# Delta sync. Writes to users, student_courses, course_materials, time_tracking and
+# time_tracking_rollups append (table, row key, op) rows to the changelog under a
+# monotonically increasing version. List endpoints accept ?since=<version> and
+# return only the rows whose latest change is newer, plus tombstones for deletes.
+# Row keys: users "<id>", student_courses "<student_id>:<course_id>",
+# course_materials "<course_id>:<material_id>", time_tracking "<student_id>",
+# rollups "<student_id>:<course_id>:<year>:<month>".
+CHANGELOG_RETENTION_DAYS = int(os.getenv("CHANGELOG_RETENTION_DAYS", "30"))
+
+def record_changes(conn, table_name, row_keys, op="upsert"):
+    row_keys = [str(key) for key in row_keys]
+    if not row_keys:
+        return
+    conn.execute("""
+        INSERT INTO changelog (version, table_name, row_key, op)
+        SELECT unnest(?), ?, unnest(?), ?
+    """, (next_ids(conn, "changelog_version", len(row_keys)), table_name, row_keys, op))
+
+def changes_since(conn, since, table_names, key_prefix=None):
+    """Returns (version, changes) where changes maps (table, row_key) to the latest op,
+    or None when the caller must take a full listing (first sync, or changes pruned).
+
+    Versions commit in order (the statement gate serialises changelog writers up to
+    their COMMIT), so nothing below the newest visible version can still appear."""
+    version, oldest = conn.execute("SELECT COALESCE(MAX(version), 0), MIN(version) FROM changelog").fetchone()
+    if since is None or since <= 0 or since > version or (oldest is not None and since < oldest - 1):
+        return version, None
+    sql = f"""
+        SELECT table_name, row_key, arg_max(op, version)
+        FROM changelog
+        WHERE version > ? AND table_name IN ({", ".join("?" * len(table_names))})
+    """
+    params = [since, *table_names]
+    if key_prefix is not None:
+        sql += " AND row_key LIKE ?"
+        params.append(f"{key_prefix}%")
+    rows = conn.execute(sql + " GROUP BY table_name, row_key", params).fetchall()
+    return version, {(table, key): op for table, key, op in rows}
+
+def prune_changelog():
+    # Keep the newest row so the retained range still proves where history starts
+    cutoff = datetime.utcnow() - timedelta(days=CHANGELOG_RETENTION_DAYS)
+    deleted = get_db().execute("""
+        DELETE FROM changelog
+        WHERE changed_at < ? AND version < (SELECT MAX(version) FROM changelog)
+    """, (cutoff,)).fetchone()[0]
+    return f"pruned {deleted} changelog rows" if deleted else None
+
+def prune_time_entry_receipts():
+    cutoff = datetime.utcnow() - timedelta(days=OFFLINE_RECEIPT_RETENTION_DAYS)
+    deleted = get_db().execute("DELETE FROM time_entry_receipts WHERE received_at < ?", (cutoff,)).fetchone()[0]
+    return f"pruned {deleted} offline time entry receipts" if deleted else None
+
+def delta_response(version, changes, deleted):
+    return {"version": version, "full": False, "changes": changes, "deleted": deleted}
+
+def full_response(version, rows):
+    return {"version": version, "full": True, "changes": rows, "deleted": []}
+
+# Admin live events. Write paths publish small deltas to an in-process bus and
+# /api/admin/events streams them to dashboards over Server-Sent Events. Events carry
+# increasing ids and a short replay buffer lets a reconnecting EventSource catch up
+# from Last-Event-ID; a subscriber that falls too far behind gets a "resync" event
+# and reloads the roster instead. Behind db_service.py the service's bus is the only
+# one: workers forward what they publish to it and relay its stream to dashboards,
+# so every dashboard sees every worker's events under one id sequence.
+EVENT_REPLAY_SIZE = int(os.getenv("EVENT_REPLAY_SIZE", "500"))
+EVENT_QUEUE_SIZE = int(os.getenv("EVENT_QUEUE_SIZE", "200"))
+EVENT_KEEPALIVE_SECONDS = 15
+
+class EventBus:
+    def __init__(self):
+        self._loop = None
+        self._subscribers = set()
+        self._replay = deque(maxlen=EVENT_REPLAY_SIZE)
+        self._next_id = 1
+        self._relays = {}  # subscriber queue -> task relaying the service's stream
+        self._forwarder = None
+
+    def attach(self, loop):
+        """Keep events (for replay) before the first subscriber; the database service
+        calls this since its socket handlers subscribe from other threads."""
+        self._loop = loop
+
+    def publish(self, event_type, data):
+        """Safe to call from routes on the event loop and from threadpool code."""
+        if DB_SERVICE_SOCKET:
+            # One thread sends them in order, so the caller never waits on the socket
+            if self._forwarder is None:
+                self._forwarder = ThreadPoolExecutor(max_workers=1, thread_name_prefix="event-forwarder")
+            self._forwarder.submit(self._forward, event_type, data)
+            return
+        loop = self._loop
+        if loop is None:
+            return  # nobody has subscribed yet
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is loop:
+            self._dispatch(event_type, data)
+        else:
+            loop.call_soon_threadsafe(self._dispatch, event_type, data)
+
+    def _dispatch(self, event_type, data):
+        event = (self._next_id, event_type, json.dumps(data, default=str))
+        self._next_id += 1
+        self._replay.append(event)
+        for queue in self._subscribers:
+            self._offer(queue, event)
+
+    def _offer(self, queue, event):
+        try:
+            queue.put_nowait(event)
+        except asyncio.QueueFull:
+            while not queue.empty():
+                queue.get_nowait()
+            queue.put_nowait((event[0], "resync", "{}"))
+
+    def subscribe(self, last_event_id=None):
+        """Returns a queue of (id, type, data) events; None means the stream ended."""
+        self._loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(maxsize=EVENT_QUEUE_SIZE)
+        if DB_SERVICE_SOCKET:
+            self._relays[queue] = asyncio.create_task(self._relay(queue, last_event_id))
+            self._subscribers.add(queue)
+            return queue
+        if last_event_id is not None:
+            if self._replay and self._replay[0][0] > last_event_id + 1:
+                self._offer(queue, (self._next_id - 1, "resync", "{}"))
+            else:
+                for event in self._replay:
+                    if event[0] > last_event_id:
+                        self._offer(queue, event)
+        self._subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, queue):
+        self._subscribers.discard(queue)
+        relay = self._relays.pop(queue, None)
+        if relay is not None:
+            relay.cancel()
+
+    def subscribe_threadsafe(self, last_event_id=None):
+        async def subscribe():
+            return self.subscribe(last_event_id)
+        return asyncio.run_coroutine_threadsafe(subscribe(), self._loop).result()
+
+    def next_event_threadsafe(self, queue, timeout):
+        """The next event for a subscriber from another thread, or None after timeout."""
+        try:
+            return asyncio.run_coroutine_threadsafe(asyncio.wait_for(queue.get(), timeout), self._loop).result()
+        except asyncio.TimeoutError:
+            return None
+
+    def unsubscribe_threadsafe(self, queue):
+        self._loop.call_soon_threadsafe(self.unsubscribe, queue)
+
+    def _forward(self, event_type, data):
+        try:
+            cursor = RemoteCursor(DB_SERVICE_SOCKET)
+            try:
+                cursor._call("publish", event_type, data)
+            finally:
+                cursor.close()
+        except Exception as e:
+            print(f"Event forwarding to the database service failed, dropped {event_type}: {e}")
+
+    async def _relay(self, queue, last_event_id):
+        writer = None
+        try:
+            reader, writer = await asyncio.open_unix_connection(DB_SERVICE_SOCKET)
+            writer.write(encode_frame(("subscribe", last_event_id)))
+            await writer.drain()
+            while True:
+                (length,) = _FRAME_HEADER.unpack(await reader.readexactly(_FRAME_HEADER.size))
+                frame = pickle.loads(await reader.readexactly(length))
+                if frame[0] == "event":
+                    self._offer(queue, frame[1:])
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Event stream from the database service ended: {e}")
+        finally:
+            if writer is not None:
+                writer.close()
+        # The dashboard reconnects, with Last-Event-ID, once its stream ends
+        while not queue.empty():
+            queue.get_nowait()
+        queue.put_nowait(None)
+
+    def __len__(self):
+        return len(self._subscribers)
+
+event_bus = EventBus()
+
+def _assigned_course_names(conn, student_id):
+    courses = conn.execute("""
+        SELECT c.name
+        FROM student_courses sc
+        JOIN courses c ON sc.course_id = c.id
+        WHERE sc.student_id = ?
+        ORDER BY c.name
+    """, (student_id,)).fetchall()
+    return ", ".join(course[0] for course in courses)
+
+def _assigned_course_names_by_student(conn):
+    return dict(conn.execute("""
+        SELECT sc.student_id, string_agg(c.name, ', ' ORDER BY c.name)
+        FROM student_courses sc
+        JOIN courses c ON sc.course_id = c.id
+        GROUP BY sc.student_id
+    """).fetchall())
+
+# Reference-data catalog. The course list, each student's assignments (a bitset with
+# bit n set for course n) and the course of every material are small, so they are
+# held in memory: listing courses and checking enrollment on every materials request
+# never touch the database. Loaded on first use; assignment and upload routes update
+# it after their writes, and with several workers the writer's table versions tell
+# this worker to reload after another one wrote.
+CATALOG_TABLES = ("courses", "student_courses", "course_materials")
+
+class CourseCatalog:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._generation = 0      # bumped by every write, so a load never undoes one
+        self._courses = {}        # course_id -> course row
+        self._by_name = []        # course rows ordered by name
+        self._assignments = {}    # student_id -> int bitset of course ids
+        self._materials = {}      # material_id -> course_id
+        self._table_versions = None
+        self.stats = {"loads": 0, "enrollment_checks": 0, "denied": 0}
+
+    def _refresh(self):
+        if DB_SERVICE_SOCKET:
+            versions = get_db().table_versions()
+            key = tuple(versions.get(table, 0) for table in CATALOG_TABLES)
+            if key != self._table_versions:
+                self.load()
+                self._table_versions = key
+        elif not self._loaded:
+            self.load()
+
+    def load(self):
+        while True:
+            generation = self._generation
+            conn = get_db()
+            courses = conn.execute("SELECT * FROM courses ORDER BY name").fetchall()
+            assignments = {}
+            for student_id, course_id in conn.execute("SELECT student_id, course_id FROM student_courses").fetchall():
+                assignments[student_id] = assignments.get(student_id, 0) | (1 << course_id)
+            materials = dict(conn.execute("SELECT id, course_id FROM course_materials").fetchall())
+            with self._lock:
+                if generation != self._generation:
+                    continue  # a write landed while we were reading; read again
+                self._courses = {course[0]: course for course in courses}
+                self._by_name = courses
+                self._assignments = assignments
+                self._materials = materials
+                self._loaded = True
+                self.stats["loads"] += 1
+                return
+
+    def courses(self):
+        self._refresh()
+        return list(self._by_name)
+
+    def courses_for(self, student_id):
+        self._refresh()
+        bits = self._assignments.get(student_id, 0)
+        return [course for course in self._by_name if bits >> course[0] & 1]
+
+    def course_ids_for(self, student_id):
+        return [course[0] for course in self.courses_for(student_id)]
+
+    def is_assigned(self, student_id, course_id):
+        self._refresh()
+        self.stats["enrollment_checks"] += 1
+        assigned = bool(self._assignments.get(student_id, 0) >> course_id & 1)
+        if not assigned:
+            self.stats["denied"] += 1
+        return assigned
+
+    def material_course(self, material_id):
+        self._refresh()
+        return self._materials.get(material_id)
+
+    def can_access_course(self, current_user, course_id):
+        return bool(current_user[5]) or self.is_assigned(current_user[0], course_id)
+
+    def assign(self, student_id, course_id):
+        with self._lock:
+            self._generation += 1
+            self._assignments[student_id] = self._assignments.get(student_id, 0) | (1 << course_id)
+
+    def set_assignments(self, student_id, course_ids):
+        bits = 0
+        for course_id in course_ids:
+            bits |= 1 << course_id
+        with self._lock:
+            self._generation += 1
+            self._assignments[student_id] = bits
+
+    def remove_student(self, student_id):
+        with self._lock:
+            self._generation += 1
+            self._assignments.pop(student_id, None)
+
+    def add_material(self, material_id, course_id):
+        with self._lock:
+            self._generation += 1
+            self._materials[material_id] = course_id
+
+    def summary(self):
+        return dict(self.stats, courses=len(self._courses), students=len(self._assignments),
+                    materials=len(self._materials))
+
+course_catalog = CourseCatalog()
+
+# Course materials listing cache. Materials only change when an admin uploads, so the
+# per-course listing is cached until upload_material (or a delete) invalidates it.
+# Concurrent misses for the same course share one query running in the threadpool.
+class CourseMaterialsCache:
+    def __init__(self):
+        self._entries = {}    # course_id -> (etag, materials)
+        self._inflight = {}   # course_id -> asyncio.Future
+        self._versions = {}   # course_id -> bumped on every invalidation
+        self.stats = {"hits": 0, "misses": 0, "coalesced": 0, "invalidations": 0}
+        self._table_version = None  # service-side course_materials version (multi-worker)
+
+    async def get(self, course_id):
+        if DB_SERVICE_SOCKET:
+            # Another worker may have taken the upload, so check the writer's table
+            # version (one local socket round trip) before trusting our entries
+            version = get_db().table_versions().get("course_materials", 0)
+            if version != self._table_version:
+                self.clear()
+                self._table_version = version
+        entry = self._entries.get(course_id)
+        if entry is not None:
+            self.stats["hits"] += 1
+            return entry
+
+        inflight = self._inflight.get(course_id)
+        if inflight is not None:
+            self.stats["coalesced"] += 1
+            return await asyncio.shield(inflight)
+
+        self.stats["misses"] += 1
+        version = self._versions.get(course_id, 0)
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[course_id] = future
+        try:
+            materials = await run_in_threadpool(_load_course_materials, course_id)
+            etag = '"' + hashlib.sha1(json.dumps(materials).encode("utf-8")).hexdigest()[:20] + '"'
+            entry = (etag, materials)
+            # Don't store a listing that an upload invalidated while it was loading
+            if self._versions.get(course_id, 0) == version:
+                self._entries[course_id] = entry
+            future.set_result(entry)
+            return entry
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # mark retrieved when nobody else was waiting
+            raise
+        finally:
+            if self._inflight.get(course_id) is future:
+                del self._inflight[course_id]
+
+    def invalidate(self, course_id):
+        self._versions[course_id] = self._versions.get(course_id, 0) + 1
+        self._entries.pop(course_id, None)
+        self._inflight.pop(course_id, None)
+        self.stats["invalidations"] += 1
+
+    def clear(self):
+        for course_id in list(self._entries):
+            self.invalidate(course_id)
+
+def _load_course_materials(course_id):
+    conn = get_db()
+    materials = conn.execute("""
+        SELECT id, material_type, filename, uploaded_at
+        FROM course_materials
+        WHERE course_id = ?
+        ORDER BY material_type, uploaded_at DESC
+    """, (course_id,)).fetchall()
+
+    material_list = []
+    for material in materials:
+        material_list.append({
+            "id": material[0],
+            "material_type": material[1],
+            "filename": material[2],
+            "uploaded_at": str(material[3])
+        })
+    return material_list
+
+course_materials_cache = CourseMaterialsCache()
+
+def _course_materials_since(course_id, since):
+    conn = get_db()
+    version, changes = changes_since(conn, since, ["course_materials"], key_prefix=f"{course_id}:")
+    if changes is None:
+        return full_response(version, _load_course_materials(course_id))
+    deleted = sorted(int(key.split(":")[1]) for (_, key), op in changes.items() if op == "delete")
+    added = [int(key.split(":")[1]) for (_, key), op in changes.items() if op == "upsert"]
+    if not added:
+        return delta_response(version, [], deleted)
+    materials = conn.execute(f"""
+        SELECT id, material_type, filename, uploaded_at
+        FROM course_materials
+        WHERE course_id = ? AND id IN ({", ".join("?" * len(added))})
+        ORDER BY material_type, uploaded_at DESC
+    """, (course_id, *added)).fetchall()
+    return delta_response(version, [{
+        "id": material[0],
+        "material_type": material[1],
+        "filename": material[2],
+        "uploaded_at": str(material[3])
+    } for material in materials], deleted)
+
+# Single-flight request coalescing. Identical concurrent reads (same route, same
+# parameters, same principal class) share one in-flight computation and its result.
+class SingleFlight:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._inflight = {}       # key -> [threading.Event, result, error] for sync routes
+        self._async_inflight = {} # key -> asyncio.Future for async routes
+        self.stats = {}           # route -> {"calls", "executions", "coalesced"}
+
+    def _count(self, route, field):
+        route_stats = self.stats.setdefault(route, {"calls": 0, "executions": 0, "coalesced": 0})
+        route_stats[field] += 1
+
+    def do(self, route, key, fn):
+        with self._lock:
+            self._count(route, "calls")
+            call = self._inflight.get(key)
+            leader = call is None
+            if leader:
+                call = [threading.Event(), None, None]
+                self._inflight[key] = call
+                self._count(route, "executions")
+            else:
+                self._count(route, "coalesced")
+
+        if not leader:
+            call[0].wait()
+            if call[2] is not None:
+                raise call[2]
+            return call[1]
+
+        try:
+            call[1] = fn()
+            return call[1]
+        except Exception as e:
+            call[2] = e
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[key]
+            call[0].set()
+
+    async def do_async(self, route, key, fn):
+        self._count(route, "calls")
+        future = self._async_inflight.get(key)
+        if future is not None:
+            self._count(route, "coalesced")
+            return await asyncio.shield(future)
+
+        self._count(route, "executions")
+        future = asyncio.get_running_loop().create_future()
+        self._async_inflight[key] = future
+        try:
+            result = await fn()
+            future.set_result(result)
+            return result
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # mark retrieved when nobody else was waiting
+            raise
+        finally:
+            del self._async_inflight[key]
+
+single_flight = SingleFlight()
+
+def _principal_class(current_user, per_user):
+    if current_user is None:
+        return "anonymous"
+    if current_user[5]:  # is_admin
+        return "admin"
+    return f"student:{current_user[0]}" if per_user else "student"
+
+def _clone_response(response):
+    # Responses are per request (the middleware adds headers), so followers get a copy
+    if not isinstance(response, Response):
+        return response
+    clone = Response(content=response.body, status_code=response.status_code)
+    clone.raw_headers = list(response.raw_headers)
+    return clone
+
+def coalesce(per_user=False):
+    """Opt a read endpoint into single-flight coalescing.
+
+    The key is the route, its parameters (excluding current_user/request) and the
+    caller's principal class: "admin", "student", or "student:<id>" when per_user is
+    set because the result depends on who is asking. Followers get the leader's
+    response, so a per-caller access check must either run before the coalesced call
+    or be covered by per_user.
+    """
+    def decorator(func):
+        route = func.__name__
+
+        def make_key(kwargs):
+            params = tuple(sorted((name, value) for name, value in kwargs.items()
+                                  if name not in ("current_user", "request")))
+            return (route, params, _principal_class(kwargs.get("current_user"), per_user))
+
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                result = await single_flight.do_async(route, make_key(kwargs), lambda: func(*args, **kwargs))
+                return _clone_response(result)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            result = single_flight.do(route, make_key(kwargs), lambda: func(*args, **kwargs))
+            return _clone_response(result)
+        return wrapper
+    return decorator
+
+# Query result cache for read endpoints. Each entry is tagged with the tables its
+# query reads and the write counts of those tables when it was loaded
+# (get_db().table_versions()); a lookup whose tables have been written since is a
+# miss and the entry is dropped. Entries are LRU-evicted past QUERY_CACHE_MAX_BYTES.
+QUERY_CACHE_ENABLED = os.getenv("QUERY_CACHE_ENABLED", "true").lower() == "true"
+QUERY_CACHE_MAX_BYTES = int(os.getenv("QUERY_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+
+class QueryCache:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.enabled = QUERY_CACHE_ENABLED
+        self._entries = OrderedDict()  # (endpoint, key) -> (tables, versions, value, size)
+        self._bytes = 0
+        self._lock = threading.Lock()  # used from routes on the loop and in the threadpool
+        self.stats = {}                # endpoint -> {"hits", "misses", "stale", "evictions"}
+
+    def _count(self, endpoint, field):
+        endpoint_stats = self.stats.setdefault(endpoint, {"hits": 0, "misses": 0, "stale": 0, "evictions": 0})
+        endpoint_stats[field] += 1
+
+    def get_or_load(self, endpoint, key, tables, loader):
+        """Return loader()'s result, cached under (endpoint, key) until one of tables is
+        written. Results must be picklable and are shared between callers, so callers
+        must not modify them."""
+        if not self.enabled:
+            return loader()
+        # Read the versions before loading: a write that lands mid-load leaves the
+        # entry tagged older than the table, so the next lookup discards it
+        all_versions = get_db().table_versions() if tables else {}
+        versions = tuple(all_versions.get(table, 0) for table in tables)
+        cache_key = (endpoint, key)
+        with self._lock:
+            entry = self._entries.get(cache_key)
+            if entry is not None:
+                if entry[1] == versions:
+                    self._entries.move_to_end(cache_key)
+                    self._count(endpoint, "hits")
+                    return entry[2]
+                self._remove(cache_key)
+                self._count(endpoint, "stale")
+            self._count(endpoint, "misses")
+
+        value = loader()
+        size = len(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+        if size > self.max_bytes // 4:
+            return value  # too big to be worth the budget
+        with self._lock:
+            if cache_key in self._entries:
+                self._remove(cache_key)
+            self._entries[cache_key] = (tables, versions, value, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._count(oldest[0], "evictions")
+                self._remove(oldest)
+        return value
+
+    def get_or_load_many(self, endpoint, keys, tables, loader):
+        """get_or_load for several keys of one endpoint: loader(missing_keys) loads
+        every miss at once and returns {key: value}, each cached as its own entry."""
+        if not self.enabled:
+            return loader(list(keys))
+        all_versions = get_db().table_versions() if tables else {}
+        versions = tuple(all_versions.get(table, 0) for table in tables)
+        values = {}
+        missing = []
+        with self._lock:
+            for key in keys:
+                cache_key = (endpoint, key)
+                entry = self._entries.get(cache_key)
+                if entry is not None:
+                    if entry[1] == versions:
+                        self._entries.move_to_end(cache_key)
+                        self._count(endpoint, "hits")
+                        values[key] = entry[2]
+                        continue
+                    self._remove(cache_key)
+                    self._count(endpoint, "stale")
+                self._count(endpoint, "misses")
+                missing.append(key)
+        if not missing:
+            return values
+
+        loaded = loader(missing)
+        with self._lock:
+            for key in missing:
+                value = values[key] = loaded[key]
+                size = len(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+                if size > self.max_bytes // 4:
+                    continue
+                cache_key = (endpoint, key)
+                if cache_key in self._entries:
+                    self._remove(cache_key)
+                self._entries[cache_key] = (tables, versions, value, size)
+                self._bytes += size
+            while self._bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._count(oldest[0], "evictions")
+                self._remove(oldest)
+        return values
+
+    def _remove(self, cache_key):
+        self._bytes -= self._entries.pop(cache_key)[3]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def summary(self):
+        endpoints = {}
+        for endpoint, counts in self.stats.items():
+            lookups = counts["hits"] + counts["misses"]
+            endpoints[endpoint] = dict(counts, hit_rate=round(counts["hits"] / lookups, 3) if lookups else None)
+        return {"enabled": self.enabled, "entries": len(self._entries), "bytes": self._bytes,
+                "max_bytes": self.max_bytes, "endpoints": endpoints}
+
+query_cache = QueryCache(QUERY_CACHE_MAX_BYTES)
+
+def analytics_cache_tags(response, conn, tables):
+    """(key part, tables) for caching a read on analytics_db's connection. Snapshot
+    results are keyed by the snapshot's as-of time instead of being tagged, since
+    the snapshot only changes when it is refreshed."""
+    if conn is get_db():
+        return "live", tables
+    return response.headers["X-Data-As-Of"], ()
+
+# Idempotency keys for mutating endpoints. A client that retries a POST sends the
+# same Idempotency-Key header; the first response is kept for IDEMPOTENCY_TTL_SECONDS
+# and replayed to duplicates without running the endpoint again. Behind db_service.py
+# the service holds the keys, so a retry that lands on another worker is still caught.
+IDEMPOTENCY_TTL_SECONDS = int(os.getenv("IDEMPOTENCY_TTL_SECONDS", "86400"))
+IDEMPOTENCY_MAX_KEYS = int(os.getenv("IDEMPOTENCY_MAX_KEYS", "10000"))
+IDEMPOTENCY_KEY_MAX_LENGTH = 255
+# A key whose request never finished (its worker died) is given up after this long
+IDEMPOTENCY_LEASE_SECONDS = 300
+IDEMPOTENCY_WAIT_SECONDS = 5
+
+class IdempotencyStore:
+    """Responses by key. Thread-safe: claims wait in the threadpool, and the database
+    service serves every worker's claims from its socket threads."""
+
+    def __init__(self, ttl_seconds, max_keys):
+        self.ttl_seconds = ttl_seconds
+        self.max_keys = max_keys
+        self._entries = OrderedDict()  # key -> [fingerprint, expires_at, result or None while running]
+        self._cond = threading.Condition()
+        self.stats = {"executions": 0, "replays": 0, "waited": 0, "mismatches": 0, "evictions": 0}
+
+    def _evict(self, now):
+        # Entries are kept in insertion order, so expired ones are at the front
+        while self._entries:
+            key, entry = next(iter(self._entries.items()))
+            if entry[1] > now and len(self._entries) <= self.max_keys:
+                break
+            if entry[2] is None and entry[1] > now:
+                break  # never drop a request that is still running
+            del self._entries[key]
+            self.stats["evictions"] += 1
+
+    def claim(self, key, fingerprint, wait_seconds=IDEMPOTENCY_WAIT_SECONDS):
+        """("run",) when the caller goes first and must complete() or release() the key,
+        ("done", result) for a stored response, ("mismatch",) when the key was used for
+        other parameters, ("pending",) if the first request is still running after
+        wait_seconds."""
+        deadline = time.monotonic() + wait_seconds
+        waited = False
+        with self._cond:
+            while True:
+                now = time.time()
+                self._evict(now)
+                entry = self._entries.get(key)
+                if entry is not None and entry[1] <= now:
+                    del self._entries[key]
+                    entry = None
+                if entry is None:
+                    self.stats["executions"] += 1
+                    self._entries[key] = [fingerprint, now + IDEMPOTENCY_LEASE_SECONDS, None]
+                    return ("run",)
+                if entry[0] != fingerprint:
+                    self.stats["mismatches"] += 1
+                    return ("mismatch",)
+                if entry[2] is not None:
+                    self.stats["waited" if waited else "replays"] += 1
+                    return ("done", entry[2])
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return ("pending",)
+                waited = True
+                self._cond.wait(remaining)
+
+    def complete(self, key, result):
+        with self._cond:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry[1] = time.time() + self.ttl_seconds
+                entry[2] = result
+            self._cond.notify_all()
+
+    def release(self, key):
+        # Nothing was stored, so the client (or a duplicate waiting) may run it again
+        with self._cond:
+            self._entries.pop(key, None)
+            self._cond.notify_all()
+
+    def summary(self):
+        with self._cond:
+            return dict(self.stats, keys=len(self._entries))
+
+class SharedIdempotencyStore:
+    """Keys held by the database service. Each call gets its own socket, since a claim
+    can wait for a duplicate running on another worker."""
+
+    def claim(self, key, fingerprint, wait_seconds=IDEMPOTENCY_WAIT_SECONDS):
+        return get_db().idempotency("claim", key, fingerprint, wait_seconds)
+
+    def complete(self, key, result):
+        return get_db().idempotency("complete", key, result)
+
+    def release(self, key):
+        return get_db().idempotency("release", key)
+
+    def summary(self):
+        return get_db().idempotency("summary")
+
+idempotency_store = IdempotencyStore(IDEMPOTENCY_TTL_SECONDS, IDEMPOTENCY_MAX_KEYS)
+shared_idempotency_store = SharedIdempotencyStore()
+# What the service runs on behalf of workers
+IDEMPOTENCY_SERVICE_METHODS = ("claim", "complete", "release", "summary")
+
+def idempotency_backend():
+    return shared_idempotency_store if DB_SERVICE_SOCKET else idempotency_store
+
+async def run_idempotent(key, fingerprint, fn):
+    """Return (status, body, media_type, replayed) for the request stored under key."""
+    store = idempotency_backend()
+    claim = ("pending",)
+    while claim[0] == "pending":
+        claim = await run_in_threadpool(store.claim, key, fingerprint)
+    if claim[0] == "mismatch":
+        raise HTTPException(status_code=422, detail="Idempotency-Key was already used for a different request")
+    if claim[0] == "done":
+        return (*claim[1], True)
+
+    try:
+        result = await fn()
+    except BaseException:
+        await asyncio.shield(run_in_threadpool(store.release, key))
+        raise
+    if result[0] >= 500:
+        # A server error is worth retrying
+        await run_in_threadpool(store.release, key)
+    else:
+        await run_in_threadpool(store.complete, key, result)
+    return (*result, False)
+
+async def _fingerprint_value(value):
+    if isinstance(value, UploadFile):
+        # Hash the upload in the threadpool, then rewind it for the endpoint
+        def digest():
+            hasher = hashlib.sha256()
+            value.file.seek(0)
+            for chunk in iter(lambda: value.file.read(1024 * 1024), b""):
+                hasher.update(chunk)
+            value.file.seek(0)
+            return hasher.hexdigest()
+        return {"filename": value.filename, "sha256": await run_in_threadpool(digest)}
+    return jsonable_encoder(value)
+
+def idempotent(func):
+    """Accept an optional Idempotency-Key header on a mutating endpoint.
+
+    Keys are scoped to the route and the caller. A repeated key with the same
+    parameters gets the stored response (marked Idempotent-Replayed: true) without
+    running the endpoint; a concurrent duplicate waits for the first to finish.
+    Reusing a key with different parameters is rejected with 422. Responses with a
+    5xx status are not stored.
+    """
+    route = func.__name__
+    signature = inspect.signature(func)
+
+    async def call(*args, **kwargs):
+        if inspect.iscoroutinefunction(func):
+            return await func(*args, **kwargs)
+        return await run_in_threadpool(func, *args, **kwargs)
+
+    @functools.wraps(func)
+    async def wrapper(*args, idempotency_key: Optional[str] = None, **kwargs):
+        if not idempotency_key:
+            return await call(*args, **kwargs)
+        if len(idempotency_key) > IDEMPOTENCY_KEY_MAX_LENGTH:
+            raise HTTPException(status_code=400, detail="Idempotency-Key is too long")
+
+        current_user = kwargs.get("current_user")
+        principal = current_user[0] if current_user is not None else None
+        params = {}
+        for name, value in sorted(kwargs.items()):
+            if name != "current_user" and not isinstance(value, (Request, Response)):
+                params[name] = await _fingerprint_value(value)
+        fingerprint = hashlib.sha256(json.dumps(params, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+        async def execute():
+            result = await call(*args, **kwargs)
+            if not isinstance(result, Response):
+                result = JSONResponse(content=jsonable_encoder(result))
+            return (result.status_code, bytes(result.body), result.media_type)
+
+        status_code, body, media_type, replayed = await run_idempotent(
+            (route, principal, idempotency_key), fingerprint, execute
+        )
+        response = Response(content=body, status_code=status_code, media_type=media_type)
+        if replayed:
+            response.headers["Idempotent-Replayed"] = "true"
+        return response
+
+    wrapper.__signature__ = signature.replace(parameters=[
+        *signature.parameters.values(),
+        inspect.Parameter("idempotency_key", inspect.Parameter.KEYWORD_ONLY,
+                          default=Header(None, alias="Idempotency-Key"), annotation=Optional[str])
+    ])
+    return wrapper
+
+# Rate limiting. Token buckets per route class, keyed by the signed-in account or the
+# client IP; /api/login also charges a bucket per email before hashing the password.
+# Buckets refill continuously and sit in LRU order, so the front is swept of buckets
+# that have refilled (they hold nothing a fresh bucket wouldn't) and, past
+# RATE_LIMIT_MAX_KEYS, of the least recently used. With several web workers behind
+# db_service.py the buckets live in the service and every worker draws on them.
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "true").lower() == "true"
+RATE_LIMIT_MAX_KEYS = int(os.getenv("RATE_LIMIT_MAX_KEYS", "50000"))
+RATE_LIMIT_TRUST_FORWARDED = os.getenv("RATE_LIMIT_TRUST_FORWARDED", "false").lower() == "true"
+# "local" keeps buckets in this process, "service" in the database service
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "service" if DB_SERVICE_SOCKET else "local")
+
+# route class -> (requests, window seconds); e.g. RATE_LIMITS="login=20/60,api=300/60"
+DEFAULT_RATE_LIMITS = {
+    "login": (10, 60),           # per client IP
+    "login_account": (5, 300),   # per email
+    "register": (20, 3600),      # per client IP
+    "upload": (30, 60),
+    "api": (600, 60),
+}
+
+def _parse_rate_limits(spec):
+    limits = dict(DEFAULT_RATE_LIMITS)
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        name, _, value = item.partition("=")
+        requests, _, window = value.partition("/")
+        limits[name.strip()] = (int(requests), float(window or 60))
+    return limits
+
+RATE_LIMITS = _parse_rate_limits(os.getenv("RATE_LIMITS", ""))
+
+# (method, path prefix, route class); the first match wins and None exempts the route
+RATE_LIMIT_ROUTES = [
+    ("POST", "/api/login", "login"),
+    ("POST", "/api/register", "register"),
+    ("POST", "/api/upload-material/", "upload"),
+    ("GET", "/api/admin/events", None),  # one long-lived stream per dashboard
+    (None, "/api/", "api"),
+]
+
+class TokenBuckets:
+    """In-process buckets. take() is the whole backend interface: SharedTokenBuckets
+    answers the same call from the database service."""
+
+    def __init__(self, max_keys):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()  # key -> [tokens, updated_at, full_at]
+        self._lock = threading.Lock()  # the database service calls take() from many threads
+        self.stats = {"allowed": 0, "limited": 0, "expired": 0, "evictions": 0}
+
+    def take(self, key, capacity, window_seconds, cost=1):
+        """Returns (allowed, remaining, reset_seconds, retry_after_seconds). Cost 0
+        checks whether a request would be allowed without charging for it."""
+        rate = capacity / window_seconds
+        now = time.monotonic()
+        needed = max(cost, 1)
+        with self._lock:
+            self._evict(now)
+            bucket = self._buckets.pop(key, None)
+            tokens = capacity if bucket is None else min(capacity, bucket[0] + (now - bucket[1]) * rate)
+            allowed = tokens >= needed
+            if allowed:
+                tokens -= cost
+            self._buckets[key] = [tokens, now, now + (capacity - tokens) / rate]
+            self.stats["allowed" if allowed else "limited"] += 1
+        retry_after = 0 if allowed else (needed - tokens) / rate
+        return allowed, int(tokens), (capacity - tokens) / rate, retry_after
+
+    def _evict(self, now):
+        while self._buckets:
+            key, bucket = next(iter(self._buckets.items()))
+            if bucket[2] <= now:
+                self.stats["expired"] += 1
+            elif len(self._buckets) >= self.max_keys:
+                self.stats["evictions"] += 1
+            else:
+                break
+            del self._buckets[key]
+
+    def __len__(self):
+        return len(self._buckets)
+
+class SharedTokenBuckets:
+    def take(self, key, capacity, window_seconds, cost=1):
+        return get_db().take_tokens(key, capacity, window_seconds, cost)
+
+local_rate_limits = TokenBuckets(RATE_LIMIT_MAX_KEYS)
+shared_rate_limits = SharedTokenBuckets()
+
+def rate_limit_backend():
+    return shared_rate_limits if RATE_LIMIT_BACKEND == "service" and DB_SERVICE_SOCKET else local_rate_limits
+
+async def check_rate_limit_async(route_class, subject, cost=1):
+    # The shared backend is a round trip to the database service: keep it off the loop
+    if rate_limit_backend() is shared_rate_limits:
+        return await run_in_threadpool(check_rate_limit, route_class, subject, cost)
+    return check_rate_limit(route_class, subject, cost)
+
+def check_rate_limit(route_class, subject, cost=1):
+    """Charge subject's bucket for route_class. Returns (allowed, headers), or None
+    when the class is not limited."""
+    limit = RATE_LIMITS.get(route_class)
+    if not RATE_LIMIT_ENABLED or limit is None:
+        return None
+    capacity, window = limit
+    key = f"{route_class}:{subject}"
+    try:
+        allowed, remaining, reset, retry_after = rate_limit_backend().take(key, capacity, window, cost)
+    except Exception as e:
+        # Service unreachable: limit per process rather than not at all
+        print(f"Shared rate limiter unavailable, using local buckets: {e}")
+        allowed, remaining, reset, retry_after = local_rate_limits.take(key, capacity, window, cost)
+    headers = {
+        "RateLimit-Limit": str(capacity),
+        "RateLimit-Remaining": str(remaining),
+        "RateLimit-Reset": str(math.ceil(reset)),
+        "RateLimit-Policy": f"{capacity};w={int(window)}",
+    }
+    if not allowed:
+        headers["Retry-After"] = str(max(1, math.ceil(retry_after)))
+    return allowed, headers
+
+def rate_limit_exceeded(headers):
+    return JSONResponse(status_code=429, headers=headers,
+                        content={"detail": "Too many requests. Please try again later."})
+
+def client_ip(request: Request):
+    if RATE_LIMIT_TRUST_FORWARDED:
+        forwarded = request.headers.get("x-forwarded-for")
+        if forwarded:
+            return forwarded.split(",")[0].strip()
+    return request.client.host if request.client else "unknown"
+
+def _rate_limit_class(method, path):
+    for route_method, prefix, route_class in RATE_LIMIT_ROUTES:
+        if (route_method is None or route_method == method) and path.startswith(prefix):
+            return route_class
+    return None
+
+def _rate_limit_subject(request: Request, route_class):
+    # Signed-in callers are limited per account, since a classroom may share one IP.
+    # Only the signature is checked here; the route still authenticates properly.
+    if route_class not in ("login", "register"):
+        auth_header = request.headers.get("authorization", "")
+        if auth_header.lower().startswith("bearer "):
+            try:
+                email = jwt.decode(auth_header[7:], SECRET_KEY, algorithms=[ALGORITHM]).get("sub")
+                if email:
+                    return "user:" + email
+            except JWTError:
+                pass
+    return "ip:" + client_ip(request)
+
+# Derivative pipeline: compressed audio renditions, waveform peaks and lyrics previews
+# are built in a process pool from a persistent job queue (derivative_jobs), with
+# retries and exponential backoff. ffmpeg, pdftotext/pdftoppm and pypdf are optional;
+# whatever isn't installed is simply skipped.
+DERIVATIVE_WORKERS = int(os.getenv("DERIVATIVE_WORKERS", "2"))
+DERIVATIVE_MAX_ATTEMPTS = int(os.getenv("DERIVATIVE_MAX_ATTEMPTS", "5"))
+DERIVATIVE_RETRY_SECONDS = int(os.getenv("DERIVATIVE_RETRY_SECONDS", "30"))
+DERIVATIVE_POLL_SECONDS = float(os.getenv("DERIVATIVE_POLL_SECONDS", "5"))
+WAVEFORM_PEAKS = 800
+PREVIEW_TEXT_CHARS = 2000
+
+# kind -> (mime type, file extension, ffmpeg codec arguments)
+AUDIO_RENDITIONS = {
+    "audio_opus": ("audio/ogg", ".opus", ["-c:a", "libopus", "-b:a", "48k", "-f", "ogg"]),
+    "audio_mp3": ("audio/mpeg", ".mp3", ["-c:a", "libmp3lame", "-b:a", "96k", "-f", "mp3"]),
+}
+
+derivative_pool = None
+derivative_wakeup = None
+
+def _run_tool(args):
+    result = subprocess.run(args, capture_output=True, timeout=600)
+    if result.returncode != 0:
+        raise RuntimeError(f"{os.path.basename(args[0])} failed: {result.stderr.decode('utf-8', 'replace')[-500:]}")
+    return result.stdout
+
+def _waveform_peaks(samples, sample_width):
+    # samples: signed PCM array; returns WAVEFORM_PEAKS normalised peak values
+    if not samples:
+        return []
+    full_scale = float(2 ** (8 * sample_width - 1))
+    bucket = max(1, len(samples) // WAVEFORM_PEAKS)
+    return [
+        round(max(abs(min(samples[i:i + bucket])), abs(max(samples[i:i + bucket]))) / full_scale, 3)
+        for i in range(0, len(samples), bucket)
+    ][:WAVEFORM_PEAKS]
+
+def _wav_peaks(content):
+    with wave.open(io.BytesIO(content)) as wav:
+        width, channels = wav.getsampwidth(), wav.getnchannels()
+        frames = wav.readframes(wav.getnframes())
+    if width not in (1, 2, 4):
+        return None
+    if width == 1:  # 8-bit WAV is unsigned
+        samples = array("h", (b - 128 for b in frames))
+    else:
+        samples = array("h" if width == 2 else "i", frames)
+    return _waveform_peaks(samples[::channels], width)
+
+def _docx_text(content):
+    with zipfile.ZipFile(io.BytesIO(content)) as docx:
+        xml = docx.read("word/document.xml").decode("utf-8")
+    paragraphs = re.findall(r"<w:p[ >].*?</w:p>", xml, flags=re.S)
+    return "\n".join("".join(re.findall(r"<w:t[^>]*>([^<]*)</w:t>", p)) for p in paragraphs)
+
+def build_material_derivatives(material_type, filename, content):
+    """Runs in a pool process. Returns a list of (kind, mime_type, bytes)."""
+    extension = os.path.splitext(filename or "")[1].lower()
+    derivatives = []
+    search_text = ""
+    ffmpeg = shutil.which("ffmpeg")
+
+    with tempfile.TemporaryDirectory(prefix="sloka-derivative-") as workdir:
+        source = os.path.join(workdir, "source" + extension)
+        with open(source, "wb") as f:
+            f.write(content)
+
+        if (material_type or "").startswith("recording"):
+            if ffmpeg:
+                for kind, (mime_type, _, codec_args) in AUDIO_RENDITIONS.items():
+                    output = _run_tool([ffmpeg, "-hide_banner", "-loglevel", "error", "-i", source,
+                                        "-vn", "-ac", "1"] + codec_args + ["pipe:1"])
+                    # Only keep renditions that actually save bytes
+                    if output and len(output) < len(content):
+                        derivatives.append((kind, mime_type, output))
+                pcm = _run_tool([ffmpeg, "-hide_banner", "-loglevel", "error", "-i", source,
+                                 "-ac", "1", "-ar", "8000", "-f", "s16le", "pipe:1"])
+                peaks = _waveform_peaks(array("h", pcm[:len(pcm) - len(pcm) % 2]), 2)
+            elif extension == ".wav":
+                peaks = _wav_peaks(content)
+            else:
+                peaks = None
+            if peaks:
+                derivatives.append(("waveform", "application/json", json.dumps(peaks).encode("utf-8")))
+
+        elif material_type == "lyrics":
+            # text: first page for the preview; full_text: the whole document for search
+            text = full_text = None
+            if extension in (".txt", ".md"):
+                text = full_text = content.decode("utf-8", "replace")
+            elif extension == ".docx":
+                text = full_text = _docx_text(content)
+            elif extension == ".pdf":
+                if PdfReader is not None:
+                    pages = [page.extract_text() or "" for page in PdfReader(io.BytesIO(content)).pages]
+                    text, full_text = (pages[0] if pages else None), "\n".join(pages)
+                elif shutil.which("pdftotext"):
+                    full_text = _run_tool(["pdftotext", "-enc", "UTF-8", source, "-"]).decode("utf-8", "replace")
+                    text = full_text.split("\f", 1)[0]
+                if shutil.which("pdftoppm"):
+                    target = os.path.join(workdir, "preview")
+                    _run_tool(["pdftoppm", "-png", "-f", "1", "-l", "1", "-scale-to", "800",
+                               "-singlefile", source, target])
+                    with open(target + ".png", "rb") as f:
+                        derivatives.append(("preview_image", "image/png", f.read()))
+            if text:
+                derivatives.append(("preview_text", "text/plain; charset=utf-8",
+                                    text.strip()[:PREVIEW_TEXT_CHARS].encode("utf-8")))
+            if full_text:
+                search_text = full_text
+
+    # Every material is searchable by filename; lyrics by their text as well
+    derivatives.append(("search_text", "text/plain; charset=utf-8",
+                        f"{filename or ''}\n{search_text}".encode("utf-8")))
+    return derivatives
+
+def enqueue_derivative_job(material_id):
+    conn = get_db()
+    conn.execute("""
+        INSERT INTO derivative_jobs (id, material_id, status) VALUES (?, ?, 'pending')
+    """, (*next_ids(conn, "derivative_jobs_id"), material_id))
+    if derivative_wakeup is not None:
+        derivative_wakeup.set()
+
+def _recover_derivative_jobs():
+    conn = get_db()
+    # Jobs interrupted by a restart go back to the queue
+    conn.execute("UPDATE derivative_jobs SET status = 'pending' WHERE status = 'running'")
+    # Backfill materials uploaded before the pipeline existed
+    missing = conn.execute("""
+        SELECT id FROM course_materials
+        WHERE id NOT IN (SELECT material_id FROM derivative_jobs)
+        ORDER BY id
+    """).fetchall()
+    # and materials processed before they were indexed for search
+    missing += conn.execute("""
+        SELECT material_id FROM derivative_jobs
+        WHERE material_id NOT IN (SELECT material_id FROM search_documents)
+          AND material_id IN (SELECT id FROM course_materials)
+        GROUP BY material_id
+        HAVING arg_max(status, id) = 'done'
+        ORDER BY material_id
+    """).fetchall()
+    for (material_id,) in missing:
+        enqueue_derivative_job(material_id)
+
+def _claim_derivative_job():
+    conn = get_db()
+    job = conn.execute("""
+        SELECT j.id, j.material_id, j.attempts, m.material_type, m.filename, m.content
+        FROM derivative_jobs j
+        JOIN course_materials m ON m.id = j.material_id
+        WHERE j.status = 'pending' AND j.next_attempt_at <= CURRENT_TIMESTAMP
+        ORDER BY j.id
+        LIMIT 1
+    """).fetchone()
+    if job:
+        conn.execute("""
+            UPDATE derivative_jobs SET status = 'running', updated_at = CURRENT_TIMESTAMP WHERE id = ?
+        """, (job[0],))
+    else:
+        # Jobs whose material was removed can never run
+        conn.execute("""
+            UPDATE derivative_jobs SET status = 'failed', last_error = 'Material not found'
+            WHERE status = 'pending' AND material_id NOT IN (SELECT id FROM course_materials)
+        """)
+    return job
+
+def _store_derivatives(job_id, material_id, derivatives):
+    conn = get_db()
+    # The extracted text goes to the search index rather than material_derivatives
+    search_text = [data for kind, _, data in derivatives if kind == "search_text"]
+    derivatives = [derivative for derivative in derivatives if derivative[0] != "search_text"]
+    conn.execute("BEGIN TRANSACTION")
+    try:
+        conn.execute("DELETE FROM material_derivatives WHERE material_id = ?", (material_id,))
+        if search_text:
+            index_material_text(conn, material_id, search_text[0].decode("utf-8"))
+        for derivative_id, (kind, mime_type, data) in zip(
+                next_ids(conn, "material_derivatives_id", len(derivatives)), derivatives):
+            conn.execute("""
+                INSERT INTO material_derivatives (id, material_id, kind, mime_type, content, size)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """, (derivative_id, material_id, kind, mime_type, data, len(data)))
+        conn.execute("""
+            UPDATE derivative_jobs SET status = 'done', last_error = NULL, updated_at = CURRENT_TIMESTAMP
+            WHERE id = ?
+        """, (job_id,))
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+def _fail_derivative_job(job_id, attempts, error):
+    status = "failed" if attempts >= DERIVATIVE_MAX_ATTEMPTS else "pending"
+    delay = DERIVATIVE_RETRY_SECONDS * 2 ** (attempts - 1)
+    get_db().execute("""
+        UPDATE derivative_jobs
+        SET status = ?, attempts = ?, last_error = ?, updated_at = CURRENT_TIMESTAMP,
+            next_attempt_at = CURRENT_TIMESTAMP + to_seconds(?)
+        WHERE id = ?
+    """, (status, attempts, str(error)[:1000], delay, job_id))
+
+async def _process_derivative_job(job, slots):
+    global derivative_pool
+    job_id, material_id, attempts, material_type, filename, content = job
+    try:
+        loop = asyncio.get_running_loop()
+        derivatives = await loop.run_in_executor(
+            derivative_pool, build_material_derivatives, material_type, filename, content
+        )
+        await run_in_threadpool(_store_derivatives, job_id, material_id, derivatives)
+    except Exception as e:
+        print(f"Derivative job {job_id} for material {material_id} failed: {e}")
+        if isinstance(e, BrokenProcessPool):
+            derivative_pool = ProcessPoolExecutor(max_workers=DERIVATIVE_WORKERS)
+        await run_in_threadpool(_fail_derivative_job, job_id, attempts + 1, e)
+    finally:
+        slots.release()
+
+async def run_derivative_worker():
+    global derivative_pool, derivative_wakeup
+    derivative_wakeup = asyncio.Event()
+    slots = asyncio.Semaphore(DERIVATIVE_WORKERS)
+    try:
+        await run_in_threadpool(_recover_derivative_jobs)
+        derivative_pool = ProcessPoolExecutor(max_workers=DERIVATIVE_WORKERS)
+        while True:
+            await slots.acquire()
+            job = await run_in_threadpool(_claim_derivative_job)
+            if job is None:
+                slots.release()
+                derivative_wakeup.clear()
+                try:
+                    await asyncio.wait_for(derivative_wakeup.wait(), DERIVATIVE_POLL_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            asyncio.create_task(_process_derivative_job(job, slots))
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        print(f"Derivative worker stopped: {e}")
+
+def _pick_rendition(material_id, rendition, formats, original_size):
+    """Returns (kind, mime_type) of the rendition to serve, or None for the original."""
+    if rendition == "original":
+        return None
+    derivatives = get_db().execute("""
+        SELECT kind, mime_type, size FROM material_derivatives
+        WHERE material_id = ? AND kind LIKE 'audio_%'
+        ORDER BY size
+    """, (material_id,)).fetchall()
+    if rendition != "auto":
+        for kind, mime_type, _ in derivatives:
+            if kind == rendition:
+                return kind, mime_type
+        raise HTTPException(status_code=404, detail="Rendition not available")
+    return _smallest_playable(derivatives, formats, original_size)
+
+def _smallest_playable(derivatives, formats, original_size):
+    # derivatives: (kind, mime_type, size) ordered by size
+    accepted = {f.strip() for f in (formats or "").split(",") if f.strip()}
+    for kind, mime_type, size in derivatives:
+        if mime_type in accepted and size < original_size:
+            return kind, mime_type
+    return None
+
+# Course bundles: one ZIP of a course's materials, written while it is sent. Each file
+# is read from its BLOB BUNDLE_CHUNK_BYTES at a time, so memory stays flat however
+# large the course. Recordings and already-compressed documents are stored as they
+# are; text is deflated, ahead of time when under BUNDLE_PRECOMPRESS_BYTES. Every size
+# is then known before the first byte, so the response carries a Content-Length
+# (browsers show progress) unless a large text file has to be deflated on the fly.
+# All reads share one transaction, so an upload or delete mid-download can't change
+# a file after its size was announced.
+BUNDLE_CHUNK_BYTES = int(os.getenv("BUNDLE_CHUNK_BYTES", str(2 * 1024 * 1024)))
+BUNDLE_PRECOMPRESS_BYTES = int(os.getenv("BUNDLE_PRECOMPRESS_BYTES", str(1024 * 1024)))
+# Deflate gains next to nothing on these (WAV included: PCM audio barely compresses)
+BUNDLE_STORED_EXTENSIONS = {
+    ".mp3", ".m4a", ".aac", ".ogg", ".opus", ".flac", ".wav", ".wma", ".webm", ".mp4",
+    ".pdf", ".docx", ".zip", ".gz", ".jpg", ".jpeg", ".png", ".gif", ".webp",
+}
+
+_ZIP_LOCAL_HEADER = struct.Struct("<IHHHHHIIIHH")
+_ZIP_DESCRIPTOR = struct.Struct("<IIII")
+_ZIP_CENTRAL_HEADER = struct.Struct("<IHHHHHHIIIHHHHHII")
+_ZIP_END = struct.Struct("<IHHHHIIH")
+_ZIP_UTF8 = 0x0800
+_ZIP_HAS_DESCRIPTOR = 0x0008
+_ZIP_LIMIT = 0xFFFFFFFF  # without Zip64 extensions
+
+class BundleEntry:
+    def __init__(self, name, table, row_id, size, modified, deflate):
+        self.name = name
+        self.table = table          # course_materials or material_derivatives
+        self.row_id = row_id
+        self.size = size
+        self.modified = modified
+        self.deflate = deflate
+        self.data = None            # deflated ahead of time
+        self.crc = 0
+
+    @property
+    def compressed_size(self):
+        if self.data is not None:
+            return len(self.data)
+        return None if self.deflate else self.size
+
+    def dos_time(self):
+        modified = max(self.modified or datetime(1980, 1, 1), datetime(1980, 1, 1))
+        return (modified.hour << 11 | modified.minute << 5 | modified.second // 2,
+                (modified.year - 1980) << 9 | modified.month << 5 | modified.day)
+
+def _bundle_name(material_type, filename, material_id, extension, taken):
+    base = os.path.basename((filename or "").replace("\\", "/")).strip().lstrip(".") or f"material-{material_id}"
+    if extension:
+        base = os.path.splitext(base)[0] + extension
+    folder = "lyrics" if material_type == "lyrics" else "recordings"
+    stem, ext = os.path.splitext(base)
+    name, copy = f"{folder}/{base}", 2
+    while name.lower() in taken:
+        name = f"{folder}/{stem} ({copy}){ext}"
+        copy += 1
+    taken.add(name.lower())
+    return name
+
+def plan_course_bundle(cursor, course_id, material_ids=None, rendition="original", formats=None):
+    """Entries for the bundle, read on cursor (which should hold the transaction the
+    bundle is then streamed from)."""
+    query = """
+        SELECT id, material_type, filename, uploaded_at, octet_length(content)
+        FROM course_materials WHERE course_id = ?
+    """
+    params = [course_id]
+    if material_ids:
+        query += f" AND id IN ({', '.join('?' for _ in material_ids)})"
+        params.extend(material_ids)
+    materials = cursor.execute(query + " ORDER BY material_type, uploaded_at DESC", params).fetchall()
+    if material_ids and len(materials) != len(set(material_ids)):
+        raise HTTPException(status_code=404, detail="Material not found in this course")
+    
+    renditions = {}
+    if rendition == "auto" and materials:
+        for material_id, derivative_id, kind, mime_type, size in cursor.execute(f"""
+            SELECT material_id, id, kind, mime_type, size FROM material_derivatives
+            WHERE material_id IN ({', '.join('?' for _ in materials)}) AND kind LIKE 'audio_%'
+            ORDER BY size
+        """, [material[0] for material in materials]).fetchall():
+            renditions.setdefault(material_id, []).append((kind, mime_type, size, derivative_id))
+    
+    entries = []
+    taken = set()
+    for material_id, material_type, filename, uploaded_at, size in materials:
+        derivatives = renditions.get(material_id, [])
+        chosen = _smallest_playable([d[:3] for d in derivatives], formats, size) if derivatives else None
+        if chosen is not None:
+            kind, _, derivative_size, derivative_id = next(d for d in derivatives if d[0] == chosen[0])
+            name = _bundle_name(material_type, filename, material_id, AUDIO_RENDITIONS[kind][1], taken)
+            entries.append(BundleEntry(name, "material_derivatives", derivative_id, derivative_size, uploaded_at, False))
+            continue
+        name = _bundle_name(material_type, filename, material_id, None, taken)
+        deflate = os.path.splitext(name)[1].lower() not in BUNDLE_STORED_EXTENSIONS
+        entries.append(BundleEntry(name, "course_materials", material_id, size or 0, uploaded_at, deflate))
+    
+    for entry in entries:
+        if entry.deflate and entry.size <= BUNDLE_PRECOMPRESS_BYTES:
+            content = cursor.execute(f"SELECT content FROM {entry.table} WHERE id = ?", (entry.row_id,)).fetchone()[0] or b""
+            compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+            data = compressor.compress(content) + compressor.flush()
+            entry.crc = zlib.crc32(content)
+            if len(data) < len(content):
+                entry.data = data
+            else:
+                entry.deflate = False
+    return entries
+
+def bundle_length(entries):
+    """Exact size of the ZIP, or None while a deflated size is still unknown."""
+    total = _ZIP_END.size
+    for entry in entries:
+        if entry.compressed_size is None:
+            return None
+        name = len(entry.name.encode("utf-8"))
+        total += _ZIP_LOCAL_HEADER.size + name + entry.compressed_size + _ZIP_CENTRAL_HEADER.size + name
+        if entry.data is None:
+            total += _ZIP_DESCRIPTOR.size
+    return total
+
+def _blob_chunks(cursor, entry):
+    for start in range(1, entry.size + 1, BUNDLE_CHUNK_BYTES):
+        # BLOB slices are 1-based and inclusive
+        yield cursor.execute(f"SELECT content[?:?] FROM {entry.table} WHERE id = ?",
+                             (start, start + BUNDLE_CHUNK_BYTES - 1, entry.row_id)).fetchone()[0]
+
+def stream_bundle(cursor, entries, on_close):
+    # Local headers carry no sizes when they aren't known up front (flag bit 3); the
+    # data descriptor after the file and the central directory have them
+    offset = 0
+    directory = []
+    try:
+        for entry in entries:
+            name = entry.name.encode("utf-8")
+            method = zipfile.ZIP_DEFLATED if entry.deflate else zipfile.ZIP_STORED
+            dos_time, dos_date = entry.dos_time()
+            header_offset = offset
+            if entry.data is not None:
+                flags = _ZIP_UTF8
+                header = _ZIP_LOCAL_HEADER.pack(0x04034b50, 20, flags, method, dos_time, dos_date,
+                                                entry.crc, len(entry.data), entry.size, len(name), 0)
+                yield header + name
+                yield entry.data
+                crc, compressed = entry.crc, len(entry.data)
+                offset += len(header) + len(name) + compressed
+            else:
+                flags = _ZIP_UTF8 | _ZIP_HAS_DESCRIPTOR
+                header = _ZIP_LOCAL_HEADER.pack(0x04034b50, 20, flags, method, dos_time, dos_date, 0, 0, 0, len(name), 0)
+                yield header + name
+                crc = compressed = 0
+                compressor = zlib.compressobj(6, zlib.DEFLATED, -15) if entry.deflate else None
+                for chunk in _blob_chunks(cursor, entry):
+                    crc = zlib.crc32(chunk, crc)
+                    if compressor is not None:
+                        chunk = compressor.compress(chunk)
+                    if chunk:
+                        compressed += len(chunk)
+                        yield chunk
+                if compressor is not None:
+                    tail = compressor.flush()
+                    compressed += len(tail)
+                    yield tail
+                yield _ZIP_DESCRIPTOR.pack(0x08074b50, crc, compressed, entry.size)
+                offset += len(header) + len(name) + compressed + _ZIP_DESCRIPTOR.size
+            if offset > _ZIP_LIMIT:
+                raise RuntimeError("Bundle exceeds 4 GB")
+            directory.append(_ZIP_CENTRAL_HEADER.pack(
+                0x02014b50, 3 << 8 | 20, 20, flags, method, dos_time, dos_date, crc, compressed, entry.size,
+                len(name), 0, 0, 0, 0, 0o100644 << 16, header_offset  # made on Unix: regular file, rw-r--r--
+            ) + name)
+        central = b"".join(directory)
+        yield central + _ZIP_END.pack(0x06054b50, 0, 0, len(directory), len(directory), len(central), offset, 0)
+    finally:
+        on_close()
+
+# Full-text search. The derivative pipeline extracts each material's text (filename,
+# plus the whole document for lyrics) and index_material_text stores one posting per
+# (term, material) in search_postings. Terms are spelling-folded keys, so IAST
+# ("śravaṇaṃ"), Harvard-Kyoto ("zravaNaM"), Devanagari ("श्रवणं") and casual ASCII
+# ("shravanam") all index and search as "sravanam". Results are ranked with BM25.
+SEARCH_RESULT_LIMIT = 50
+SEARCH_SNIPPET_CHARS = 200
+SEARCH_PREFIX_MIN = 4
+SEARCH_PREFIX_WEIGHT = 0.5
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+DEVANAGARI_CONSONANTS = dict(zip(
+    "कखगघङचछजझञटठडढणतथदधनपफबभमयरलवशषसहळ",
+    ["k", "kh", "g", "gh", "ṅ", "c", "ch", "j", "jh", "ñ", "ṭ", "ṭh", "ḍ", "ḍh", "ṇ", "t", "th", "d", "dh", "n",
+     "p", "ph", "b", "bh", "m", "y", "r", "l", "v", "ś", "ṣ", "s", "h", "ḷ"]
+))
+DEVANAGARI_VOWELS = dict(zip("अआइईउऊऋॠऌएऐओऔ", ["a", "ā", "i", "ī", "u", "ū", "ṛ", "ṝ", "ḷ", "e", "ai", "o", "au"]))
+DEVANAGARI_VOWEL_SIGNS = dict(zip("ािीुूृॄॢेैोौ", ["ā", "i", "ī", "u", "ū", "ṛ", "ṝ", "ḷ", "e", "ai", "o", "au"]))
+DEVANAGARI_MARKS = {"ं": "ṃ", "ँ": "ṃ", "ः": "ḥ", "ऽ": "'", **{chr(0x966 + d): str(d) for d in range(10)}}
+DEVANAGARI_VIRAMA = "्"
+DEVANAGARI_NUKTA = "़"
+
+HARVARD_KYOTO = {"lRR": "ḹ", "lR": "ḷ", "RR": "ṝ", "R": "ṛ", "A": "ā", "I": "ī", "U": "ū", "M": "ṃ", "H": "ḥ",
+                 "G": "ṅ", "J": "ñ", "T": "ṭ", "D": "ḍ", "N": "ṇ", "z": "ś", "S": "ṣ"}
+_HARVARD_KYOTO_PATTERN = re.compile("lRR|lR|RR|[RAIUMHGJTDNzS]")
+# z anywhere, or a Harvard-Kyoto capital after the first letter ("kRSNa", "zrI")
+_HARVARD_KYOTO_HINT = re.compile(r"z|.[RAIUMHGJTDNS]")
+# Words, including Devanagari vowel signs and virama (but not the danda)
+_SEARCH_WORD = re.compile(r"(?:[^\W_]|[ऀ-ॣ०-ॿ])+")
+
+def devanagari_to_iast(text):
+    out = []
+    i = 0
+    while i < len(text):
+        ch = text[i]
+        i += 1
+        if ch not in DEVANAGARI_CONSONANTS:
+            out.append(DEVANAGARI_VOWELS.get(ch) or DEVANAGARI_MARKS.get(ch) or ch)
+            continue
+        out.append(DEVANAGARI_CONSONANTS[ch])
+        if i < len(text) and text[i] == DEVANAGARI_NUKTA:
+            i += 1
+        if i < len(text) and text[i] in DEVANAGARI_VOWEL_SIGNS:
+            out.append(DEVANAGARI_VOWEL_SIGNS[text[i]])
+            i += 1
+        elif i < len(text) and text[i] == DEVANAGARI_VIRAMA:
+            i += 1
+        else:
+            out.append("a")  # inherent vowel
+    return "".join(out)
+
+def _fold_spelling(word):
+    # IAST -> lowercase ASCII, then merge the common casual spellings: ṛ/ri, ś/ṣ/sh,
+    # c/ch, v/w, ī/ee, ū/oo and doubled letters
+    word = unicodedata.normalize("NFD", word.lower())
+    word = re.sub("r\u0323\u0304?", "ri", word)  # ṛ and ṝ after NFD
+    word = "".join(c for c in word if not unicodedata.combining(c))
+    word = word.replace("sh", "s").replace("ch", "c").replace("w", "v").replace("ee", "i").replace("oo", "u")
+    return re.sub(r"([a-z])\1+", r"\1", re.sub(r"[^a-z0-9]", "", word))
+
+def search_keys(word):
+    """Index keys for one word: its folded spelling, plus the Harvard-Kyoto reading
+    when the word looks like Harvard-Kyoto."""
+    word = devanagari_to_iast(word)
+    keys = {_fold_spelling(word)}
+    if not word.isupper() and _HARVARD_KYOTO_HINT.search(word):
+        keys.add(_fold_spelling(_HARVARD_KYOTO_PATTERN.sub(lambda m: HARVARD_KYOTO[m.group()], word)))
+    keys.discard("")
+    return keys
+
+def _search_words(text):
+    return _SEARCH_WORD.finditer(unicodedata.normalize("NFC", text))
+
+def index_material_text(conn, material_id, text):
+    """Replace the material's postings; called inside the derivative store transaction."""
+    text = unicodedata.normalize("NFC", text)
+    terms = Counter()
+    length = 0
+    for match in _search_words(text):
+        length += 1
+        terms.update(search_keys(match.group()))
+    conn.execute("DELETE FROM search_postings WHERE material_id = ?", (material_id,))
+    conn.execute("DELETE FROM search_documents WHERE material_id = ?", (material_id,))
+    conn.execute("""
+        INSERT INTO search_documents (material_id, course_id, length, text)
+        SELECT id, course_id, ?, ? FROM course_materials WHERE id = ?
+    """, (length, text, material_id))
+    postings = list(terms.items())
+    for offset in range(0, len(postings), 500):
+        rows = postings[offset:offset + 500]
+        conn.execute(f"""
+            INSERT INTO search_postings (term, material_id, tf)
+            VALUES {", ".join(["(?, ?, ?)"] * len(rows))}
+        """, [value for term, tf in rows for value in (term, material_id, tf)])
+
+def _search_term_matches(term, keys):
+    # Sanskrit words inflect ("kṛṣṇa", "kṛṣṇāya"), so longer query words also match as prefixes
+    return term in keys or any(len(key) >= SEARCH_PREFIX_MIN and term.startswith(key) for key in keys)
 
-def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
-    credentials_exception = HTTPException(
-        status_code=401,
-        detail="Could not validate credentials",
-        headers={"WWW-Authenticate": "Bearer"},
-    )
+def _search_snippet(text, keys):
+    """Returns (snippet, highlights) around the first matching word; highlights are
+    [start, end) offsets into the snippet."""
+    matches = [(m.start(), m.end()) for m in _search_words(text)
+               if any(_search_term_matches(term, keys) for term in search_keys(m.group()))]
+    if not matches:
+        return text[:SEARCH_SNIPPET_CHARS], []
+    start = max(0, matches[0][0] - SEARCH_SNIPPET_CHARS // 4)
+    if start:
+        # Begin on a word boundary
+        boundary = text.rfind(" ", 0, start)
+        start = boundary + 1 if boundary >= 0 and start - boundary < 20 else start
+    end = min(len(text), start + SEARCH_SNIPPET_CHARS)
+    return text[start:end], [[s - start, e - start] for s, e in matches if s >= start and e <= end]
+
+def search_materials(conn, query, current_user, course_id=None, limit=20):
+    query_keys = set()
+    for match in _search_words(query):
+        query_keys |= search_keys(match.group())
+    if not query_keys:
+        return []
+    terms = sorted(query_keys)
+    filters, params = "", []
+    if course_id is not None:
+        filters += " AND d.course_id = ?"
+        params.append(course_id)
+    if not current_user[5]:  # Students only search their assigned courses
+        course_ids = course_catalog.course_ids_for(current_user[0])
+        if not course_ids:
+            return []
+        filters += f" AND d.course_id IN ({', '.join('?' * len(course_ids))})"
+        params += course_ids
+    # BM25 over every indexed term the query words match, prefix matches weighted down.
+    # df is counted before the course filters, so scores don't depend on who asks.
+    ranked = conn.execute(f"""
+        WITH corpus AS (
+            SELECT COUNT(*) AS n, GREATEST(AVG(length), 1) AS avgdl FROM search_documents
+        ), query_terms AS (
+            SELECT * FROM (VALUES {", ".join(["(?)"] * len(terms))}) AS q(key)
+        ), matched AS (
+            SELECT p.term, p.material_id, p.tf,
+                   MAX(CASE WHEN p.term = q.key THEN 1.0 ELSE {SEARCH_PREFIX_WEIGHT} END) AS weight
+            FROM search_postings p
+            JOIN query_terms q
+              ON p.term = q.key OR (length(q.key) >= {SEARCH_PREFIX_MIN} AND starts_with(p.term, q.key))
+            GROUP BY p.term, p.material_id, p.tf
+        ), scored AS (
+            SELECT *, COUNT(*) OVER (PARTITION BY term) AS df FROM matched
+        )
+        SELECT d.material_id, d.course_id,
+               SUM(s.weight * ln(1 + (corpus.n - s.df + 0.5) / (s.df + 0.5))
+                   * s.tf * ({BM25_K1} + 1)
+                   / (s.tf + {BM25_K1} * (1 - {BM25_B} + {BM25_B} * d.length / corpus.avgdl))) AS score
+        FROM scored s
+        JOIN search_documents d ON d.material_id = s.material_id
+        CROSS JOIN corpus
+        WHERE TRUE {filters}
+        GROUP BY d.material_id, d.course_id
+        ORDER BY score DESC, d.material_id
+        LIMIT ?
+    """, [*terms, *params, limit]).fetchall()
+    if not ranked:
+        return []
+
+    ids = [row[0] for row in ranked]
+    details = {row[0]: row[1:] for row in conn.execute(f"""
+        SELECT d.material_id, m.filename, m.material_type, c.name, d.text
+        FROM search_documents d
+        JOIN course_materials m ON m.id = d.material_id
+        JOIN courses c ON c.id = d.course_id
+        WHERE d.material_id IN ({", ".join("?" * len(ids))})
+    """, ids).fetchall()}
+    results = []
+    for material_id, result_course_id, score in ranked:
+        if material_id not in details:
+            continue
+        filename, material_type, course_name, text = details[material_id]
+        # The indexed text starts with the filename line; show the document itself
+        body = text.split("\n", 1)[1] if "\n" in text else text
+        snippet, highlights = _search_snippet(body, query_keys)
+        results.append({
+            "material_id": material_id,
+            "course_id": result_course_id,
+            "course_name": course_name,
+            "filename": filename,
+            "material_type": material_type,
+            "score": round(score, 4),
+            "snippet": snippet,
+            "highlights": highlights
+        })
+    return results
+
+# Rate-limit middleware: runs inside the diagnostics middleware, so a 429 still
+# carries Server-Timing
+@app.middleware("http")
+async def rate_limit_requests(request: Request, call_next):
+    route_class = _rate_limit_class(request.method, request.url.path)
+    result = await check_rate_limit_async(route_class, _rate_limit_subject(request, route_class)) if route_class else None
+    if result is None:
+        return await call_next(request)
+    allowed, headers = result
+    if not allowed:
+        return rate_limit_exceeded(headers)
+    response = await call_next(request)
+    # A route that hit a tighter limit of its own (login per account) reports that one
+    if "ratelimit-limit" not in response.headers:
+        response.headers.update(headers)
+    return response
+
+# Diagnostics middleware: Server-Timing breakdown on every response, plus the
+# opt-in profiler
+@app.middleware("http")
+async def request_diagnostics(request: Request, call_next):
+    global _profile_counter
+    stats = {"path": request.url.path}
+    token = _request_stats.set(stats)
+    profiler = None
+    mode = _profile_requested(request)
+    if mode and _profiler_lock.acquire(blocking=False):
+        if mode == "armed":
+            profiling_state["remaining"] -= 1
+        profiler = RequestProfiler()
+        profiler.start()
+    start = time.perf_counter()
     try:
-        payload = jwt.decode(credentials.credentials, SECRET_KEY, algorithms=[ALGORITHM])
-        email: str = payload.get("sub")
-        if email is None:
-            raise credentials_exception
-    except JWTError:
-        raise credentials_exception
-    
-    conn = get_db()
-    user = conn.execute("""
-        SELECT id, first_name, last_name, email, password_hash, is_admin 
-        FROM users 
-        WHERE email = ?
-    """, (email,)).fetchone()
-    
-    if user is None:
-        raise credentials_exception
-    return user
+        response = await call_next(request)
+    finally:
+        _request_stats.reset(token)
+        profile_data = None
+        if profiler is not None:
+            try:
+                profile_data = profiler.stop()
+            finally:
+                _profiler_lock.release()
+    total_ms = (time.perf_counter() - start) * 1000
+
+    timings = [f'db;dur={stats.get("db_ms", 0.0):.1f};desc="{stats.get("db_count", 0)} queries"']
+    if "hash_ms" in stats:
+        timings.append(f'hash;dur={stats["hash_ms"]:.1f}')
+    timings.append(f"total;dur={total_ms:.1f}")
+
+    if profile_data is not None:
+        _profile_counter += 1
+        profile_history.append({
+            "id": _profile_counter,
+            "path": request.url.path,
+            "method": request.method,
+            "status": response.status_code,
+            "duration_ms": round(total_ms, 2),
+            "format": profiler.format,
+            "captured_at": datetime.utcnow().isoformat(),
+            "data": profile_data
+        })
+        if mode == "header":
+            response = _profile_response(_profile_counter, profiler.format, profile_data, response.status_code)
+        response.headers["X-Profile-Id"] = str(_profile_counter)
+
+    response.headers["Server-Timing"] = ", ".join(timings)
+    return response
 
 # Routes
 
@@ -247,13 +4858,20 @@ async def admin_dashboard(request: Request):
 async def course_page(request: Request, course_id: int):
     return templates.TemplateResponse("course.html", {"request": request, "course_id": course_id})
 
+@app.get("/sw.js")
+async def service_worker():
+    # Served from the root so the worker's scope covers every page
+    return FileResponse("static/js/sw.js", media_type="application/javascript",
+                        headers={"Cache-Control": "no-cache"})
+
 @app.get("/error", response_class=HTMLResponse)
 async def error_page(request: Request):
     return templates.TemplateResponse("error.html", {"request": request})
 
 # API Routes
 @app.post("/api/register")
-async def register(user: UserCreate):
+@idempotent
+def register(user: UserCreate):
     try:
         conn = get_db()
         
@@ -269,38 +4887,61 @@ async def register(user: UserCreate):
         # Create new user
         password_hash = get_password_hash(user.password)
         # Get next user ID
-        max_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM users").fetchone()[0]
-        next_id = max_id + 1
-        conn.execute("""
-            INSERT INTO users (id, first_name, last_name, email, password_hash, is_admin) 
-            VALUES (?, ?, ?, ?, ?, ?)
-        """, (next_id, user.first_name, user.last_name, user.email, password_hash, False))
+        next_id = conn.execute("SELECT nextval('users_id')").fetchone()[0]
+        conn.execute("BEGIN")
+        try:
+            conn.execute("""
+                INSERT INTO users (id, first_name, last_name, email, password_hash, is_admin) 
+                VALUES (?, ?, ?, ?, ?, ?)
+            """, (next_id, user.first_name, user.last_name, user.email, password_hash, False))
+            record_changes(conn, "users", [next_id])
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        event_bus.publish("student_added", {
+            "id": next_id, "first_name": user.first_name, "last_name": user.last_name,
+            "email": user.email, "assigned_courses": "", "total_practice_time": 0
+        })
         
         return {"message": "User registered successfully"}
     except Exception as e:
         return JSONResponse(status_code=500, content={"detail": str(e)})
 
 @app.post("/api/login")
-async def login(user: UserLogin):
+def login(user: UserLogin, background_tasks: BackgroundTasks):
+    # Checked before the lookup, so guessing one account's password can't keep PBKDF2
+    # busy from many addresses. Only failed attempts are charged, so signing in often
+    # (several devices, a shared classroom login) never locks the owner out
+    account = user.email.lower()
+    throttled = check_rate_limit("login_account", account, cost=0)
+    if throttled is not None and not throttled[0]:
+        return rate_limit_exceeded(throttled[1])
     try:
         conn = get_db()
         db_user = conn.execute("""
             SELECT id, first_name, last_name, email, password_hash, is_admin 
             FROM users 
-            WHERE email = ?
+            WHERE email = ? AND deleted_at IS NULL
         """, (user.email,)).fetchone()
         
         if not db_user or not verify_password(user.password, db_user[4]):
+            check_rate_limit("login_account", account)
             raise HTTPException(status_code=401, detail="Invalid credentials")
+        if password_needs_rehash(db_user[4]):
+            background_tasks.add_task(rehash_password, db_user[0], db_user[4], user.password)
         
         access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
         access_token = create_access_token(
             data={"sub": user.email}, expires_delta=access_token_expires
         )
+        refresh_token = create_refresh_session(conn, db_user[0])
         
         return {
             "access_token": access_token,
             "token_type": "bearer",
+            "expires_in": ACCESS_TOKEN_EXPIRE_MINUTES * 60,
+            "refresh_token": refresh_token,
             "user": {
                 "id": db_user[0],
                 "first_name": db_user[1],
@@ -312,21 +4953,60 @@ async def login(user: UserLogin):
     except Exception as e:
         return JSONResponse(status_code=500, content={"detail": str(e)})
 
-@app.get("/api/courses")
-async def get_courses(current_user: tuple = Depends(get_current_user)):
+class RefreshTokenRequest(BaseModel):
+    refresh_token: str
+
+@app.post("/api/token/refresh")
+def refresh_access_token(request: RefreshTokenRequest):
     try:
         conn = get_db()
+        db_user, refresh_token = rotate_refresh_session(conn, request.refresh_token)
+        access_token = create_access_token(
+            data={"sub": db_user[3]}, expires_delta=timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+        )
+        response = {
+            "access_token": access_token,
+            "token_type": "bearer",
+            "expires_in": ACCESS_TOKEN_EXPIRE_MINUTES * 60
+        }
+        if refresh_token is not None:
+            response["refresh_token"] = refresh_token
+        return response
+    except HTTPException:
+        raise
+    except Exception as e:
+        return JSONResponse(status_code=500, content={"detail": str(e)})
+
+@app.post("/api/logout")
+def logout(request: RefreshTokenRequest):
+    try:
+        revoke_refresh_session(get_db(), request.refresh_token)
+        return {"message": "Logged out"}
+    except Exception as e:
+        return JSONResponse(status_code=500, content={"detail": str(e)})
+
+# Plain def: runs in the threadpool, so identical concurrent requests can coalesce
+@app.get("/api/courses")
+@coalesce(per_user=True)
+def get_courses(since: Optional[int] = None, current_user: tuple = Depends(get_current_user)):
+    try:
+        changes = None
+        if since is not None:
+            version, changes = changes_since(get_db(), since, ["student_courses"], key_prefix=f"{current_user[0]}:")
         
-        if current_user[5]:  # is_admin
-            courses = conn.execute("SELECT * FROM courses ORDER BY name").fetchall()
+        if changes is not None:
+            # Delta: courses assigned or unassigned since the client's version (the
+            # catalogue itself isn't edited through the API, so admins only get full lists)
+            if current_user[5]:
+                return delta_response(version, [], [])
+            deleted = sorted(int(key.split(":")[1]) for (_, key), op in changes.items() if op == "delete")
+            added = {int(key.split(":")[1]) for (_, key), op in changes.items() if op == "upsert"}
+            courses = [course for course in course_catalog.courses_for(current_user[0]) if course[0] in added]
+        elif current_user[5]:  # is_admin
+            courses = course_catalog.courses()
         else:
             # Get only assigned courses for students
-            courses = conn.execute("""
-                SELECT c.* FROM courses c
-                JOIN student_courses sc ON c.id = sc.course_id
-                WHERE sc.student_id = ?
-                ORDER BY c.name
-            """, (current_user[0],)).fetchall()
+            courses = course_catalog.courses_for(current_user[0])
         
         
         course_list = []
@@ -338,46 +5018,85 @@ async def get_courses(current_user: tuple = Depends(get_current_user)):
                 "created_at": str(course[3])
             })
         
-        return course_list
+        if since is None:
+            return course_list
+        if changes is None:
+            return full_response(version, course_list)
+        return delta_response(version, course_list, deleted)
     except Exception as e:
         return JSONResponse(status_code=500, content={"detail": str(e)})
 
 @app.get("/api/students")
-async def get_students(current_user: tuple = Depends(get_current_user)):
+async def get_students(response: Response, max_staleness: Optional[int] = None, since: Optional[int] = None,
+                       current_user: tuple = Depends(get_current_user)):
     try:
         if not current_user[5]:  # Not admin
             raise HTTPException(status_code=403, detail="Admin access required")
         
         conn = get_db()
-        # First get all students
-        students_basic = conn.execute("""
-            SELECT id, first_name, last_name, email
-            FROM users
-            WHERE is_admin = FALSE
-            ORDER BY first_name, last_name
-        """).fetchall()
+        changes = None
+        course_names = None
+        if since is not None:
+            version, changes = changes_since(
+                conn, since, ["users", "student_courses", "time_tracking", "time_tracking_rollups"]
+            )
+        
+        if changes is not None:
+            # Delta: only students touched since the client's version, with live totals
+            deleted = sorted(int(key) for (table, key), op in changes.items() if table == "users" and op == "delete")
+            student_ids = sorted({int(key.split(":")[0]) for _, key in changes} - set(deleted))
+            if not student_ids:
+                return delta_response(version, [], deleted)
+            id_list = ", ".join("?" * len(student_ids))
+            totals = dict(conn.execute(f"""
+                SELECT student_id, SUM(total) FROM (
+                    SELECT student_id, SUM(duration) AS total FROM time_tracking
+                    WHERE student_id IN ({id_list}) GROUP BY student_id
+                    UNION ALL
+                    SELECT student_id, SUM(total_duration) FROM time_tracking_rollups
+                    WHERE student_id IN ({id_list}) GROUP BY student_id
+                ) GROUP BY student_id
+            """, student_ids + student_ids).fetchall())
+            students_basic = conn.execute(f"""
+                SELECT id, first_name, last_name, email
+                FROM users
+                WHERE is_admin = FALSE AND deleted_at IS NULL AND id IN ({id_list})
+                ORDER BY first_name, last_name
+            """, student_ids).fetchall()
+        else:
+            # Practice totals scan every time entry, so they come from the analytics snapshot
+            analytics = analytics_db(response, max_staleness)
+            source, tables = analytics_cache_tags(response, analytics, ("time_tracking", "time_tracking_rollups"))
+            totals = query_cache.get_or_load("get_students.totals", source, tables, lambda: dict(analytics.execute("""
+                SELECT student_id, SUM(total) FROM (
+                    SELECT student_id, SUM(duration) AS total FROM time_tracking GROUP BY student_id
+                    UNION ALL
+                    SELECT student_id, SUM(total_duration) FROM time_tracking_rollups GROUP BY student_id
+                ) GROUP BY student_id
+            """).fetchall()))
+
+            # First get all students
+            students_basic = query_cache.get_or_load("get_students.roster", None, ("users",), lambda: conn.execute("""
+                SELECT id, first_name, last_name, email
+                FROM users
+                WHERE is_admin = FALSE AND deleted_at IS NULL
+                ORDER BY first_name, last_name
+            """).fetchall())
+            course_names = query_cache.get_or_load("get_students.courses", None, ("student_courses", "courses"),
+                                                   lambda: _assigned_course_names_by_student(conn))
         
         student_list = []
         for student in students_basic:
             student_id = student[0]
             
             # Get assigned courses
-            courses = conn.execute("""
-                SELECT c.name
-                FROM student_courses sc
-                JOIN courses c ON sc.course_id = c.id
-                WHERE sc.student_id = ?
-                ORDER BY c.name
-            """, (student_id,)).fetchall()
-            
-            # Get total practice time
-            total_time = conn.execute("""
-                SELECT COALESCE(SUM(duration), 0)
-                FROM time_tracking
-                WHERE student_id = ?
-            """, (student_id,)).fetchone()[0]
+            if course_names is not None:
+                assigned_courses = course_names.get(student_id, "")
+            else:
+                assigned_courses = _assigned_course_names(conn, student_id)
             
-            assigned_courses = ", ".join([course[0] for course in courses]) if courses else ""
+            # Total practice time (hot entries plus archived monthly rollups)
+            total_time = totals.get(student_id, 0)
             
             student_list.append({
                 "id": student[0],
@@ -388,84 +5107,257 @@ async def get_students(current_user: tuple = Depends(get_current_user)):
                 "total_practice_time": total_time or 0
             })
         
-        return student_list
+        if since is None:
+            return student_list
+        if changes is None:
+            return full_response(version, student_list)
+        return delta_response(version, student_list, deleted)
 
     except Exception as e:
         return JSONResponse(status_code=500, content={"detail": str(e)})
 
+def _course_assigned(conn, student_id, course_id):
+    return conn.execute("SELECT 1 FROM student_courses WHERE student_id = ? AND course_id = ?",
+                        (student_id, course_id)).fetchone() is not None
+
+def _assignment_refs_exist(conn, student_id, course_id):
+    """Whether a constraint error on assigning was the (student_id, course_id) index, which
+    also fires against a concurrent, still uncommitted assign, rather than a foreign key."""
+    return conn.execute("""
+        SELECT EXISTS (SELECT 1 FROM users WHERE id = ?) AND EXISTS (SELECT 1 FROM courses WHERE id = ?)
+    """, (student_id, course_id)).fetchone()[0]
+
 @app.post("/api/assign-course")
-async def assign_course(student_id: int = Form(...), course_id: int = Form(...), current_user: tuple = Depends(get_current_user)):
+@idempotent
+def assign_course(student_id: int = Form(...), course_id: int = Form(...), current_user: tuple = Depends(get_current_user)):
     try:
         if not current_user[5]:  # Not admin
             raise HTTPException(status_code=403, detail="Admin access required")
         
         conn = get_db()
         
-        # Check if assignment already exists
-        existing = conn.execute("""
-            SELECT * FROM student_courses WHERE student_id = ? AND course_id = ?
-        """, (student_id, course_id)).fetchone()
-        
-        if not existing:
-            # Get next ID
-            max_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM student_courses").fetchone()[0]
-            next_id = max_id + 1
+        # The unique (student_id, course_id) index is the guard: a repeat fails the
+        # INSERT, and a concurrent assign of the same pair fails the later COMMIT
+        conn.execute("BEGIN")
+        try:
             conn.execute("""
                 INSERT INTO student_courses (id, student_id, course_id) VALUES (?, ?, ?)
-            """, (next_id, student_id, course_id))
+            """, (*next_ids(conn, "student_courses_id"), student_id, course_id))
+            record_changes(conn, "student_courses", [f"{student_id}:{course_id}"])
+        except duckdb.ConstraintException:
+            conn.execute("ROLLBACK")
+            if not _assignment_refs_exist(conn, student_id, course_id):
+                raise  # an unknown student or course
+            return {"message": "Course assigned successfully"}
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        try:
+            conn.execute("COMMIT")
+        except duckdb.TransactionException:
+            # The failed COMMIT has rolled back
+            if not _course_assigned(conn, student_id, course_id):
+                raise
+            return {"message": "Course assigned successfully"}
+        course_catalog.assign(student_id, course_id)
+        event_bus.publish("assignments_changed", {
+            "student_id": student_id, "assigned_courses": _assigned_course_names(conn, student_id)
+        })
         
         return {"message": "Course assigned successfully"}
     except Exception as e:
         return JSONResponse(status_code=500, content={"detail": str(e)})
 
 @app.post("/api/time-tracking")
-async def save_time_entry(time_entry: TimeEntry, current_user: tuple = Depends(get_current_user)):
+@idempotent
+def save_time_entry(time_entry: TimeEntry, current_user: tuple = Depends(get_current_user)):
     try:
         conn = get_db()
         
-        # Get next ID
-        max_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM time_tracking").fetchone()[0]
-        next_id = max_id + 1
-        conn.execute("""
-            INSERT INTO time_tracking (id, student_id, course_id, start_time, end_time, duration)
-            VALUES (?, ?, ?, ?, ?, ?)
-        """, (next_id, current_user[0], time_entry.course_id, time_entry.start_time, 
-              time_entry.end_time, time_entry.duration))
+        conn.execute("BEGIN")
+        try:
+            conn.execute("""
+                INSERT INTO time_tracking (id, student_id, course_id, start_time, end_time, duration)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """, (*next_ids(conn, "time_tracking_id"), current_user[0], time_entry.course_id, time_entry.start_time, 
+                  time_entry.end_time, time_entry.duration))
+            record_changes(conn, "time_tracking", [current_user[0]])
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        if time_entry.duration:
+            event_bus.publish("practice_time", {
+                "student_id": current_user[0], "course_id": time_entry.course_id, "duration": time_entry.duration
+            })
         
         return {"message": "Time entry saved successfully"}
     except Exception as e:
         return JSONResponse(status_code=500, content={"detail": str(e)})
 
+@app.post("/api/time-tracking/batch")
+@idempotent
+def save_time_entry_batch(batch: TimeEntryBatch, current_user: tuple = Depends(get_current_user)):
+    # Time practised offline, replayed by the service worker. Each entry carries a
+    # client-generated key; keys already received are skipped, so retries are safe.
+    try:
+        if len(batch.entries) > OFFLINE_BATCH_LIMIT:
+            raise HTTPException(status_code=413, detail=f"At most {OFFLINE_BATCH_LIMIT} entries per batch")
+        
+        oldest = datetime.utcnow() - timedelta(days=OFFLINE_RECEIPT_RETENTION_DAYS)
+        entries = {}
+        expired = 0
+        for entry in batch.entries:
+            start = entry.start_time.replace(tzinfo=None)
+            end = entry.end_time.replace(tzinfo=None)
+            # Older than the receipts we keep, so a replay could no longer be detected
+            if start < oldest:
+                expired += 1
+                continue
+            duration = min(entry.duration, int((end - start).total_seconds()))
+            if duration > 0:
+                entries[entry.entry_key] = (entry.course_id, start, end, duration)
+        if not entries:
+            return {"accepted": 0, "duplicates": len(batch.entries) - expired, "expired": expired}
+        
+        conn = get_db()
+        student_id = current_user[0]
+        conn.execute("BEGIN")
+        try:
+            new_keys = [row[0] for row in conn.execute(f"""
+                INSERT INTO time_entry_receipts (student_id, entry_key)
+                SELECT ?, entry_key FROM (VALUES {", ".join(["(?)"] * len(entries))}) AS batch(entry_key)
+                WHERE entry_key NOT IN (SELECT entry_key FROM time_entry_receipts WHERE student_id = ?)
+                RETURNING entry_key
+            """, [student_id, *entries, student_id]).fetchall()]
+            if new_keys:
+                rows = [(student_id, *entries[key]) for key in new_keys]
+                conn.execute(f"""
+                    INSERT INTO time_tracking (id, student_id, course_id, start_time, end_time, duration)
+                    VALUES {", ".join(["(?, ?, ?, ?, ?, ?)"] * len(rows))}
+                """, [value for row_id, row in zip(next_ids(conn, "time_tracking_id", len(rows)), rows)
+                      for value in (row_id, *row)])
+                record_changes(conn, "time_tracking", [student_id])
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        
+        for key in new_keys:
+            course_id, _, _, duration = entries[key]
+            event_bus.publish("practice_time", {"student_id": student_id, "course_id": course_id, "duration": duration})
+        return {"accepted": len(new_keys), "duplicates": len(batch.entries) - expired - len(new_keys), "expired": expired}
+    except HTTPException:
+        raise
+    except Exception as e:
+        return JSONResponse(status_code=500, content={"detail": str(e)})
+
+@app.post("/api/practice-sessions")
+@idempotent
+def start_practice_session(body: PracticeSessionStart, current_user: tuple = Depends(get_current_user)):
+    session_id, started = practice_backend().start(current_user[0], body.course_id)
+    return {
+        "session_id": session_id,
+        "started_at": datetime.utcfromtimestamp(started).isoformat() + "Z",
+        "heartbeat_seconds": PRACTICE_HEARTBEAT_SECONDS
+    }
+
+@app.post("/api/practice-sessions/{session_id}/heartbeat")
+@idempotent
+def practice_session_heartbeat(session_id: str, current_user: tuple = Depends(get_current_user)):
+    elapsed = practice_backend().heartbeat(session_id, current_user[0])
+    if elapsed is None:
+        raise HTTPException(status_code=404, detail="Practice session not found")
+    return {"elapsed": elapsed}
+
+@app.post("/api/practice-sessions/{session_id}/stop")
+@idempotent
+def stop_practice_session(session_id: str, current_user: tuple = Depends(get_current_user)):
+    duration = practice_backend().stop(session_id, current_user[0])
+    if duration is None:
+        raise HTTPException(status_code=404, detail="Practice session not found")
+    return {"duration": duration}
+
+@app.delete("/api/practice-sessions/{session_id}")
+@idempotent
+def discard_practice_session(session_id: str, current_user: tuple = Depends(get_current_user)):
+    if practice_backend().stop(session_id, current_user[0], discard=True) is None:
+        raise HTTPException(status_code=404, detail="Practice session not found")
+    return {"message": "Practice session discarded"}
+
 @app.get("/api/time-stats/{student_id}")
-async def get_time_stats(student_id: int, current_user: tuple = Depends(get_current_user)):
+async def get_time_stats(student_id: int, response: Response, max_staleness: Optional[int] = None,
+                         current_user: tuple = Depends(get_current_user)):
     try:
         if not current_user[5] and current_user[0] != student_id:  # Not admin and not own stats
             raise HTTPException(status_code=403, detail="Access denied")
         
-        conn = get_db()
-        stats = conn.execute("""
-            SELECT c.name, SUM(tt.duration) as total_time, COUNT(tt.id) as sessions
-            FROM time_tracking tt
+        # Students see their own entries immediately; admin reports may lag by the staleness bound
+        conn = analytics_db(response, max_staleness) if current_user[5] else get_db()
+        source, tables = analytics_cache_tags(response, conn, ("time_tracking", "time_tracking_rollups", "courses"))
+        stats = query_cache.get_or_load("get_time_stats", (student_id, source), tables, lambda: conn.execute("""
+            SELECT c.name, SUM(tt.total_time) as total_time, SUM(tt.sessions) as sessions
+            FROM (
+                SELECT course_id, SUM(duration) AS total_time, COUNT(id) AS sessions
+                FROM time_tracking WHERE student_id = ? GROUP BY course_id
+                UNION ALL
+                SELECT course_id, SUM(total_duration), SUM(sessions)
+                FROM time_tracking_rollups WHERE student_id = ? GROUP BY course_id
+            ) tt
             JOIN courses c ON tt.course_id = c.id
-            WHERE tt.student_id = ?
             GROUP BY c.id, c.name
             ORDER BY total_time DESC
-        """, (student_id,)).fetchall()
-        
-        stats_list = []
-        for stat in stats:
-            stats_list.append({
-                "course_name": stat[0],
-                "total_time": stat[1] or 0,
-                "sessions": stat[2] or 0
-            })
+        """, (student_id, student_id)).fetchall())
+        
+        return _time_stats_list(stats)
+    except Exception as e:
+        return JSONResponse(status_code=500, content={"detail": str(e)})
+
+def _time_stats_list(stats):
+    return [{"course_name": stat[0], "total_time": stat[1] or 0, "sessions": stat[2] or 0} for stat in stats]
+
+@app.get("/api/time-entries/{student_id}")
+async def get_time_entries(
+    student_id: int,
+    start: datetime,
+    end: datetime,
+    current_user: tuple = Depends(get_current_user)
+):
+    # Individual sessions in [start, end), from the hot table and the Parquet archive.
+    # The year/month predicate lets DuckDB skip archive partitions outside the range.
+    try:
+        if not current_user[5] and current_user[0] != student_id:  # Not admin and not own entries
+            raise HTTPException(status_code=403, detail="Access denied")
+        
+        conn = get_db()
+        entries = conn.execute("""
+            SELECT tt.id, tt.course_id, c.name, tt.start_time, tt.end_time, tt.duration
+            FROM time_tracking_all tt
+            JOIN courses c ON tt.course_id = c.id
+            WHERE tt.year * 100 + tt.month BETWEEN ? AND ?
+              AND tt.student_id = ? AND tt.start_time >= ? AND tt.start_time < ?
+            ORDER BY tt.start_time
+        """, (start.year * 100 + start.month, end.year * 100 + end.month, student_id, start, end)).fetchall()
         
-        return stats_list
+        return [
+            {
+                "id": entry[0],
+                "course_id": entry[1],
+                "course_name": entry[2],
+                "start_time": str(entry[3]),
+                "end_time": str(entry[4]) if entry[4] else None,
+                "duration": entry[5]
+            }
+            for entry in entries
+        ]
+    except HTTPException:
+        raise
     except Exception as e:
         return JSONResponse(status_code=500, content={"detail": str(e)})
 
 @app.post("/api/upload-material/{course_id}")
-async def upload_material(
+@idempotent
+def upload_material(
     course_id: int,
     material_type: str = Form(...),
     file: UploadFile = File(...),
@@ -475,91 +5367,398 @@ async def upload_material(
         if not current_user[5]:  # Not admin
             raise HTTPException(status_code=403, detail="Admin access required")
         
-        content = await file.read()
+        content = file.file.read()
         
         conn = get_db()
         # Get next ID
-        max_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM course_materials").fetchone()[0]
-        next_id = max_id + 1
-        conn.execute("""
-            INSERT INTO course_materials (id, course_id, material_type, filename, content)
-            VALUES (?, ?, ?, ?, ?)
-        """, (next_id, course_id, material_type, file.filename, content))
+        next_id = conn.execute("SELECT nextval('course_materials_id')").fetchone()[0]
+        conn.execute("BEGIN")
+        try:
+            conn.execute("""
+                INSERT INTO course_materials (id, course_id, material_type, filename, content)
+                VALUES (?, ?, ?, ?, ?)
+            """, (next_id, course_id, material_type, file.filename, content))
+            record_changes(conn, "course_materials", [f"{course_id}:{next_id}"])
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        course_materials_cache.invalidate(course_id)
+        course_catalog.add_material(next_id, course_id)
+        enqueue_derivative_job(next_id)
+        event_bus.publish("material_uploaded", {
+            "course_id": course_id, "material_id": next_id,
+            "material_type": material_type, "filename": file.filename
+        })
         
         return {"message": "Material uploaded successfully"}
     except Exception as e:
         return JSONResponse(status_code=500, content={"detail": str(e)})
 
 @app.get("/api/course-materials/{course_id}")
-async def get_course_materials(course_id: int, current_user: tuple = Depends(get_current_user)):
+async def get_course_materials(course_id: int, request: Request, since: Optional[int] = None,
+                               current_user: tuple = Depends(get_current_user)):
     try:
-        conn = get_db()
-        materials = conn.execute("""
-            SELECT id, material_type, filename, uploaded_at
-            FROM course_materials
-            WHERE course_id = ?
-            ORDER BY material_type, uploaded_at DESC
-        """, (course_id,)).fetchall()
-        
-        material_list = []
-        for material in materials:
-            material_list.append({
-                "id": material[0],
-                "material_type": material[1],
-                "filename": material[2],
-                "uploaded_at": str(material[3])
-            })
+        if not course_catalog.can_access_course(current_user, course_id):
+            raise HTTPException(status_code=403, detail="You are not enrolled in this course")
+        if since is not None:
+            return await run_in_threadpool(_course_materials_since, course_id, since)
         
-        return material_list
+        etag, material_list = await course_materials_cache.get(course_id)
+        headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+        if request.headers.get("if-none-match") == etag:
+            return Response(status_code=304, headers=headers)
+        
+        return JSONResponse(content=material_list, headers=headers)
+    except HTTPException:
+        raise
     except Exception as e:
         return JSONResponse(status_code=500, content={"detail": str(e)})
 
 @app.get("/api/download-material/{material_id}")
-async def download_material(material_id: int, current_user: tuple = Depends(get_current_user)):
+def download_material(
+    material_id: int,
+    rendition: str = "original",
+    formats: Optional[str] = None,
+    current_user: tuple = Depends(get_current_user)
+):
+    # rendition: "original", "auto" (smallest rendition in one of the comma-separated
+    # mime types in formats, falling back to the original) or a specific kind
+    course_id = course_catalog.material_course(material_id)
+    if course_id is None:
+        raise HTTPException(status_code=404, detail="Material not found")
+    if not course_catalog.can_access_course(current_user, course_id):
+        raise HTTPException(status_code=403, detail="You are not enrolled in this course")
+    return material_download(material_id=material_id, rendition=rendition, formats=formats)
+
+# Shared by every caller asking for the same rendition at once, so the access check
+# stays in the route above
+@coalesce()
+def material_download(material_id, rendition, formats):
     try:
         conn = get_db()
         material = conn.execute("""
-            SELECT filename, content FROM course_materials WHERE id = ?
+            SELECT filename, octet_length(content) FROM course_materials WHERE id = ?
         """, (material_id,)).fetchone()
         
         if not material:
             raise HTTPException(status_code=404, detail="Material not found")
         
+        chosen = _pick_rendition(material_id, rendition, formats, material[1])
+        if chosen is None:
+            content = conn.execute("SELECT content FROM course_materials WHERE id = ?", (material_id,)).fetchone()[0]
+            return JSONResponse({
+                "filename": material[0],
+                "content": base64.b64encode(content).decode('utf-8'),
+                "rendition": "original"
+            })
+        
+        kind, mime_type = chosen
+        content = conn.execute("""
+            SELECT content FROM material_derivatives WHERE material_id = ? AND kind = ?
+        """, (material_id, kind)).fetchone()[0]
         return JSONResponse({
-            "filename": material[0],
-            "content": base64.b64encode(material[1]).decode('utf-8')
+            "filename": os.path.splitext(material[0])[0] + AUDIO_RENDITIONS[kind][1],
+            "content": base64.b64encode(content).decode('utf-8'),
+            "rendition": kind,
+            "mime_type": mime_type
         })
+    except HTTPException:
+        raise
+    except Exception as e:
+        return JSONResponse(status_code=500, content={"detail": str(e)})
+
+@app.post("/api/course-materials/{course_id}/bundle-link")
+def course_bundle_link(
+    course_id: int,
+    ids: Optional[str] = None,
+    rendition: str = "original",
+    formats: Optional[str] = None,
+    current_user: tuple = Depends(get_current_user)
+):
+    # A URL for the bundle that a plain link can open (see link tokens)
+    if not course_catalog.can_access_course(current_user, course_id):
+        raise HTTPException(status_code=403, detail="You are not enrolled in this course")
+    params = {"ids": ids, "rendition": rendition, "formats": formats,
+              "token": create_link_token(current_user, f"bundle:{course_id}")}
+    query = urlencode({key: value for key, value in params.items() if value is not None})
+    return {"url": f"/api/course-materials/{course_id}/bundle?{query}", "expires_in": LINK_TOKEN_SECONDS}
+
+@app.get("/api/course-materials/{course_id}/bundle")
+def download_course_bundle(
+    course_id: int,
+    request: Request,
+    ids: Optional[str] = None,
+    rendition: str = "original",
+    formats: Optional[str] = None,
+    token: Optional[str] = None
+):
+    # ids: comma-separated material ids (default all); rendition "auto" swaps
+    # recordings for the smallest compressed rendition in formats, as downloads do.
+    # token: a link token from bundle-link, for plain links
+    current_user = link_or_bearer_user(request, token, f"bundle:{course_id}")
+    cursor = None
+    try:
+        if rendition not in ("original", "auto"):
+            raise HTTPException(status_code=400, detail="rendition must be 'original' or 'auto'")
+        try:
+            material_ids = [int(part) for part in ids.split(",") if part.strip()] if ids else None
+        except ValueError:
+            raise HTTPException(status_code=400, detail="ids must be comma-separated material ids")
+        if not course_catalog.can_access_course(current_user, course_id):
+            raise HTTPException(status_code=403, detail="You are not enrolled in this course")
+        
+        conn = get_db()
+        # A stream cursor, so compaction won't swap the file under the download
+        cursor = conn.stream_cursor()
+        cursor.execute("BEGIN TRANSACTION")
+        entries = plan_course_bundle(cursor, course_id, material_ids, rendition, formats)
+        if not entries:
+            raise HTTPException(status_code=404, detail="No materials in this course")
+        if sum(entry.size for entry in entries) + len(entries) * 1024 > _ZIP_LIMIT:
+            raise HTTPException(status_code=413, detail="Bundle too large; select fewer materials")
+        
+        stream_cursor, closed = cursor, []
+        def close():
+            # From the stream's end, or when a stream that never started is dropped
+            if closed:
+                return
+            closed.append(True)
+            try:
+                stream_cursor.execute("ROLLBACK")
+            except Exception:
+                pass
+            finally:
+                conn.close_cursor(stream_cursor, stream=True)
+        
+        course = next((c for c in course_catalog.courses() if c[0] == course_id), None)
+        title = course[1] if course else f"course-{course_id}"
+        headers = {
+            "Content-Disposition": f"attachment; filename=\"course-{course_id}.zip\"; filename*=UTF-8''{quote(title)}.zip",
+            "Cache-Control": "private, no-store",
+        }
+        length = bundle_length(entries)
+        if length is not None:
+            headers["Content-Length"] = str(length)
+        stream = stream_bundle(cursor, entries, close)
+        weakref.finalize(stream, close)
+        cursor = None  # the stream closes it
+        return StreamingResponse(stream, media_type="application/zip", headers=headers)
+    except HTTPException:
+        raise
+    except Exception as e:
+        return JSONResponse(status_code=500, content={"detail": str(e)})
+    finally:
+        if cursor is not None:
+            try:
+                cursor.execute("ROLLBACK")
+            except Exception:
+                pass
+            get_db().close_cursor(cursor, stream=True)
+
+@app.get("/api/material-preview/{material_id}")
+async def get_material_preview(material_id: int, current_user: tuple = Depends(get_current_user)):
+    try:
+        course_id = course_catalog.material_course(material_id)
+        if course_id is None:
+            raise HTTPException(status_code=404, detail="Material not found")
+        if not course_catalog.can_access_course(current_user, course_id):
+            raise HTTPException(status_code=403, detail="You are not enrolled in this course")
+        conn = get_db()
+        job = conn.execute("""
+            SELECT status, attempts FROM derivative_jobs WHERE material_id = ? ORDER BY id DESC LIMIT 1
+        """, (material_id,)).fetchone()
+        derivatives = conn.execute("""
+            SELECT kind, mime_type, size,
+                   CASE WHEN kind IN ('waveform', 'preview_text', 'preview_image') THEN content END
+            FROM material_derivatives
+            WHERE material_id = ?
+        """, (material_id,)).fetchall()
+        
+        preview = {
+            "material_id": material_id,
+            "status": job[0] if job else None,
+            "renditions": [],
+            "waveform": None,
+            "text": None,
+            "image": None
+        }
+        for kind, mime_type, size, content in derivatives:
+            if kind in AUDIO_RENDITIONS:
+                preview["renditions"].append({"kind": kind, "mime_type": mime_type, "size": size})
+            elif kind == "waveform":
+                preview["waveform"] = json.loads(content)
+            elif kind == "preview_text":
+                preview["text"] = content.decode("utf-8")
+            elif kind == "preview_image":
+                preview["image"] = base64.b64encode(content).decode("utf-8")
+        
+        return preview
+    except HTTPException:
+        raise
+    except Exception as e:
+        return JSONResponse(status_code=500, content={"detail": str(e)})
+
+@app.get("/api/search")
+async def search(q: str, course_id: Optional[int] = None, limit: int = 20,
+                 current_user: tuple = Depends(get_current_user)):
+    # Ranked matches across every course the caller can see (all of them for admins)
+    try:
+        start = time.perf_counter()
+        results = search_materials(get_db(), q, current_user, course_id, max(1, min(limit, SEARCH_RESULT_LIMIT)))
+        return {"query": q, "results": results, "took_ms": round((time.perf_counter() - start) * 1000, 2)}
     except Exception as e:
         return JSONResponse(status_code=500, content={"detail": str(e)})
 
 @app.get("/api/student-assignments/{student_id}")
-async def get_student_assignments(student_id: int, current_user: tuple = Depends(get_current_user)):
+async def get_student_assignments(student_id: int, since: Optional[int] = None,
+                                  current_user: tuple = Depends(get_current_user)):
     try:
         if not current_user[5]:  # Not admin
             raise HTTPException(status_code=403, detail="Admin access required")
         
         conn = get_db()
-        assignments = conn.execute("""
-            SELECT sc.course_id, c.name
-            FROM student_courses sc
-            JOIN courses c ON sc.course_id = c.id
-            WHERE sc.student_id = ?
-            ORDER BY c.name
-        """, (student_id,)).fetchall()
-        
-        assignment_list = []
-        for assignment in assignments:
-            assignment_list.append({
-                "course_id": assignment[0],
-                "course_name": assignment[1]
-            })
+        changes = None
+        if since is not None:
+            version, changes = changes_since(conn, since, ["student_courses"], key_prefix=f"{student_id}:")
+        
+        course_filter = ""
+        params = [student_id]
+        if changes is not None:
+            deleted = sorted(int(key.split(":")[1]) for (_, key), op in changes.items() if op == "delete")
+            added = [int(key.split(":")[1]) for (_, key), op in changes.items() if op == "upsert"]
+            course_filter = f"AND sc.course_id IN ({', '.join('?' * len(added)) or 'NULL'})"
+            params += added
+        def load_assignments():
+            return conn.execute(f"""
+                SELECT sc.course_id, c.name
+                FROM student_courses sc
+                JOIN courses c ON sc.course_id = c.id
+                WHERE sc.student_id = ? {course_filter}
+                ORDER BY c.name
+            """, params).fetchall()
+        if changes is None:
+            assignments = query_cache.get_or_load("get_student_assignments", student_id,
+                                                  ("student_courses", "courses"), load_assignments)
+        else:
+            assignments = load_assignments()
+        
+        assignment_list = _assignment_list(assignments)
         
-        return assignment_list
+        if since is None:
+            return assignment_list
+        if changes is None:
+            return full_response(version, assignment_list)
+        return delta_response(version, assignment_list, deleted)
+    except Exception as e:
+        return JSONResponse(status_code=500, content={"detail": str(e)})
+
+def _assignment_list(assignments):
+    return [{"course_id": assignment[0], "course_name": assignment[1]} for assignment in assignments]
+
+# Batch student details for the admin dashboard: the course list plus each student's
+# assignments and practice stats in one request, instead of /api/courses,
+# /api/student-assignments/{id} and /api/time-stats/{id} per student. Each part is
+# loaded with one query for all students and cached per student under the same
+# entries as the single-student endpoints.
+STUDENT_DETAILS_MAX_IDS = int(os.getenv("STUDENT_DETAILS_MAX_IDS", "500"))
+
+class StudentDetailsRequest(BaseModel):
+    student_ids: List[int]
+    include_courses: bool = True
+
+def _load_assignments_many(conn, student_ids):
+    rows = conn.execute(f"""
+        SELECT sc.student_id, sc.course_id, c.name
+        FROM student_courses sc
+        JOIN courses c ON sc.course_id = c.id
+        WHERE sc.student_id IN ({', '.join('?' * len(student_ids))})
+        ORDER BY sc.student_id, c.name
+    """, student_ids).fetchall()
+    assignments = {student_id: [] for student_id in student_ids}
+    for student_id, course_id, name in rows:
+        assignments[student_id].append((course_id, name))
+    return assignments
+
+def _load_time_stats_many(conn, student_ids, source):
+    id_list = ", ".join("?" * len(student_ids))
+    rows = conn.execute(f"""
+        SELECT tt.student_id, c.name, SUM(tt.total_time) as total_time, SUM(tt.sessions) as sessions
+        FROM (
+            SELECT student_id, course_id, SUM(duration) AS total_time, COUNT(id) AS sessions
+            FROM time_tracking WHERE student_id IN ({id_list}) GROUP BY student_id, course_id
+            UNION ALL
+            SELECT student_id, course_id, SUM(total_duration), SUM(sessions)
+            FROM time_tracking_rollups WHERE student_id IN ({id_list}) GROUP BY student_id, course_id
+        ) tt
+        JOIN courses c ON tt.course_id = c.id
+        GROUP BY tt.student_id, c.id, c.name
+        ORDER BY tt.student_id, total_time DESC
+    """, student_ids + student_ids).fetchall()
+    stats = {(student_id, source): [] for student_id in student_ids}
+    for student_id, name, total_time, sessions in rows:
+        stats[(student_id, source)].append((name, total_time, sessions))
+    return stats
+
+@app.post("/api/admin/student-details")
+def get_student_details(request: StudentDetailsRequest, response: Response,
+                        max_staleness: Optional[int] = None,
+                        current_user: tuple = Depends(get_current_user)):
+    try:
+        if not current_user[5]:  # Not admin
+            raise HTTPException(status_code=403, detail="Admin access required")
+
+        student_ids = list(dict.fromkeys(request.student_ids))
+        if len(student_ids) > STUDENT_DETAILS_MAX_IDS:
+            raise HTTPException(status_code=400, detail=f"At most {STUDENT_DETAILS_MAX_IDS} students per request")
+
+        result = {}
+        if request.include_courses:
+            result["courses"] = [
+                {"id": course[0], "name": course[1], "description": course[2], "created_at": str(course[3])}
+                for course in course_catalog.courses()
+            ]
+        if not student_ids:
+            return dict(result, students=[], missing=[])
+
+        conn = get_db()
+        existing = {row[0] for row in conn.execute(f"""
+            SELECT id FROM users
+            WHERE is_admin = FALSE AND deleted_at IS NULL AND id IN ({', '.join('?' * len(student_ids))})
+        """, student_ids).fetchall()}
+        missing = [student_id for student_id in student_ids if student_id not in existing]
+        student_ids = [student_id for student_id in student_ids if student_id in existing]
+
+        assignments = query_cache.get_or_load_many(
+            "get_student_assignments", student_ids, ("student_courses", "courses"),
+            lambda ids: _load_assignments_many(conn, ids)
+        ) if student_ids else {}
+        # Practice stats come from the analytics snapshot, like /api/time-stats for admins
+        analytics = analytics_db(response, max_staleness)
+        source, tables = analytics_cache_tags(response, analytics, ("time_tracking", "time_tracking_rollups", "courses"))
+        stats = query_cache.get_or_load_many(
+            "get_time_stats", [(student_id, source) for student_id in student_ids], tables,
+            lambda keys: _load_time_stats_many(analytics, [key[0] for key in keys], source)
+        ) if student_ids else {}
+
+        result["students"] = [
+            {
+                "id": student_id,
+                "assignments": _assignment_list(assignments[student_id]),
+                "time_stats": _time_stats_list(stats[(student_id, source)])
+            }
+            for student_id in student_ids
+        ]
+        result["missing"] = missing
+        return result
+    except HTTPException:
+        raise
     except Exception as e:
         return JSONResponse(status_code=500, content={"detail": str(e)})
 
 @app.post("/api/update-student-courses")
-async def update_student_courses(
+@idempotent
+def update_student_courses(
     student_id: int = Form(...), 
     course_ids: str = Form(...), 
     current_user: tuple = Depends(get_current_user)
@@ -570,21 +5769,39 @@ async def update_student_courses(
         
         # Parse course IDs from JSON string
         import json
-        selected_course_ids = json.loads(course_ids)
+        # A repeated id would break the unique (student_id, course_id) index
+        selected_course_ids = list(dict.fromkeys(json.loads(course_ids)))
         
         conn = get_db()
         
-        # Remove all existing assignments for this student
-        conn.execute("DELETE FROM student_courses WHERE student_id = ?", (student_id,))
-        
-        # Add new assignments
-        for course_id in selected_course_ids:
-            # Get next ID
-            max_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM student_courses").fetchone()[0]
-            next_id = max_id + 1
-            conn.execute("""
-                INSERT INTO student_courses (id, student_id, course_id) VALUES (?, ?, ?)
-            """, (next_id, student_id, course_id))
+        conn.execute("BEGIN")
+        try:
+            previous_course_ids = {row[0] for row in conn.execute(
+                "SELECT course_id FROM student_courses WHERE student_id = ?", (student_id,)
+            ).fetchall()}
+            
+            # Remove all existing assignments for this student
+            conn.execute("DELETE FROM student_courses WHERE student_id = ?", (student_id,))
+            
+            # Add new assignments
+            for assignment_id, course_id in zip(
+                    next_ids(conn, "student_courses_id", len(selected_course_ids)), selected_course_ids):
+                conn.execute("""
+                    INSERT INTO student_courses (id, student_id, course_id) VALUES (?, ?, ?)
+                """, (assignment_id, student_id, course_id))
+            record_changes(conn, "student_courses",
+                           [f"{student_id}:{course_id}" for course_id in previous_course_ids - set(selected_course_ids)],
+                           op="delete")
+            record_changes(conn, "student_courses",
+                           [f"{student_id}:{course_id}" for course_id in set(selected_course_ids) - previous_course_ids])
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        course_catalog.set_assignments(student_id, selected_course_ids)
+        event_bus.publish("assignments_changed", {
+            "student_id": student_id, "assigned_courses": _assigned_course_names(conn, student_id)
+        })
         
         return {"message": f"Course assignments updated successfully. {len(selected_course_ids)} courses assigned."}
     except Exception as e:
@@ -594,7 +5811,8 @@ class RemoveStudentRequest(BaseModel):
     student_id: int
 
 @app.post("/api/remove-student")
-async def remove_student(request: RemoveStudentRequest, current_user: tuple = Depends(get_current_user)):
+@idempotent
+def remove_student(request: RemoveStudentRequest, current_user: tuple = Depends(get_current_user)):
     try:
         if not current_user[5]:  # Not admin
             raise HTTPException(status_code=403, detail="Admin access required")
@@ -606,32 +5824,327 @@ async def remove_student(request: RemoveStudentRequest, current_user: tuple = De
         student = conn.execute("""
             SELECT id, first_name, last_name, email, password_hash, is_admin 
             FROM users 
-            WHERE id = ? AND is_admin = FALSE
+            WHERE id = ? AND is_admin = FALSE AND deleted_at IS NULL
         """, (student_id,)).fetchone()
         if not student:
             raise HTTPException(status_code=404, detail="Student not found or cannot remove admin users")
         
-        # Remove all related data in correct order (due to foreign key constraints)
-        # 1. Remove course materials uploaded by this student (if any)
-        # Note: We don't have a direct link, but this is for completeness
-        
-        # 2. Remove time tracking records
-        conn.execute("DELETE FROM time_tracking WHERE student_id = ?", (student_id,))
-        
-        # 3. Remove course assignments
-        conn.execute("DELETE FROM student_courses WHERE student_id = ?", (student_id,))
+        # The account goes now; practice history is deleted by a background purge job
+        jobs = purge_students(conn, [student_id])
         
-        # 4. Remove the user account
-        conn.execute("DELETE FROM users WHERE id = ?", (student_id,))
-        
-        
-        return {"message": "Student and all associated data removed successfully"}
+        return {"message": "Student removed successfully; their practice history is being deleted",
+                "purge_job_id": jobs[0][1] if jobs else None}
     except HTTPException:
         # Re-raise HTTP exceptions (like 403, 404)
         raise
     except Exception as e:
         return JSONResponse(status_code=500, content={"detail": str(e)})
 
+class PurgeStudentsRequest(BaseModel):
+    student_ids: List[int]
+    cohort: Optional[str] = None
+
+@app.post("/api/admin/purge-students")
+def purge_students_route(request: PurgeStudentsRequest, current_user: tuple = Depends(get_current_user)):
+    # Bulk removal, e.g. a graduating cohort; admins and unknown ids are skipped
+    try:
+        if not current_user[5]:  # Not admin
+            raise HTTPException(status_code=403, detail="Admin access required")
+        if not request.student_ids:
+            raise HTTPException(status_code=400, detail="No students given")
+        
+        jobs = purge_students(get_db(), sorted(set(request.student_ids)), request.cohort)
+        removed = {student_id for student_id, _ in jobs}
+        return {
+            "cohort": request.cohort,
+            "removed": [{"student_id": student_id, "purge_job_id": job_id} for student_id, job_id in jobs],
+            "skipped": [student_id for student_id in sorted(set(request.student_ids)) if student_id not in removed]
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        return JSONResponse(status_code=500, content={"detail": str(e)})
+
+@app.get("/api/admin/purge-jobs")
+async def get_purge_jobs(cohort: Optional[str] = None, current_user: tuple = Depends(get_current_user)):
+    try:
+        if not current_user[5]:  # Not admin
+            raise HTTPException(status_code=403, detail="Admin access required")
+        return purge_progress(get_db(), cohort)
+    except HTTPException:
+        raise
+    except Exception as e:
+        return JSONResponse(status_code=500, content={"detail": str(e)})
+
+@app.post("/api/admin/events-link")
+def admin_events_link(current_user: tuple = Depends(get_current_user)):
+    # EventSource can't send an Authorization header (see link tokens)
+    if not current_user[5]:  # Not admin
+        raise HTTPException(status_code=403, detail="Admin access required")
+    query = urlencode({"token": create_link_token(current_user, "events")})
+    return {"url": f"/api/admin/events?{query}", "expires_in": LINK_TOKEN_SECONDS}
+
+@app.get("/api/admin/events")
+async def admin_events(request: Request, token: Optional[str] = None):
+    # token: a link token from events-link; it is checked when the stream opens, so
+    # EventSource's own reconnects work until it expires
+    current_user = await run_in_threadpool(link_or_bearer_user, request, token, "events")
+    if not current_user[5]:  # Not admin
+        raise HTTPException(status_code=403, detail="Admin access required")
+
+    last_event_id = request.headers.get("last-event-id")
+    queue = event_bus.subscribe(int(last_event_id) if last_event_id and last_event_id.isdigit() else None)
+
+    async def stream():
+        try:
+            yield "retry: 3000\n\n"
+            while True:
+                try:
+                    event = await asyncio.wait_for(queue.get(), EVENT_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    if await request.is_disconnected():
+                        return
+                    yield ": keepalive\n\n"
+                    continue
+                if event is None:
+                    return
+                event_id, event_type, data = event
+                yield f"id: {event_id}\nevent: {event_type}\ndata: {data}\n\n"
+        finally:
+            event_bus.unsubscribe(queue)
+
+    return StreamingResponse(stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+# Diagnostics (admin only)
+@app.get("/api/admin/cache-stats")
+async def get_cache_stats(current_user: tuple = Depends(get_current_user)):
+    if not current_user[5]:  # Not admin
+        raise HTTPException(status_code=403, detail="Admin access required")
+
+    return {
+        "course_materials": dict(course_materials_cache.stats),
+        "course_catalog": course_catalog.summary(),
+        "query_cache": query_cache.summary(),
+        "idempotency": await run_in_threadpool(idempotency_backend().summary),
+        "rate_limits": dict(local_rate_limits.stats, keys=len(local_rate_limits),
+                            backend=RATE_LIMIT_BACKEND if DB_SERVICE_SOCKET else "local"),
+        "single_flight": {route: dict(counts) for route, counts in single_flight.stats.items()}
+    }
+
+@app.get("/api/admin/practice-sessions")
+def get_practice_session_stats(current_user: tuple = Depends(get_current_user)):
+    if not current_user[5]:  # Not admin
+        raise HTTPException(status_code=403, detail="Admin access required")
+
+    return practice_backend().summary()
+
+@app.get("/api/admin/derivative-jobs")
+async def get_derivative_jobs(current_user: tuple = Depends(get_current_user)):
+    if not current_user[5]:  # Not admin
+        raise HTTPException(status_code=403, detail="Admin access required")
+
+    conn = get_db()
+    counts = conn.execute("SELECT status, COUNT(*) FROM derivative_jobs GROUP BY status").fetchall()
+    failures = conn.execute("""
+        SELECT id, material_id, status, attempts, last_error, updated_at
+        FROM derivative_jobs
+        WHERE last_error IS NOT NULL
+        ORDER BY updated_at DESC
+        LIMIT 50
+    """).fetchall()
+    return {
+        "counts": {status: count for status, count in counts},
+        "recent_errors": [
+            {"id": f[0], "material_id": f[1], "status": f[2], "attempts": f[3],
+             "last_error": f[4], "updated_at": str(f[5])}
+            for f in failures
+        ]
+    }
+
+@app.post("/api/admin/derivative-jobs/{material_id}/retry")
+def retry_derivative_job(material_id: int, current_user: tuple = Depends(get_current_user)):
+    if not current_user[5]:  # Not admin
+        raise HTTPException(status_code=403, detail="Admin access required")
+
+    enqueue_derivative_job(material_id)
+    return {"message": "Derivative job queued"}
+
+@app.post("/api/admin/maintenance/recluster")
+async def trigger_recluster(current_user: tuple = Depends(get_current_user)):
+    if not current_user[5]:  # Not admin
+        raise HTTPException(status_code=403, detail="Admin access required")
+
+    result = await run_in_threadpool(recluster_time_tracking, True)
+    return {"message": result}
+
+@app.post("/api/admin/maintenance/archive")
+async def trigger_archive(current_user: tuple = Depends(get_current_user)):
+    if not current_user[5]:  # Not admin
+        raise HTTPException(status_code=403, detail="Admin access required")
+
+    result = await run_in_threadpool(archive_time_tracking)
+    return {"message": result or "Nothing to archive"}
+
+@app.post("/api/admin/maintenance/analytics-snapshot")
+async def trigger_analytics_snapshot(current_user: tuple = Depends(get_current_user)):
+    if not current_user[5]:  # Not admin
+        raise HTTPException(status_code=403, detail="Admin access required")
+
+    result = await run_in_threadpool(take_analytics_snapshot)
+    return {"message": result or "Analytics snapshots need a file-backed database"}
+
+@app.post("/api/admin/maintenance/compact")
+async def trigger_compaction(force: bool = False, current_user: tuple = Depends(get_current_user)):
+    if not current_user[5]:  # Not admin
+        raise HTTPException(status_code=403, detail="Admin access required")
+
+    try:
+        report = await run_in_threadpool(compact_database, force)
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    if report is None:
+        return {"message": "Not enough dead space to compact (use ?force=true to compact anyway)"}
+    return report
+
+@app.get("/api/admin/storage")
+async def get_storage_stats(current_user: tuple = Depends(get_current_user)):
+    if not current_user[5]:  # Not admin
+        raise HTTPException(status_code=403, detail="Admin access required")
+    if database_path in (None, ":memory:"):
+        return {"message": "In-memory database"}
+
+    dead_space = await run_in_threadpool(measure_dead_space, get_db())
+    # Compactions run where the file is open: with db_service.py their history is kept there
+    return dict(dead_space, compactions=list(compaction_history))
+
+@app.post("/api/admin/maintenance/backup")
+async def trigger_backup(current_user: tuple = Depends(get_current_user)):
+    if not current_user[5]:  # Not admin
+        raise HTTPException(status_code=403, detail="Admin access required")
+
+    try:
+        report = await run_in_threadpool(take_backup)
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    if report is None:
+        return {"message": "No backup target configured (set BACKUP_DIR or BACKUP_S3_BUCKET)"}
+    return report
+
+@app.get("/api/admin/backups")
+async def get_backups(current_user: tuple = Depends(get_current_user)):
+    if not current_user[5]:  # Not admin
+        raise HTTPException(status_code=403, detail="Admin access required")
+    store = backup_store()
+    if store is None:
+        return {"message": "No backup target configured (set BACKUP_DIR or BACKUP_S3_BUCKET)"}
+
+    def summaries():
+        backups = []
+        for backup_id in list_backup_manifests(store):
+            manifest = load_backup_manifest(store, backup_id)
+            backups.append(dict(manifest["stats"], id=backup_id, taken_at=manifest["taken_at"]))
+        return backups
+    return {"location": store.location, "backups": await run_in_threadpool(summaries)}
+
+@app.get("/api/admin/query-plans")
+async def get_query_plan_check(current_user: tuple = Depends(get_current_user)):
+    if not current_user[5]:  # Not admin
+        raise HTTPException(status_code=403, detail="Admin access required")
+
+    failures = await run_in_threadpool(check_query_plans, get_db())
+    return {"ok": not failures, "failures": failures}
+
+class SlowQueryConfig(BaseModel):
+    threshold_ms: Optional[float] = None
+    explain: Optional[bool] = None
+
+class QueryCacheConfig(BaseModel):
+    enabled: Optional[bool] = None
+    max_bytes: Optional[int] = None
+
+class ProfilingConfig(BaseModel):
+    requests: int = 1
+    path_prefix: str = "/api/"
+
+@app.get("/api/admin/slow-queries")
+async def get_slow_queries(current_user: tuple = Depends(get_current_user)):
+    if not current_user[5]:  # Not admin
+        raise HTTPException(status_code=403, detail="Admin access required")
+
+    return {
+        "threshold_ms": SLOW_QUERY_MS,
+        "explain": SLOW_QUERY_EXPLAIN,
+        "entries": list(reversed(slow_query_log))
+    }
+
+@app.post("/api/admin/slow-queries/config")
+async def configure_slow_queries(config: SlowQueryConfig, current_user: tuple = Depends(get_current_user)):
+    global SLOW_QUERY_MS, SLOW_QUERY_EXPLAIN
+    if not current_user[5]:  # Not admin
+        raise HTTPException(status_code=403, detail="Admin access required")
+
+    if config.threshold_ms is not None:
+        SLOW_QUERY_MS = config.threshold_ms
+    if config.explain is not None:
+        SLOW_QUERY_EXPLAIN = config.explain
+
+    return {"threshold_ms": SLOW_QUERY_MS, "explain": SLOW_QUERY_EXPLAIN}
+
+@app.post("/api/admin/query-cache/config")
+async def configure_query_cache(config: QueryCacheConfig, current_user: tuple = Depends(get_current_user)):
+    # Kill switch: disabling also drops every entry
+    if not current_user[5]:  # Not admin
+        raise HTTPException(status_code=403, detail="Admin access required")
+
+    if config.enabled is not None:
+        query_cache.enabled = config.enabled
+        if not config.enabled:
+            query_cache.clear()
+    if config.max_bytes is not None:
+        query_cache.max_bytes = max(config.max_bytes, 0)
+    return query_cache.summary()
+
+@app.delete("/api/admin/slow-queries")
+async def clear_slow_queries(current_user: tuple = Depends(get_current_user)):
+    if not current_user[5]:  # Not admin
+        raise HTTPException(status_code=403, detail="Admin access required")
+
+    slow_query_log.clear()
+    return {"message": "Slow query log cleared"}
+
+@app.post("/api/admin/profiling")
+async def arm_profiler(config: ProfilingConfig, current_user: tuple = Depends(get_current_user)):
+    if not current_user[5]:  # Not admin
+        raise HTTPException(status_code=403, detail="Admin access required")
+
+    profiling_state["remaining"] = max(config.requests, 0)
+    profiling_state["path_prefix"] = config.path_prefix
+    return {
+        "message": f"Profiling the next {profiling_state['remaining']} requests under {config.path_prefix}",
+        "profiler": "pyinstrument" if pyinstrument is not None else "cProfile"
+    }
+
+@app.get("/api/admin/profiles")
+async def list_profiles(current_user: tuple = Depends(get_current_user)):
+    if not current_user[5]:  # Not admin
+        raise HTTPException(status_code=403, detail="Admin access required")
+
+    return [
+        {key: value for key, value in profile.items() if key != "data"}
+        for profile in reversed(profile_history)
+    ]
+
+@app.get("/api/admin/profiles/{profile_id}")
+async def download_profile(profile_id: int, current_user: tuple = Depends(get_current_user)):
+    if not current_user[5]:  # Not admin
+        raise HTTPException(status_code=403, detail="Admin access required")
+
+    for profile in profile_history:
+        if profile["id"] == profile_id:
+            return _profile_response(profile_id, profile["format"], profile["data"], profile["status"])
+    raise HTTPException(status_code=404, detail="Profile not found")
+
 # Vercel handler
 handler = app
 
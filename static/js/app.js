@@ -8,6 +8,7 @@ $(document).ready(function() {
 // Global variables
 let currentUser = null;
 let authToken = null;
+let refreshToken = null;
 let timers = {};
 
 // Global flag to prevent multiple initializations
@@ -27,6 +28,7 @@ function initApp() {
     try {
         // Check for stored authentication
         authToken = localStorage.getItem('authToken');
+        refreshToken = localStorage.getItem('refreshToken');
         const userData = localStorage.getItem('userData');
         
         if (authToken && userData) {
@@ -36,6 +38,7 @@ function initApp() {
         
         // Bind event handlers
         bindEventHandlers();
+        initOfflineSupport();
         
         // Initialize page-specific functionality
         const page = getCurrentPage();
@@ -119,9 +122,11 @@ function login(email, password) {
     }).then(response => {
         if (response.access_token) {
             authToken = response.access_token;
+            refreshToken = response.refresh_token;
             currentUser = response.user;
             
             localStorage.setItem('authToken', authToken);
+            localStorage.setItem('refreshToken', refreshToken);
             localStorage.setItem('userData', JSON.stringify(currentUser));
             
             updateUIForLoggedInUser();
@@ -158,13 +163,173 @@ function register(userData) {
 }
 
 function logout() {
+    const userId = currentUser ? currentUser.id : null;
+    if (refreshToken) {
+        // Best effort: the session also expires on its own
+        $.ajax({
+            url: '/api/logout',
+            method: 'POST',
+            contentType: 'application/json',
+            data: JSON.stringify({ refresh_token: refreshToken })
+        });
+    }
     authToken = null;
+    refreshToken = null;
     currentUser = null;
     localStorage.removeItem('authToken');
+    localStorage.removeItem('refreshToken');
     localStorage.removeItem('userData');
     
     showAlert('Logged out successfully', 'success');
-    window.location.href = '/';
+    forgetOfflineUser(userId).then(() => {
+        window.location.href = '/';
+    });
+}
+
+// Access tokens are short-lived; trade the refresh token for a new one instead of
+// asking for the password again. Concurrent 401s share one refresh, and another tab
+// may already have rotated the token, so the latest one is read from localStorage.
+let tokenRenewal = null;
+
+function renewAccessToken() {
+    if (!tokenRenewal) {
+        refreshToken = localStorage.getItem('refreshToken') || refreshToken;
+        if (!refreshToken) {
+            return Promise.reject(new Error('Not signed in'));
+        }
+        tokenRenewal = Promise.resolve($.ajax({
+            url: '/api/token/refresh',
+            method: 'POST',
+            contentType: 'application/json',
+            data: JSON.stringify({ refresh_token: refreshToken })
+        })).then(response => {
+            authToken = response.access_token;
+            localStorage.setItem('authToken', authToken);
+            if (response.refresh_token) {
+                refreshToken = response.refresh_token;
+                localStorage.setItem('refreshToken', refreshToken);
+            } else {
+                // Another tab rotated it moments ago
+                refreshToken = localStorage.getItem('refreshToken') || refreshToken;
+            }
+            if (offlineStoreAvailable() && currentUser) {
+                OfflineStore.setToken(currentUser.id, authToken).catch(() => {});
+            }
+            return authToken;
+        }).finally(() => {
+            tokenRenewal = null;
+        });
+    }
+    return tokenRenewal;
+}
+
+// Send options with the current access token; on a 401 renew it once and resend
+function ajaxWithAuth(options, send = $.ajax) {
+    const withToken = () => {
+        options.headers = Object.assign({}, options.headers, { 'Authorization': `Bearer ${authToken}` });
+        return send(options);
+    };
+    return withToken().catch(error => {
+        if (error.status !== 401 || !refreshToken) {
+            throw error;
+        }
+        return renewAccessToken().then(withToken, () => { throw error; });
+    });
+}
+
+// Offline support: service worker for cached pages/materials, queued time entries
+function initOfflineSupport() {
+    if ('serviceWorker' in navigator) {
+        navigator.serviceWorker.register('/sw.js')
+            .then(() => navigator.serviceWorker.ready)
+            .then(registration => {
+                // This page's assets were fetched before the worker took control
+                const urls = $('script[src], link[rel="stylesheet"]').map(function() {
+                    return this.src || this.href;
+                }).get();
+                registration.active.postMessage({ type: 'cache-urls', urls: urls });
+            })
+            .catch(error => console.warn('Service worker registration failed:', error));
+    }
+    
+    if (offlineStoreAvailable() && currentUser && authToken) {
+        // The worker replays queued entries with this token, possibly after the tab is closed
+        OfflineStore.setToken(currentUser.id, authToken)
+            .then(flushOfflineTimeEntries)
+            .catch(error => console.warn('Offline storage unavailable:', error));
+        window.addEventListener('online', flushOfflineTimeEntries);
+    }
+}
+
+// offline-store.js is loaded before this file; IndexedDB may still be unavailable
+function offlineStoreAvailable() {
+    return typeof OfflineStore !== 'undefined' && !!window.indexedDB;
+}
+
+// Queue practice time that couldn't reach the server
+function queueOfflineTimeEntry(courseId, from, to) {
+    const duration = Math.floor((to - from) / 1000);
+    if (duration <= 0 || !currentUser) return;
+    if (!offlineStoreAvailable()) {
+        showAlert('Failed to save time entry', 'error');
+        return;
+    }
+    
+    const entryKey = newRequestKey();
+    OfflineStore.queueTimeEntry({
+        entry_key: entryKey,
+        user_id: currentUser.id,
+        course_id: courseId,
+        start_time: from.toISOString(),
+        end_time: to.toISOString(),
+        duration: duration
+    }).then(() => {
+        showAlert('You are offline. Practice time was saved and will sync automatically.', 'info');
+        requestTimeEntrySync();
+    }).catch(error => {
+        console.error('Error queueing time entry:', error);
+        showAlert('Failed to save time entry', 'error');
+    });
+}
+
+// Background Sync where supported, otherwise try now (and again when back online)
+function requestTimeEntrySync() {
+    if ('serviceWorker' in navigator && 'SyncManager' in window) {
+        navigator.serviceWorker.ready
+            .then(registration => registration.sync.register('time-entries'))
+            .catch(flushOfflineTimeEntries);
+    } else {
+        flushOfflineTimeEntries();
+    }
+}
+
+function flushOfflineTimeEntries() {
+    if (!offlineStoreAvailable() || !navigator.onLine) return Promise.resolve(0);
+    return OfflineStore.flushTimeEntries().then(sent => {
+        if (sent > 0) {
+            showAlert('Offline practice time synced', 'success');
+        }
+        return sent;
+    }).catch(error => {
+        console.warn('Time entry sync postponed:', error);
+        return 0;
+    });
+}
+
+// On logout: drop this user's cached lists and materials, and their stored token
+// unless entries still wait for it
+function forgetOfflineUser(userId) {
+    if (navigator.serviceWorker && navigator.serviceWorker.controller) {
+        navigator.serviceWorker.controller.postMessage({ type: 'logout' });
+    }
+    if (!offlineStoreAvailable() || userId === null) return Promise.resolve();
+    return OfflineStore.pendingTimeEntries()
+        .then(entries => {
+            if (!entries.some(entry => entry.user_id === userId)) {
+                return OfflineStore.setToken(userId, null);
+            }
+        })
+        .catch(() => {});
 }
 
 // Update UI for logged-in user
@@ -194,19 +359,16 @@ function makeAPICall(url, method = 'GET', data = null) {
         }
     };
     
-    if (authToken) {
-        options.headers['Authorization'] = `Bearer ${authToken}`;
-    }
-    
     if (data && method !== 'GET') {
         options.data = JSON.stringify(data);
     }
     
-    return $.ajax(options).catch(error => {
+    const request = authToken ? ajaxWithAuth(options, ajaxWithRetry) : ajaxWithRetry(options);
+    return request.catch(error => {
         console.error('API Error:', error);
         
         if (error.status === 401) {
-            // Token expired or invalid
+            // Token expired and couldn't be renewed
             logout();
             throw new Error('Session expired. Please log in again.');
         }
@@ -227,18 +389,41 @@ function makeAPICall(url, method = 'GET', data = null) {
     });
 }
 
+function newRequestKey() {
+    return window.crypto && crypto.randomUUID ? crypto.randomUUID() :
+        `${Date.now()}-${Math.random().toString(36).slice(2)}`;
+}
+
+// Writes carry an Idempotency-Key, so a request that failed on the network (or hit a
+// gateway error) can be retried: the server replays its first response instead of
+// saving the time entry, user, upload or assignment twice.
+const REQUEST_RETRY_DELAYS = [1000, 3000];
+
+function ajaxWithRetry(options) {
+    if (options.method === 'GET') {
+        return $.ajax(options);
+    }
+    options.headers = Object.assign({ 'Idempotency-Key': newRequestKey() }, options.headers);
+    const attempt = retry => $.ajax(options).catch(error => {
+        const retryable = error.status === 0 || error.status === 502 || error.status === 503 || error.status === 504;
+        if (!retryable || retry >= REQUEST_RETRY_DELAYS.length) {
+            throw error;
+        }
+        return new Promise(resolve => setTimeout(resolve, REQUEST_RETRY_DELAYS[retry]))
+            .then(() => attempt(retry + 1));
+    });
+    return attempt(0);
+}
+
 // File upload wrapper
 function makeFileUpload(url, formData) {
-    return $.ajax({
+    return ajaxWithAuth({
         url: url,
         method: 'POST',
         data: formData,
         processData: false,
-        contentType: false,
-        headers: {
-            'Authorization': `Bearer ${authToken}`
-        }
-    }).catch(error => {
+        contentType: false
+    }, ajaxWithRetry).catch(error => {
         console.error('Upload Error:', error);
         let errorMessage = 'Upload failed';
         if (error.responseJSON && error.responseJSON.detail) {
@@ -449,6 +634,7 @@ function initAdminDashboard() {
     loadAllCourses();
     loadAllStudents();
     loadAllTimeStats();
+    subscribeAdminEvents();
 }
 
 // Load all courses for admin
@@ -478,85 +664,231 @@ function loadAllCourses() {
     });
 }
 
-// Load all students for admin
+// Roster state for the admin dashboard, patched in place by live events
+let rosterStudents = new Map();
+let rosterVersion = 0;
+let adminEvents = null;
+let adminEventsLink = null;
+
+// Load all students for admin. After the first load only the changes since
+// rosterVersion are fetched and merged.
 function loadAllStudents() {
-    makeAPICall('/api/students').then(students => {
-        const studentsList = $('#studentsList');
-        
-        let studentsHtml = '<h3>Student Management</h3>';
-        
-        if (students.length === 0) {
-            studentsHtml += '<div class="alert alert-info">No students registered yet.</div>';
+    makeAPICall(`/api/students?since=${rosterVersion}`).then(result => {
+        if (result.full) {
+            rosterStudents = new Map(result.changes.map(student => [student.id, student]));
         } else {
-            studentsHtml += '<div class="table-responsive"><table class="table"><thead><tr><th>Name</th><th>Email</th><th>Assigned Courses</th><th>Total Practice Time</th><th>Actions</th></tr></thead><tbody>';
-            
-            students.forEach(student => {
-                const assignedCourses = student.assigned_courses ? student.assigned_courses.split(',') : [];
-                const coursesList = assignedCourses.length > 0 ? 
-                    assignedCourses.map(course => `<span class="course-tag">${course.trim()}</span>`).join(' ') : 
-                    '<span class="text-muted">None assigned</span>';
-                
-                // Format total time
-                const totalMinutes = Math.floor((student.total_practice_time || 0) / 60);
-                const hours = Math.floor(totalMinutes / 60);
-                const minutes = totalMinutes % 60;
-                const timeDisplay = `${hours}h ${minutes}m`;
-                
-                studentsHtml += `
-                    <tr>
-                        <td><strong>${student.first_name} ${student.last_name}</strong></td>
-                        <td>${student.email}</td>
-                        <td class="assigned-courses">${coursesList}</td>
-                        <td><span class="time-badge">${timeDisplay}</span></td>
-                        <td>
-                            <button class="btn btn-primary btn-sm assign-course-btn" data-student-id="${student.id}" 
-                                    data-student-name="${student.first_name} ${student.last_name}">Manage Courses</button>
-                            <button class="btn btn-secondary btn-sm view-stats-btn" data-student-id="${student.id}"
-                                    data-student-name="${student.first_name} ${student.last_name}">Detailed Stats</button>
-                            <button class="btn btn-danger btn-sm remove-student-btn" data-student-id="${student.id}"
-                                    data-student-name="${student.first_name} ${student.last_name}">Remove Student</button>
-                        </td>
-                    </tr>
-                `;
+            result.changes.forEach(student => {
+                rosterStudents.set(student.id, Object.assign(rosterStudents.get(student.id) || {}, student));
             });
-            
-            studentsHtml += '</tbody></table></div>';
+            result.deleted.forEach(studentId => rosterStudents.delete(studentId));
         }
-        
-        studentsList.html(studentsHtml);
-        
-        // Bind course assignment functionality
-        $('.assign-course-btn').click(function() {
-            const studentId = $(this).data('student-id');
-            const studentName = $(this).data('student-name');
-            showCourseManagementModal(studentId, studentName);
-        });
-        
-        // Bind view stats functionality
-        $('.view-stats-btn').click(function() {
-            const studentId = $(this).data('student-id');
-            const studentName = $(this).data('student-name');
-            showStudentStatsModal(studentId, studentName);
-        });
-        
-        // Bind remove student functionality
-        $('.remove-student-btn').click(function() {
-            const studentId = $(this).data('student-id');
-            const studentName = $(this).data('student-name');
-            showRemoveStudentModal(studentId, studentName);
+        rosterVersion = result.version;
+        renderRoster();
+        // Prefetch the class's details so opening a student needs no request
+        loadStudentDetails(Array.from(rosterStudents.keys())).catch(error => {
+            console.error('Error prefetching student details:', error);
         });
     }).catch(error => {
         showAlert(error.message, 'error');
     });
 }
 
+// Per-student details (assignments, practice stats) and the course list, fetched
+// for many students per request. Entries are dropped by live events; without the
+// event stream they are refetched after STUDENT_DETAILS_MAX_AGE_MS.
+let studentDetails = new Map();
+let detailCourses = null;
+const STUDENT_DETAILS_BATCH = 500;
+const STUDENT_DETAILS_MAX_AGE_MS = 60000;
+
+function studentDetailsFresh(studentId) {
+    const entry = studentDetails.get(studentId);
+    if (!entry) return false;
+    const live = adminEvents && adminEvents.readyState === EventSource.OPEN;
+    return live || Date.now() - entry.fetchedAt < STUDENT_DETAILS_MAX_AGE_MS;
+}
+
+function loadStudentDetails(studentIds) {
+    const wanted = studentIds.filter(studentId => !studentDetailsFresh(studentId));
+    if (wanted.length === 0 && detailCourses) return Promise.resolve();
+    
+    const batches = [];
+    for (let i = 0; i < Math.max(wanted.length, 1); i += STUDENT_DETAILS_BATCH) {
+        batches.push(wanted.slice(i, i + STUDENT_DETAILS_BATCH));
+    }
+    return Promise.all(batches.map((ids, index) => makeAPICall('/api/admin/student-details', 'POST', {
+        student_ids: ids,
+        include_courses: index === 0
+    }))).then(results => {
+        const fetchedAt = Date.now();
+        detailCourses = results[0].courses;
+        results.forEach(result => {
+            result.students.forEach(student => studentDetails.set(student.id, Object.assign(student, { fetchedAt })));
+            result.missing.forEach(studentId => studentDetails.delete(studentId));
+        });
+    });
+}
+
+function getStudentDetails(studentId) {
+    return loadStudentDetails([studentId]).then(() => {
+        const student = studentDetails.get(studentId);
+        if (!student) throw new Error('Student not found');
+        return { courses: detailCourses, student: student };
+    });
+}
+
+// Render the roster table from rosterStudents (no network)
+function renderRoster() {
+    const studentsList = $('#studentsList');
+    const students = Array.from(rosterStudents.values()).sort((a, b) =>
+        `${a.first_name} ${a.last_name}`.localeCompare(`${b.first_name} ${b.last_name}`));
+    
+    let studentsHtml = '<h3>Student Management</h3>';
+    
+    if (students.length === 0) {
+        studentsHtml += '<div class="alert alert-info">No students registered yet.</div>';
+    } else {
+        studentsHtml += '<div class="table-responsive"><table class="table"><thead><tr><th>Name</th><th>Email</th><th>Assigned Courses</th><th>Total Practice Time</th><th>Actions</th></tr></thead><tbody>';
+        students.forEach(student => {
+            studentsHtml += renderStudentRow(student);
+        });
+        studentsHtml += '</tbody></table></div>';
+    }
+    
+    studentsList.html(studentsHtml);
+    
+    // Delegated handlers, so rows added by live events work too
+    studentsList.off('click.roster');
+    
+    // Bind course assignment functionality
+    studentsList.on('click.roster', '.assign-course-btn', function() {
+        const studentId = $(this).data('student-id');
+        const studentName = $(this).data('student-name');
+        showCourseManagementModal(studentId, studentName);
+    });
+    
+    // Bind view stats functionality
+    studentsList.on('click.roster', '.view-stats-btn', function() {
+        const studentId = $(this).data('student-id');
+        const studentName = $(this).data('student-name');
+        showStudentStatsModal(studentId, studentName);
+    });
+    
+    // Bind remove student functionality
+    studentsList.on('click.roster', '.remove-student-btn', function() {
+        const studentId = $(this).data('student-id');
+        const studentName = $(this).data('student-name');
+        showRemoveStudentModal(studentId, studentName);
+    });
+}
+
+// One roster row
+function renderStudentRow(student) {
+    const assignedCourses = student.assigned_courses ? student.assigned_courses.split(',') : [];
+    const coursesList = assignedCourses.length > 0 ? 
+        assignedCourses.map(course => `<span class="course-tag">${course.trim()}</span>`).join(' ') : 
+        '<span class="text-muted">None assigned</span>';
+    
+    // Format total time
+    const totalMinutes = Math.floor((student.total_practice_time || 0) / 60);
+    const hours = Math.floor(totalMinutes / 60);
+    const minutes = totalMinutes % 60;
+    const timeDisplay = `${hours}h ${minutes}m`;
+    const practicing = student.practicing ? ' <span class="course-tag">Practicing now</span>' : '';
+    
+    return `
+        <tr data-student-id="${student.id}">
+            <td><strong>${student.first_name} ${student.last_name}</strong></td>
+            <td>${student.email}</td>
+            <td class="assigned-courses">${coursesList}</td>
+            <td><span class="time-badge">${timeDisplay}</span>${practicing}</td>
+            <td>
+                <button class="btn btn-primary btn-sm assign-course-btn" data-student-id="${student.id}" 
+                        data-student-name="${student.first_name} ${student.last_name}">Manage Courses</button>
+                <button class="btn btn-secondary btn-sm view-stats-btn" data-student-id="${student.id}"
+                        data-student-name="${student.first_name} ${student.last_name}">Detailed Stats</button>
+                <button class="btn btn-danger btn-sm remove-student-btn" data-student-id="${student.id}"
+                        data-student-name="${student.first_name} ${student.last_name}">Remove Student</button>
+            </td>
+        </tr>
+    `;
+}
+
+// Replace one student's row after a live update
+function patchStudentRow(studentId, changes) {
+    const student = rosterStudents.get(studentId);
+    if (!student) return;
+    Object.assign(student, changes);
+    $(`#studentsList tr[data-student-id="${studentId}"]`).replaceWith(renderStudentRow(student));
+}
+
+// Subscribe to live admin events (Server-Sent Events) and patch the roster
+function subscribeAdminEvents() {
+    if (!window.EventSource || adminEvents || adminEventsLink) return;
+    
+    // EventSource can't send the Authorization header, so the stream URL carries a
+    // short-lived link token instead of the access token
+    adminEventsLink = makeAPICall('/api/admin/events-link', 'POST').then(link => {
+        adminEventsLink = null;
+        openAdminEvents(link.url);
+    }, () => {
+        adminEventsLink = null;
+    });
+}
+
+function openAdminEvents(url) {
+    adminEvents = new EventSource(url);
+    const on = (type, handler) => adminEvents.addEventListener(type, event => handler(JSON.parse(event.data)));
+    // Reconnects reuse the URL's token; once it has expired the stream is refused
+    // and a new link is fetched
+    adminEvents.onerror = () => {
+        if (adminEvents.readyState !== EventSource.CLOSED) return;
+        adminEvents = null;
+        setTimeout(subscribeAdminEvents, 3000);
+    };
+    
+    on('student_added', student => {
+        rosterStudents.set(student.id, student);
+        renderRoster();
+    });
+    on('student_removed', data => {
+        rosterStudents.delete(data.id);
+        studentDetails.delete(data.id);
+        if (rosterStudents.size === 0) {
+            renderRoster();
+        } else {
+            $(`#studentsList tr[data-student-id="${data.id}"]`).remove();
+        }
+    });
+    on('assignments_changed', data => {
+        studentDetails.delete(data.student_id);
+        patchStudentRow(data.student_id, { assigned_courses: data.assigned_courses });
+    });
+    on('practice_time', data => {
+        studentDetails.delete(data.student_id);
+        const student = rosterStudents.get(data.student_id);
+        if (student) {
+            patchStudentRow(data.student_id, { total_practice_time: (student.total_practice_time || 0) + data.duration });
+        }
+    });
+    on('practice_started', data => patchStudentRow(data.student_id, { practicing: true }));
+    on('practice_stopped', data => patchStudentRow(data.student_id, { practicing: false }));
+    on('material_uploaded', data => showAlert(`New material uploaded: ${data.filename}`, 'info'));
+    // Missed too many events (slow connection, long disconnect): reload once
+    on('resync', () => loadAllStudents());
+}
+
+// After the admin's own change: live events already patch the roster when connected
+function refreshRosterUnlessLive() {
+    if (!adminEvents || adminEvents.readyState !== EventSource.OPEN) {
+        loadAllStudents();
+    }
+}
+
 // Show course management modal (replaces showCourseAssignmentModal)
 function showCourseManagementModal(studentId, studentName) {
-    Promise.all([
-        makeAPICall('/api/courses'),
-        makeAPICall(`/api/student-assignments/${studentId}`)
-    ]).then(([courses, assignments]) => {
-        const assignedCourseIds = assignments.map(a => a.course_id);
+    getStudentDetails(studentId).then(({ courses, student }) => {
+        const assignedCourseIds = student.assignments.map(a => a.course_id);
         
         let modalHtml = `
             <div class="modal-overlay">
@@ -613,7 +945,8 @@ function showCourseManagementModal(studentId, studentName) {
                 .then(() => {
                     showAlert('Course assignments updated successfully', 'success');
                     $('.modal-overlay').remove();
-                    loadAllStudents(); // Refresh the students list
+                    studentDetails.delete(studentId);
+                    refreshRosterUnlessLive(); // Refresh the students list
                 })
                 .catch(error => {
                     showAlert(error.message, 'error');
@@ -638,7 +971,8 @@ function showCourseManagementModal(studentId, studentName) {
 
 // Show student stats modal
 function showStudentStatsModal(studentId, studentName) {
-    makeAPICall(`/api/time-stats/${studentId}`).then(stats => {
+    getStudentDetails(studentId).then(({ student }) => {
+        const stats = student.time_stats;
         let totalTime = 0;
         let totalSessions = 0;
         
@@ -806,11 +1140,10 @@ function removeStudent(studentId) {
     const originalText = confirmBtn.text();
     confirmBtn.text('Removing...').prop('disabled', true);
     
-    $.ajax({
+    ajaxWithAuth({
         url: '/api/remove-student',
         method: 'POST',
         headers: {
-            'Authorization': `Bearer ${authToken}`,
             'Content-Type': 'application/json'
         },
         data: JSON.stringify({
@@ -818,12 +1151,12 @@ function removeStudent(studentId) {
         }),
         timeout: 5000 // 5 second timeout for quick response
     })
-    .done((response) => {
+    .then((response) => {
         showAlert('Student removed successfully', 'success');
         $('.modal-overlay').remove();
-        loadAllStudents(); // Refresh the students list
+        refreshRosterUnlessLive(); // Refresh the students list
     })
-    .fail((xhr) => {
+    .catch((xhr) => {
         let errorMessage = 'Failed to remove student';
         if (xhr.responseJSON && xhr.responseJSON.detail) {
             errorMessage = xhr.responseJSON.detail;
@@ -864,6 +1197,68 @@ function initCoursePage() {
     }
 }
 
+// Download every material of the course as one ZIP. The browser streams it straight
+// to disk; a link can't carry the Authorization header, so the server hands out a URL
+// with a short-lived token for this bundle only
+function downloadCourseBundle(courseId) {
+    const params = new URLSearchParams({ rendition: 'auto', formats: playableAudioFormats() });
+    makeAPICall(`/api/course-materials/${courseId}/bundle-link?${params}`, 'POST').then(link => {
+        window.location.href = link.url;
+    }).catch(error => {
+        showAlert(error.message, 'error');
+    });
+}
+
+// Escape text (e.g. an uploaded filename) for use in markup and attribute values
+function escapeHtml(text) {
+    return $('<div>').text(text).html().replace(/"/g, '&quot;');
+}
+
+// Show first-page preview of a lyrics file without downloading it
+function showMaterialPreviewModal(materialId, filename) {
+    const safeFilename = escapeHtml(filename);
+    makeAPICall(`/api/material-preview/${materialId}`).then(preview => {
+        let bodyHtml;
+        if (preview.image) {
+            bodyHtml = `<img src="data:image/png;base64,${preview.image}" alt="${safeFilename}" style="max-width: 100%;">`;
+        } else if (preview.text) {
+            bodyHtml = `<pre style="white-space: pre-wrap;">${$('<div>').text(preview.text).html()}</pre>`;
+        } else if (preview.status === 'pending' || preview.status === 'running') {
+            bodyHtml = '<div class="alert alert-info">Preview is still being prepared. Please try again shortly.</div>';
+        } else {
+            bodyHtml = '<div class="alert alert-info">No preview available for this file.</div>';
+        }
+        
+        const modalHtml = `
+            <div class="modal-overlay">
+                <div class="card" style="position: fixed; top: 50%; left: 50%; transform: translate(-50%, -50%); z-index: 1000; min-width: 500px; max-height: 80vh; overflow-y: auto;">
+                    <div class="card-header">
+                        <h3>${safeFilename}</h3>
+                        <button class="close-modal" style="float: right; background: none; border: none; font-size: 1.5rem; cursor: pointer;">&times;</button>
+                    </div>
+                    <div class="p-3">${bodyHtml}</div>
+                </div>
+            </div>
+        `;
+        
+        $('body').append(modalHtml);
+        
+        // Handle modal close
+        $('.close-modal').click(function() {
+            $('.modal-overlay').remove();
+        });
+        
+        // Close modal when clicking overlay
+        $('.modal-overlay').click(function(e) {
+            if (e.target === this) {
+                $(this).remove();
+            }
+        });
+    }).catch(error => {
+        showAlert(error.message, 'error');
+    });
+}
+
 // Get current course ID from URL
 function getCurrentCourseId() {
     const path = window.location.pathname;
@@ -890,6 +1285,8 @@ function loadCourseMaterials(courseId) {
                 lyricsHtml += `
                     <div class="material-item">
                         <span>${material.filename}</span>
+                        <button class="btn btn-secondary btn-sm preview-material" data-material-id="${material.id}"
+                                data-filename="${escapeHtml(material.filename)}">Preview</button>
                         <button class="btn btn-primary btn-sm download-material" data-material-id="${material.id}">Download</button>
                     </div>
                 `;
@@ -908,7 +1305,8 @@ function loadCourseMaterials(courseId) {
                 recordingsHtml += `
                     <div class="material-item">
                         <span>${material.filename}</span>
-                        <button class="btn btn-primary btn-sm download-material" data-material-id="${material.id}">Download</button>
+                        <button class="btn btn-primary btn-sm download-material" data-material-id="${material.id}"
+                                data-material-type="recordings">Download</button>
                     </div>
                 `;
             });
@@ -919,16 +1317,38 @@ function loadCourseMaterials(courseId) {
         // Bind download functionality (using event delegation to prevent multiple bindings)
         $(document).off('click', '.download-material').on('click', '.download-material', function() {
             const materialId = $(this).data('material-id');
-            downloadMaterial(materialId);
+            downloadMaterial(materialId, $(this).data('material-type'));
+        });
+        
+        $(document).off('click', '.preview-material').on('click', '.preview-material', function() {
+            showMaterialPreviewModal($(this).data('material-id'), $(this).data('filename'));
+        });
+        
+        $('#download-bundle').toggle(materials.length > 0).off('click').on('click', function() {
+            downloadCourseBundle(courseId);
         });
     }).catch(error => {
         showAlert(error.message, 'error');
     });
 }
 
+// Audio formats this browser can play, so the server can send a smaller rendition
+function playableAudioFormats() {
+    const audio = document.createElement('audio');
+    const formats = [];
+    if (audio.canPlayType('audio/ogg; codecs="opus"')) formats.push('audio/ogg');
+    if (audio.canPlayType('audio/mpeg')) formats.push('audio/mpeg');
+    return formats.join(',');
+}
+
 // Download material
-function downloadMaterial(materialId) {
-    makeAPICall(`/api/download-material/${materialId}`).then(response => {
+function downloadMaterial(materialId, materialType) {
+    let url = `/api/download-material/${materialId}`;
+    if (materialType === 'recordings') {
+        url += `?rendition=auto&formats=${encodeURIComponent(playableAudioFormats())}`;
+    }
+    
+    makeAPICall(url).then(response => {
         // Convert base64 to blob and download
         const byteCharacters = atob(response.content);
         const byteNumbers = new Array(byteCharacters.length);
@@ -936,7 +1356,7 @@ function downloadMaterial(materialId) {
             byteNumbers[i] = byteCharacters.charCodeAt(i);
         }
         const byteArray = new Uint8Array(byteNumbers);
-        const blob = new Blob([byteArray]);
+        const blob = new Blob([byteArray], response.mime_type ? { type: response.mime_type } : {});
         
         const url = window.URL.createObjectURL(blob);
         const a = document.createElement('a');
@@ -1031,17 +1451,110 @@ function initTimer(courseId) {
     const stopBtn = $('#stop-timer');
     const restartBtn = $('#restart-timer');
     
+    // The server owns the session and its duration; the browser only displays
+    // elapsed time and sends heartbeats so an abandoned tab is closed for us.
+    // Time the server could not see (offline) is queued from lastAck, the last
+    // moment it acknowledged the session, and synced later.
+    let sessionId = null;
+    let starting = null;  // start request in flight, resolves to its session id (or null)
     let startTime = null;
+    let lastAck = null;
+    let unsynced = false;
     let elapsedTime = 0;
     let timerInterval = null;
+    let heartbeatInterval = null;
+    let heartbeatSeconds = 30;
     
     // Initialize timer display
     updateTimerDisplay(0);
     
+    function startSession() {
+        const request = makeAPICall('/api/practice-sessions', 'POST', { course_id: courseId })
+            .then(session => {
+                if (starting !== request) {
+                    // Stopped or restarted while starting: endSession ends this session
+                    return session.session_id;
+                }
+                starting = null;
+                const now = new Date();
+                if (unsynced) {
+                    queueOfflineTimeEntry(courseId, lastAck, now);
+                }
+                sessionId = session.session_id;
+                lastAck = now;
+                unsynced = false;
+                if (session.heartbeat_seconds !== heartbeatSeconds) {
+                    heartbeatSeconds = session.heartbeat_seconds;
+                    clearInterval(heartbeatInterval);
+                    heartbeatInterval = setInterval(sendHeartbeat, heartbeatSeconds * 1000);
+                }
+                return sessionId;
+            })
+            .catch(error => {
+                console.warn('Practice session unavailable, timing locally:', error);
+                if (starting === request) {
+                    starting = null;
+                    unsynced = true;
+                }
+                return null;
+            });
+        starting = request;
+        return request;
+    }
+    
+    function sendHeartbeat() {
+        if (starting) {
+            return;
+        }
+        if (!sessionId) {
+            startSession();
+            return;
+        }
+        makeAPICall(`/api/practice-sessions/${sessionId}/heartbeat`, 'POST')
+            .then(() => {
+                lastAck = new Date();
+            })
+            .catch(() => {
+                // Offline, or the session was closed server-side (long sleep, restart):
+                // keep timing locally and in a new session once the server is reachable
+                sessionId = null;
+                unsynced = true;
+                startSession();
+            });
+    }
+    
+    function endSession(discard) {
+        clearInterval(heartbeatInterval);
+        heartbeatInterval = null;
+        // A session still starting is ended as soon as its id arrives
+        const session = sessionId ? Promise.resolve(sessionId) : (starting || Promise.resolve(null));
+        const from = lastAck;
+        sessionId = null;
+        starting = null;
+        lastAck = null;
+        unsynced = false;
+        const queueRemainder = () => {
+            queueOfflineTimeEntry(courseId, from, new Date());
+            return null;
+        };
+        return session.then(id => {
+            if (discard) {
+                return id ? makeAPICall(`/api/practice-sessions/${id}`, 'DELETE') : null;
+            }
+            if (!id) {
+                return queueRemainder();
+            }
+            return makeAPICall(`/api/practice-sessions/${id}/stop`, 'POST').catch(queueRemainder);
+        });
+    }
+    
     // Start timer
     startBtn.click(function() {
         if (!timerInterval) {
             startTime = new Date();
+            lastAck = startTime;
+            startSession();
+            heartbeatInterval = setInterval(sendHeartbeat, heartbeatSeconds * 1000);
             timerInterval = setInterval(() => {
                 const now = new Date();
                 elapsedTime = Math.floor((now - startTime) / 1000);
@@ -1060,11 +1573,16 @@ function initTimer(courseId) {
             clearInterval(timerInterval);
             timerInterval = null;
             
-            // Save time entry
-            if (startTime && elapsedTime > 0) {
-                const endTime = new Date();
-                saveTimeEntry(courseId, startTime, endTime, elapsedTime);
-            }
+            endSession(false)
+                .then(result => {
+                    if (result && result.duration > 0) {
+                        showAlert('Time tracked successfully', 'success');
+                    }
+                })
+                .catch(error => {
+                    console.error('Error saving time entry:', error);
+                    showAlert('Failed to save time entry', 'error');
+                });
             
             startBtn.prop('disabled', false);
             $(this).prop('disabled', true);
@@ -1077,6 +1595,7 @@ function initTimer(courseId) {
             clearInterval(timerInterval);
             timerInterval = null;
         }
+        endSession(true).catch(error => console.error('Error discarding practice session:', error));
         
         elapsedTime = 0;
         startTime = null;
@@ -1098,25 +1617,6 @@ function updateTimerDisplay(seconds) {
     $('#timer-display').text(display);
 }
 
-// Save time entry
-function saveTimeEntry(courseId, startTime, endTime, duration) {
-    const timeEntry = {
-        course_id: courseId,
-        start_time: startTime.toISOString(),
-        end_time: endTime.toISOString(),
-        duration: duration
-    };
-    
-    makeAPICall('/api/time-tracking', 'POST', timeEntry)
-        .then(() => {
-            showAlert('Time tracked successfully', 'success');
-        })
-        .catch(error => {
-            console.error('Error saving time entry:', error);
-            showAlert('Failed to save time entry', 'error');
-        });
-}
-
 // Global error tracking to prevent recursive error handling
 let errorHandlerActive = false;
 
@@ -0,0 +1,132 @@
+// IndexedDB storage shared by the page (app.js) and the service worker (sw.js):
+// time entries recorded while offline, the access token used to replay them, and
+// size/last-used bookkeeping for the material cache's LRU eviction.
+const OfflineStore = (() => {
+    const DB_NAME = 'sloka-offline';
+    const DB_VERSION = 1;
+    const SYNC_BATCH_SIZE = 200;
+    let dbPromise = null;
+
+    function open() {
+        if (!dbPromise) {
+            dbPromise = new Promise((resolve, reject) => {
+                const request = indexedDB.open(DB_NAME, DB_VERSION);
+                request.onupgradeneeded = () => {
+                    const db = request.result;
+                    db.createObjectStore('timeEntries', { keyPath: 'entry_key' });
+                    db.createObjectStore('tokens');
+                    db.createObjectStore('materials', { keyPath: 'url' });
+                };
+                request.onsuccess = () => resolve(request.result);
+                request.onerror = () => reject(request.error);
+            });
+        }
+        return dbPromise;
+    }
+
+    // Run action(store) in one transaction; resolves with the request's result, if any
+    function run(storeName, mode, action) {
+        return open().then(db => new Promise((resolve, reject) => {
+            const tx = db.transaction(storeName, mode);
+            const request = action(tx.objectStore(storeName));
+            tx.oncomplete = () => resolve(request ? request.result : undefined);
+            tx.onerror = () => reject(tx.error);
+        }));
+    }
+
+    function queueTimeEntry(entry) {
+        return run('timeEntries', 'readwrite', store => store.put(entry));
+    }
+
+    function pendingTimeEntries() {
+        return run('timeEntries', 'readonly', store => store.getAll());
+    }
+
+    function removeTimeEntries(keys) {
+        return run('timeEntries', 'readwrite', store => { keys.forEach(key => store.delete(key)); });
+    }
+
+    function setToken(userId, token) {
+        return run('tokens', 'readwrite', store => token ? store.put(token, userId) : store.delete(userId));
+    }
+
+    function getToken(userId) {
+        return run('tokens', 'readonly', store => store.get(userId));
+    }
+
+    // Send queued entries in batches, per user, with that user's token. Entries stay
+    // queued when the network or the token fails; the server skips keys it has seen.
+    function flushTimeEntries() {
+        return pendingTimeEntries().then(entries => {
+            const byUser = new Map();
+            entries.forEach(entry => {
+                if (!byUser.has(entry.user_id)) byUser.set(entry.user_id, []);
+                byUser.get(entry.user_id).push(entry);
+            });
+            let sent = 0;
+            let chain = Promise.resolve();
+            byUser.forEach((userEntries, userId) => {
+                chain = chain.then(() => getToken(userId)).then(token => {
+                    if (!token) return;
+                    let batches = Promise.resolve();
+                    for (let i = 0; i < userEntries.length; i += SYNC_BATCH_SIZE) {
+                        const batch = userEntries.slice(i, i + SYNC_BATCH_SIZE);
+                        batches = batches.then(() => sendBatch(batch, token)).then(() => { sent += batch.length; });
+                    }
+                    return batches;
+                });
+            });
+            return chain.then(() => sent);
+        });
+    }
+
+    function sendBatch(batch, token) {
+        return fetch('/api/time-tracking/batch', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+                'Authorization': `Bearer ${token}`
+            },
+            body: JSON.stringify({
+                entries: batch.map(({ entry_key, course_id, start_time, end_time, duration }) =>
+                    ({ entry_key, course_id, start_time, end_time, duration }))
+            })
+        }).then(response => {
+            if (!response.ok) {
+                throw new Error(`Time entry sync failed (${response.status})`);
+            }
+            return removeTimeEntries(batch.map(entry => entry.entry_key));
+        });
+    }
+
+    // Record a cache hit or insert; size is only known (and only updated) on insert
+    function touchMaterial(url, size) {
+        return run('materials', 'readwrite', store => {
+            const request = store.get(url);
+            request.onsuccess = () => {
+                const record = request.result || { url, size: 0 };
+                if (size !== undefined) record.size = size;
+                record.lastUsed = Date.now();
+                store.put(record);
+            };
+        });
+    }
+
+    function cachedMaterials() {
+        return run('materials', 'readonly', store => store.getAll());
+    }
+
+    function forgetMaterials(urls) {
+        return run('materials', 'readwrite', store => { urls.forEach(url => store.delete(url)); });
+    }
+
+    return {
+        queueTimeEntry,
+        pendingTimeEntries,
+        flushTimeEntries,
+        setToken,
+        touchMaterial,
+        cachedMaterials,
+        forgetMaterials
+    };
+})();
@@ -0,0 +1,131 @@
+// Service worker: keeps the app usable on poor connections.
+// - Pages and static assets: network first, cached copy when offline
+// - Course lists and material listings: network first, cached copy when offline
+// - Material downloads: cache first, bounded by MATERIAL_CACHE_MAX_BYTES with LRU eviction
+// - Course ZIP bundles: not intercepted, so they stream to disk
+// - Time entries recorded offline (IndexedDB, see offline-store.js) are replayed on "sync"
+importScripts('/static/js/offline-store.js');
+
+const SHELL_CACHE = 'sloka-shell-v1';
+const API_CACHE = 'sloka-api-v1';
+const MATERIAL_CACHE = 'sloka-materials-v1';
+const MATERIAL_CACHE_MAX_BYTES = 200 * 1024 * 1024;
+const SHELL_URLS = ['/', '/login', '/dashboard', '/static/css/style.css', '/static/js/offline-store.js'];
+
+self.addEventListener('install', event => {
+    event.waitUntil(caches.open(SHELL_CACHE).then(cache => cache.addAll(SHELL_URLS)).then(() => self.skipWaiting()));
+});
+
+self.addEventListener('activate', event => {
+    const current = [SHELL_CACHE, API_CACHE, MATERIAL_CACHE];
+    event.waitUntil(
+        caches.keys()
+            .then(names => Promise.all(names.filter(name => !current.includes(name)).map(name => caches.delete(name))))
+            .then(() => self.clients.claim())
+    );
+});
+
+self.addEventListener('fetch', event => {
+    const request = event.request;
+    if (request.method !== 'GET') return;
+    const url = new URL(request.url);
+
+    if (url.origin !== self.location.origin) {
+        // jQuery from the CDN: part of the shell
+        if (url.hostname === 'code.jquery.com') {
+            event.respondWith(cacheFirst(SHELL_CACHE, request));
+        }
+        return;
+    }
+    if (url.pathname.endsWith('/bundle')) {
+        // Course ZIPs stream straight to disk; never copy them into a cache
+        return;
+    }
+    if (url.pathname.startsWith('/api/download-material/')) {
+        event.respondWith(materialFirst(request));
+    } else if (url.pathname === '/api/courses' || url.pathname.startsWith('/api/course-materials/')) {
+        event.respondWith(networkFirst(API_CACHE, request));
+    } else if (request.mode === 'navigate' || url.pathname.startsWith('/static/')) {
+        event.respondWith(networkFirst(SHELL_CACHE, request));
+    }
+});
+
+self.addEventListener('sync', event => {
+    if (event.tag === 'time-entries') {
+        event.waitUntil(OfflineStore.flushTimeEntries());
+    }
+});
+
+self.addEventListener('message', event => {
+    const message = event.data || {};
+    if (message.type === 'cache-urls') {
+        // Assets of the page that registered us, fetched before we were in control
+        event.waitUntil(caches.open(SHELL_CACHE).then(cache => Promise.all(
+            message.urls.map(url => cache.add(new Request(url, { mode: new URL(url).origin === self.location.origin ? 'same-origin' : 'no-cors' })).catch(() => null))
+        )));
+    } else if (message.type === 'logout') {
+        // Cached lists and materials belong to the user who downloaded them
+        event.waitUntil(Promise.all([
+            caches.delete(API_CACHE),
+            caches.delete(MATERIAL_CACHE),
+            OfflineStore.cachedMaterials().then(records => OfflineStore.forgetMaterials(records.map(record => record.url)))
+        ]));
+    }
+});
+
+function networkFirst(cacheName, request) {
+    return fetch(request).then(response => {
+        if (response.ok) {
+            const copy = response.clone();
+            caches.open(cacheName).then(cache => cache.put(request, copy));
+        }
+        return response;
+    }).catch(() => caches.open(cacheName)
+        .then(cache => cache.match(request))
+        .then(cached => cached || Response.error()));
+}
+
+function cacheFirst(cacheName, request) {
+    return caches.open(cacheName).then(cache => cache.match(request).then(cached => cached || fetch(request).then(response => {
+        cache.put(request, response.clone());
+        return response;
+    })));
+}
+
+// Materials never change once uploaded, so a cached copy is always valid
+function materialFirst(request) {
+    return caches.open(MATERIAL_CACHE).then(cache => cache.match(request).then(cached => {
+        if (cached) {
+            OfflineStore.touchMaterial(request.url);
+            return cached;
+        }
+        return fetch(request).then(response => {
+            if (!response.ok) return response;
+            const copy = response.clone();
+            copy.blob().then(body => {
+                if (body.size > MATERIAL_CACHE_MAX_BYTES) return;
+                return cache.put(request, new Response(body, { headers: response.headers }))
+                    .then(() => OfflineStore.touchMaterial(request.url, body.size))
+                    .then(() => evictMaterials(cache));
+            });
+            return response;
+        });
+    }));
+}
+
+// Drop least recently used materials until the cache fits its budget
+function evictMaterials(cache) {
+    return OfflineStore.cachedMaterials().then(records => {
+        let total = records.reduce((sum, record) => sum + record.size, 0);
+        if (total <= MATERIAL_CACHE_MAX_BYTES) return;
+        records.sort((a, b) => a.lastUsed - b.lastUsed);
+        const evicted = [];
+        for (const record of records) {
+            if (total <= MATERIAL_CACHE_MAX_BYTES) break;
+            total -= record.size;
+            evicted.push(record.url);
+        }
+        return Promise.all(evicted.map(url => cache.delete(url)))
+            .then(() => OfflineStore.forgetMaterials(evicted));
+    });
+}
@@ -0,0 +1,111 @@
+"""Backup round trip: writes, a backup, more journaled writes, then a point-in-time
+restore must rebuild exactly the tables as they were at that point.
+
+The writes mix transactions and autocommit statements, and statements that read
+the clock directly or through a column default, since replay has to reproduce each.
+
+    python -m pytest tests/test_backup_restore.py
+"""
+
+import os
+import sys
+import time
+from datetime import datetime
+
+import duckdb
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main_full
+
+@pytest.fixture
+def journaled_db(tmp_path, monkeypatch):
+    monkeypatch.setenv("DATABASE_PATH", str(tmp_path / "students.db"))
+    monkeypatch.setattr(main_full, "db_conn", None)
+    monkeypatch.setattr(main_full, "BACKUP_DIR", str(tmp_path / "backups"))
+    monkeypatch.setattr(main_full, "BACKUP_JOURNAL_CHECK_SECONDS", 0)
+    monkeypatch.setattr(main_full, "_backup_store", None)
+    monkeypatch.setattr(main_full, "backup_journal", None)
+    main_full.init_db()
+    yield main_full.get_db()
+    main_full.db_conn.close()
+
+def add_student(conn, email):
+    # A transaction, with created_at and assigned_at from column defaults
+    conn.execute("BEGIN")
+    try:
+        (student_id,) = main_full.next_ids(conn, "users_id")
+        conn.execute("""
+            INSERT INTO users (id, first_name, last_name, email, password_hash, is_admin)
+            VALUES (?, 'Student', 'Test', ?, 'x', FALSE)
+        """, (student_id, email))
+        conn.execute("INSERT INTO student_courses (id, student_id, course_id) VALUES (?, ?, 1)",
+                     (*main_full.next_ids(conn, "student_courses_id"), student_id))
+        main_full.record_changes(conn, "users", [student_id])
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    return student_id
+
+def log_practice(conn, student_id, seconds):
+    # Autocommit writes: one binding its values, one reading the clock in its text
+    conn.execute("""
+        INSERT INTO time_tracking (id, student_id, course_id, start_time, end_time, duration)
+        VALUES (?, ?, 1, ?, ?, ?)
+    """, (*main_full.next_ids(conn, "time_tracking_id"), student_id,
+          datetime(2026, 1, 5, 6), datetime(2026, 1, 5, 7), seconds))
+    conn.execute("UPDATE users SET deleted_at = CURRENT_TIMESTAMP WHERE id = ?", (student_id,))
+
+def table_rows(conn):
+    tables = [name for (name,) in conn.execute(
+        "SELECT table_name FROM duckdb_tables() WHERE schema_name = 'main' ORDER BY 1"
+    ).fetchall()]
+    return {table: sorted(map(repr, conn.execute(f'SELECT * FROM "{table}"').fetchall())) for table in tables}
+
+def test_restore_until_replays_journal_to_that_point(journaled_db, tmp_path):
+    conn = journaled_db
+    before = add_student(conn, "before@restore.example.com")
+    log_practice(conn, before, 60)
+    assert main_full.take_backup() is not None
+
+    for i in range(3):
+        student_id = add_student(conn, f"after{i}@restore.example.com")
+        log_practice(conn, student_id, 120 + i)
+    # Materials insert through their uploaded_at default, in autocommit
+    conn.execute("""
+        INSERT INTO course_materials (id, course_id, material_type, filename, content)
+        VALUES (?, 1, 'lyrics', 'sloka.txt', 'om'::BLOB)
+    """, main_full.next_ids(conn, "course_materials_id"))
+    main_full.backup_journal.check(conn)
+    expected = table_rows(conn)
+    until = datetime.utcnow()
+    time.sleep(0.01)
+
+    late = add_student(conn, "late@restore.example.com")
+    log_practice(conn, late, 300)
+    main_full.ship_backup_journal()
+
+    target = str(tmp_path / "restored.db")
+    report = main_full.restore_backup(target, until=until, archive_dir=str(tmp_path / "restored-archive"))
+    assert report.get("replay_error") is None
+    assert report["replayed_transactions"] == 10
+    assert report["replay_checks"] and report["replay_verified"]
+    restored = duckdb.connect(target)
+    try:
+        assert table_rows(restored) == expected
+    finally:
+        restored.close()
+
+def test_autocommit_write_runs_outside_a_transaction(journaled_db):
+    conn = journaled_db
+    assert main_full.backup_journal is not None
+    student_id = add_student(conn, "plain@restore.example.com")
+    # The result is the statement's own, not rows fetched ahead
+    result = conn.execute("UPDATE users SET last_name = 'Renamed' WHERE id = ?", (student_id,))
+    assert not isinstance(result, main_full.FetchedResult)
+    assert result.fetchall() == [(1,)]
+    with pytest.raises(duckdb.ConstraintException):
+        conn.execute("UPDATE users SET email = 'plain@restore.example.com' WHERE id = 1")
+    assert conn.execute("SELECT last_name FROM users WHERE id = ?", (student_id,)).fetchone() == ("Renamed",)
@@ -0,0 +1,92 @@
+"""Idempotency-Key handling on a mutating endpoint (POST /api/time-tracking): a
+repeated key replays the stored response, a key reused with other parameters is
+rejected, and a duplicate sent while the first request runs waits for its result.
+
+    python -m pytest tests/test_idempotency.py
+"""
+
+import os
+import sys
+import threading
+
+import pytest
+from fastapi.testclient import TestClient
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main_full
+
+ENTRY = {"course_id": 1, "start_time": "2026-10-19T05:00:00", "duration": 60}
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    monkeypatch.setenv("DATABASE_PATH", str(tmp_path / "students.db"))
+    monkeypatch.setattr(main_full, "db_conn", None)
+    monkeypatch.setattr(main_full, "RATE_LIMIT_ENABLED", False)
+    monkeypatch.setattr(main_full, "idempotency_store", main_full.IdempotencyStore(60, 100))
+    with TestClient(main_full.app) as client:
+        yield client
+    main_full.db_conn.close()
+
+@pytest.fixture
+def student(client):
+    credentials = {"email": "student@idempotency.example.com", "password": "Passw0rd!"}
+    assert client.post("/api/register", json={**credentials, "first_name": "Student", "last_name": "Test"}).status_code == 200
+    token = client.post("/api/login", json=credentials).json()["access_token"]
+    student_id = main_full.get_db().execute("SELECT id FROM users WHERE email = ?", (credentials["email"],)).fetchone()[0]
+    return student_id, {"Authorization": f"Bearer {token}"}
+
+def entry_count(student_id):
+    return main_full.get_db().execute("SELECT COUNT(*) FROM time_tracking WHERE student_id = ?", (student_id,)).fetchone()[0]
+
+def test_completed_request_is_replayed(client, student):
+    student_id, headers = student
+    headers = {**headers, "Idempotency-Key": "replay-1"}
+    first = client.post("/api/time-tracking", headers=headers, json=ENTRY)
+    second = client.post("/api/time-tracking", headers=headers, json=ENTRY)
+    assert first.status_code == second.status_code == 200
+    assert second.json() == first.json()
+    assert "idempotent-replayed" not in first.headers
+    assert second.headers["idempotent-replayed"] == "true"
+    assert entry_count(student_id) == 1
+
+def test_key_reused_with_other_parameters_is_rejected(client, student):
+    student_id, headers = student
+    headers = {**headers, "Idempotency-Key": "mismatch-1"}
+    assert client.post("/api/time-tracking", headers=headers, json=ENTRY).status_code == 200
+    response = client.post("/api/time-tracking", headers=headers, json={**ENTRY, "duration": 90})
+    assert response.status_code == 422
+    assert entry_count(student_id) == 1
+
+def test_concurrent_duplicate_waits_for_the_first(client, student, monkeypatch):
+    student_id, headers = student
+    headers = {**headers, "Idempotency-Key": "concurrent-1"}
+    entered, release = threading.Event(), threading.Event()
+    record_changes = main_full.record_changes
+
+    def held_record_changes(*args, **kwargs):
+        # Holds the first request inside its transaction until the duplicate is queued
+        entered.set()
+        assert release.wait(10)
+        return record_changes(*args, **kwargs)
+
+    monkeypatch.setattr(main_full, "record_changes", held_record_changes)
+    responses = {}
+    def post(name):
+        responses[name] = client.post("/api/time-tracking", headers=headers, json=ENTRY)
+    first = threading.Thread(target=post, args=("first",))
+    first.start()
+    assert entered.wait(10)
+    duplicate = threading.Thread(target=post, args=("duplicate",))
+    duplicate.start()
+    duplicate.join(0.5)
+    assert duplicate.is_alive()  # waiting on the first, not running the endpoint again
+    release.set()
+    first.join(10)
+    duplicate.join(10)
+
+    assert responses["first"].status_code == responses["duplicate"].status_code == 200
+    assert responses["duplicate"].json() == responses["first"].json()
+    assert responses["duplicate"].headers["idempotent-replayed"] == "true"
+    assert main_full.idempotency_store.summary()["waited"] == 1
+    assert entry_count(student_id) == 1
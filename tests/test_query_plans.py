@@ -0,0 +1,83 @@
+"""Query-plan regression test: every hot query in main_full.HOT_QUERIES must be
+served by an index, not a full scan of its table.
+
+DuckDB only picks an index scan for selective filters, so the check runs on a
+seeded dataset shaped like production (many students, each with a small share of
+the assignments, time entries and materials).
+
+    python -m pytest tests/test_query_plans.py
+"""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main_full
+
+STUDENTS = 2000
+COURSES = 12
+TIME_ENTRIES = 100000
+MATERIALS_PER_COURSE = 50
+FIRST_STUDENT_ID = 100
+
+@pytest.fixture(scope="module")
+def seeded_db(tmp_path_factory, monkeypatch_module):
+    monkeypatch_module.setenv("DATABASE_PATH", str(tmp_path_factory.mktemp("plans") / "students.db"))
+    monkeypatch_module.setattr(main_full, "db_conn", None)
+    main_full.init_db()
+    conn = main_full.get_db()
+    conn.execute("""
+        INSERT OR IGNORE INTO courses (id, name, description)
+        SELECT i, 'Course ' || i, 'Synthetic course ' || i FROM range(7, ?) t(i)
+    """, (COURSES + 1,))
+    conn.execute("""
+        INSERT INTO users (id, first_name, last_name, email, password_hash, is_admin)
+        SELECT ? + i, 'Student', 'No' || i, 'student' || i || '@plans.example.com', 'x', FALSE
+        FROM range(?) t(i)
+    """, (FIRST_STUDENT_ID, STUDENTS))
+    conn.execute("""
+        INSERT INTO student_courses (id, student_id, course_id)
+        SELECT row_number() OVER (), s.i + ?, c.i + 1
+        FROM range(?) s(i), range(?) c(i)
+        WHERE (s.i + c.i) % 3 = 0
+    """, (FIRST_STUDENT_ID, STUDENTS, COURSES))
+    conn.execute("""
+        INSERT INTO time_tracking (id, student_id, course_id, start_time, end_time, duration)
+        SELECT i + 1, ? + (i * 7919) % ?, 1 + (i * 31) % ?,
+               now() - to_seconds(i % 86400), now() - to_seconds(i % 86400) + to_seconds(60), 60
+        FROM range(?) t(i)
+    """, (FIRST_STUDENT_ID, STUDENTS, COURSES, TIME_ENTRIES))
+    conn.execute("""
+        INSERT INTO course_materials (id, course_id, material_type, filename, content)
+        SELECT i + 1, 1 + i % ?, 'lyrics', 'sloka' || i || '.txt', 'text'::BLOB
+        FROM range(?) t(i)
+    """, (COURSES, COURSES * MATERIALS_PER_COURSE))
+    conn.execute("""
+        INSERT INTO material_derivatives (id, material_id, kind, mime_type, content, size)
+        SELECT i + 1, 1 + i // 2, 'preview_text', 'text/plain', 'text'::BLOB, 4
+        FROM range(?) t(i)
+    """, (COURSES * MATERIALS_PER_COURSE * 2,))
+    conn.execute("CHECKPOINT")
+    yield conn
+    main_full.db_conn.close()
+
+@pytest.fixture(scope="module")
+def monkeypatch_module():
+    with pytest.MonkeyPatch.context() as patch:
+        yield patch
+
+def test_hot_queries_use_indexes(seeded_db):
+    assert main_full.check_query_plans(seeded_db) == []
+
+def test_check_detects_full_scan(seeded_db):
+    # Without the index the same data must be reported, or the test above proves nothing.
+    # material_derivatives has no foreign key, whose implicit index would still serve it
+    seeded_db.execute("DROP INDEX idx_material_derivatives_material")
+    try:
+        failures = main_full.check_query_plans(seeded_db)
+    finally:
+        main_full.create_hot_path_indexes(seeded_db, "material_derivatives")
+    assert failures == ["material derivatives: full scan of material_derivatives"]
@@ -0,0 +1,68 @@
+"""Rate limiting of POST /api/login: failed attempts lock the account for a while,
+successful sign-ins never count toward that, and a limited request gets a 429 with
+Retry-After.
+
+    python -m pytest tests/test_rate_limits.py
+"""
+
+import os
+import sys
+
+import pytest
+from fastapi.testclient import TestClient
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main_full
+
+ACCOUNT_ATTEMPTS = 3
+CREDENTIALS = {"email": "student@ratelimit.example.com", "password": "Passw0rd!"}
+WRONG = {**CREDENTIALS, "password": "wrong"}
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    monkeypatch.setenv("DATABASE_PATH", str(tmp_path / "students.db"))
+    monkeypatch.setattr(main_full, "db_conn", None)
+    monkeypatch.setattr(main_full, "RATE_LIMIT_ENABLED", True)
+    monkeypatch.setattr(main_full, "local_rate_limits", main_full.TokenBuckets(1000))
+    # The per-IP login limit stays out of the way unless a test lowers it
+    monkeypatch.setattr(main_full, "RATE_LIMITS", {
+        **main_full.RATE_LIMITS, "login": (100, 60), "login_account": (ACCOUNT_ATTEMPTS, 300)
+    })
+    with TestClient(main_full.app) as client:
+        response = client.post("/api/register", json={**CREDENTIALS, "first_name": "Student", "last_name": "Test"})
+        assert response.status_code == 200
+        yield client
+    main_full.db_conn.close()
+
+def signed_in(response):
+    return response.status_code == 200 and "access_token" in response.json()
+
+def test_failed_logins_lock_the_account(client):
+    for _ in range(ACCOUNT_ATTEMPTS):
+        response = client.post("/api/login", json=WRONG)
+        assert response.status_code != 429 and not signed_in(response)
+    # Locked now, even with the right password
+    response = client.post("/api/login", json=CREDENTIALS)
+    assert response.status_code == 429
+    assert int(response.headers["retry-after"]) >= 1
+    # Per account: another address still signs in
+    response = client.post("/api/login", json={"email": "jayab2021@gmail.com", "password": "Admin@123"})
+    assert signed_in(response)
+
+def test_successful_logins_do_not_count(client):
+    for _ in range(ACCOUNT_ATTEMPTS * 3):
+        assert signed_in(client.post("/api/login", json=CREDENTIALS))
+    for _ in range(ACCOUNT_ATTEMPTS - 1):
+        assert not signed_in(client.post("/api/login", json=WRONG))
+    assert signed_in(client.post("/api/login", json=CREDENTIALS))
+
+def test_limited_request_gets_429_with_retry_after(client, monkeypatch):
+    monkeypatch.setattr(main_full, "RATE_LIMITS", {**main_full.RATE_LIMITS, "login": (2, 60)})
+    for _ in range(2):
+        assert signed_in(client.post("/api/login", json=CREDENTIALS))
+    response = client.post("/api/login", json=CREDENTIALS)
+    assert response.status_code == 429
+    assert 1 <= int(response.headers["retry-after"]) <= 60
+    assert response.headers["ratelimit-limit"] == "2"
+    assert response.headers["ratelimit-remaining"] == "0"